@@ -0,0 +1,356 @@
+"""
+Production ASGI serving mode for the sizing API.
+
+Serves the same POST /api/size contract as the Flask app in sizecharter_api,
+from any ASGI server, without importing Flask. Run as a script it uses
+uvicorn (pip install uvicorn):
+
+    python sizecharter_asgi.py --port 8000 --workers 4
+
+One process holds one copy of the charter tables, and all connections share
+it. Sizing runs on a worker thread pool so the event loop keeps accepting
+connections. When max_pending requests are already in flight, new ones are
+shed with a 503 instead of queueing without limit. Each request has a deadline
+and gets a 504 once it passes. Shutdown stops taking new requests and waits
+for in-flight ones before the pool is stopped. With --batch-size, concurrent
+requests are micro-batched and identical ones coalesced (see
+sizecharter_microbatch).
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from sizecharter_cache import RecommendationCache
+from sizecharter_core import SizeCharterTuned
+from sizecharter_registry import ChartRegistry, resolve_chart
+from sizecharter_json import dumps
+from sizecharter_request import SIZE_REQUEST, error_body, field_error, load_body
+from sizecharter_result import SizeRecommendation
+
+MAX_BODY_BYTES = 1 << 20
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+PREFLIGHT_HEADERS = CORS_HEADERS + [
+    (b"access-control-allow-methods", b"POST, OPTIONS"),
+    (b"access-control-allow-headers", b"content-type"),
+]
+
+
+class RequestRejected(Exception):
+    """
+    Raised while handling a request to answer it with an error status.
+
+    errors optionally lists structured field errors (see sizecharter_request);
+    message is the first one's.
+    """
+
+    def __init__(self, status, message, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.errors = errors
+
+    def body(self):
+        if self.errors:
+            return dumps(error_body(self.errors))
+        return dumps({"error": self.message})
+
+
+class _Slot:
+    """
+    One request's share of max_pending. The slot is given back when the
+    request is answered and every job it started has finished, so a request
+    that timed out keeps counting until its sizing work is really done.
+    Only used on the event loop's thread.
+    """
+    __slots__ = ("app", "holders")
+
+    def __init__(self, app):
+        self.app = app
+        self.holders = 1
+        app._pending += 1
+        app._idle.clear()
+
+    def hold(self):
+        self.holders += 1
+
+    def release(self):
+        self.holders -= 1
+        if not self.holders:
+            self.app._pending -= 1
+            if not self.app._pending:
+                self.app._idle.set()
+
+
+class SizingApp:
+    """
+    ASGI application serving POST /api/size.
+
+    sizer             charter to size with (a cached SizeCharterTuned by default)
+    registry          ChartRegistry resolving request "chart" IDs (default: charts/)
+    workers           threads in the sizing pool
+    max_pending       requests allowed in flight before new ones get a 503
+    request_timeout   seconds allowed per request before a 504
+    shutdown_timeout  seconds shutdown waits for in-flight requests to finish
+    shadow            optional ShadowComparer that results are submitted to;
+                      its stats are served on GET /api/shadow
+    batch_size        opt in to micro-batching: concurrent requests are sized
+                      together, up to this many per batch (see sizecharter_microbatch);
+                      its stats are served on GET /api/batching
+    store             optional ProfileStore; bodies with a "profile_id" are
+                      answered through it (see sizecharter_store)
+    batch_delay       seconds a micro-batch waits for more requests
+    """
+
+    def __init__(self, sizer=None, workers=4, max_pending=256, request_timeout=5.0, shutdown_timeout=30.0,
+                 registry=None, shadow=None, batch_size=None, batch_delay=0.002, store=None):
+        self.sizer = sizer if sizer is not None else SizeCharterTuned(cache=RecommendationCache(maxsize=100000))
+        self.registry = registry if registry is not None else ChartRegistry()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.shadow = shadow
+        self.store = store
+        self.batcher = None
+        if batch_size:
+            from sizecharter_microbatch import MicroBatcher
+            self.batcher = MicroBatcher(self.sizer, batch_size, batch_delay)
+        self._executor = None
+        self._pending = 0
+        self._idle = None
+        self._closing = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    def startup(self):
+        """
+        Start the sizing pool. Called on lifespan startup, or lazily on the first request.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="sizing")
+        if self.batcher is not None:
+            self.batcher.executor = self._executor
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+
+    async def shutdown(self):
+        """
+        Refuse new requests, wait up to shutdown_timeout for in-flight ones, then stop the pool.
+        """
+        self._closing = True
+        if self._idle is not None:
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.shadow is not None:
+            self.shadow.close()
+        if self.store is not None:
+            self.store.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        if scope["path"] == "/api/shadow" and scope["method"] == "GET":
+            if self.shadow is None:
+                await _send_json(send, 404, b'{"error": "Shadow mode is not enabled"}')
+            else:
+                await _send_json(send, 200, dumps(self.shadow.stats()))
+            return
+        if scope["path"] == "/api/batching" and scope["method"] == "GET":
+            if self.batcher is None:
+                await _send_json(send, 404, b'{"error": "Micro-batching is not enabled"}')
+            else:
+                await _send_json(send, 200, dumps(self.batcher.stats()))
+            return
+        if scope["path"] != "/api/size":
+            await _send_json(send, 404, b'{"error": "Not found"}')
+            return
+        if scope["method"] == "OPTIONS":
+            await _send(send, 204, b"", PREFLIGHT_HEADERS)
+            return
+        if scope["method"] != "POST":
+            await _send_json(send, 405, b'{"error": "Method not allowed"}', [(b"allow", b"POST, OPTIONS")])
+            return
+        if self._closing or self._pending >= self.max_pending:
+            await _send_json(send, 503, b'{"error": "Server busy, retry later"}', [(b"retry-after", b"1")])
+            return
+
+        if self._executor is None:
+            self.startup()
+        slot = _Slot(self)
+        try:
+            status, body = await asyncio.wait_for(self._size(receive, slot), self.request_timeout)
+        except asyncio.TimeoutError:
+            status, body = 504, b'{"error": "Request timed out"}'
+        except RequestRejected as exc:
+            status, body = exc.status, exc.body()
+        except ConnectionAbortedError:
+            return
+        finally:
+            slot.release()
+        await _send_json(send, status, body)
+
+    async def _size(self, receive, slot):
+        # Returns (status, response body)
+        data, errors = load_body(await _read_body(receive))
+        if not errors and self.store is not None and type(data) is dict and "profile_id" in data:
+            return await self._run(slot, self._size_profile, data)
+        if not errors:
+            kwargs, errors = SIZE_REQUEST.decode(data)
+        if errors:
+            raise RequestRejected(400, errors[0]["message"], errors)
+        explain = data.get("explain") is True
+        if self.batcher is not None and "chart" not in kwargs and not explain:
+            # Requests naming a chart are sized one by one: batches share one chart.
+            # The slot is held until the batch delivers, even if this request times out
+            task = asyncio.ensure_future(self.batcher.recommend(kwargs))
+            slot.hold()
+
+            def delivered(done):
+                slot.release()
+                if not done.cancelled():
+                    done.exception()  # retrieved, so a timed-out request's error is not logged as unhandled
+
+            task.add_done_callback(delivered)
+            return 200, self._encode(kwargs, await asyncio.shield(task))
+        return 200, await self._run(slot, self._size_json, kwargs, explain)
+
+    def _run(self, slot, function, *args):
+        # function(*args) on the sizing pool. The slot is held until the job itself
+        # finishes (or is cancelled before it starts), not until the caller stops waiting
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(function, *args)
+        slot.hold()
+
+        def finished(_):
+            try:
+                loop.call_soon_threadsafe(slot.release)
+            except RuntimeError:
+                pass  # the loop is already closed
+
+        job.add_done_callback(finished)
+        return asyncio.wrap_future(job)
+
+    def _size_profile(self, data):
+        # Runs on the sizing pool: the store's SQLite reads and writes block
+        status, body, kwargs, result = self.store.size(self.sizer, data, self.registry)
+        if self.shadow is not None and result is not None:
+            self.shadow.submit(kwargs, result)
+        return status, body
+
+    def _size_json(self, kwargs, explain=False):
+        # Runs on the sizing pool: chart loading, sizing and encoding are all blocking work
+        try:
+            resolve_chart(self.registry, kwargs)
+        except KeyError as exc:
+            raise RequestRejected(404, exc.args[0], [field_error("chart", exc.args[0])]) from exc
+        except ValueError as exc:
+            message = f"Chart failed to load: {exc}"
+            raise RequestRejected(500, message, [field_error("chart", message)]) from exc
+        if explain:
+            return self._encode(kwargs, *self.sizer.explain_size_recommendation(**kwargs))
+        return self._encode(kwargs, self.sizer.get_size_recommendation(**kwargs))
+
+    def _encode(self, kwargs, result, explanation=None):
+        if self.shadow is not None:
+            self.shadow.submit(kwargs, result)
+        if explanation is not None:
+            return dumps({**result.to_dict(), "explanation": explanation})
+        if isinstance(result, SizeRecommendation):
+            return result.to_json_bytes()
+        return dumps(result)
+
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionAbortedError()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise RequestRejected(413, "Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _send(send, status, body, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers + [(b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status, body, headers=()):
+    await _send(send, status, body, [(b"content-type", b"application/json")] + CORS_HEADERS + list(headers))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the sizing API over ASGI with uvicorn.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4, help="sizing threads")
+    parser.add_argument("--max-pending", type=int, default=256, help="in-flight requests before shedding with 503")
+    parser.add_argument("--timeout", type=float, default=5.0, help="per-request deadline in seconds")
+    parser.add_argument("--keep-alive", type=int, default=15, help="idle keep-alive timeout in seconds")
+    parser.add_argument("--shutdown-timeout", type=float, default=30.0, help="graceful shutdown limit in seconds")
+    parser.add_argument("--shadow", action="store_true",
+                        help="compare SizeCharterMimic against the served answers off the request path")
+    parser.add_argument("--shadow-sample", type=float, default=1.0, help="fraction of requests compared")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="micro-batch concurrent requests, up to this many per batch (0 = off); "
+                             "mainly helps when identical requests arrive together")
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="milliseconds a micro-batch waits for more")
+    parser.add_argument("--profile-store", help="SQLite file of stored results per profile_id (see sizecharter_store)")
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.exit(1, "uvicorn is required to serve the ASGI app: pip install uvicorn\n")
+
+    sizer = SizeCharterTuned(cache=RecommendationCache(maxsize=100000))
+    shadow = None
+    if args.shadow:
+        from sizecharter_mimic import SizeCharterMimic
+        from sizecharter_shadow import ShadowComparer
+        shadow = ShadowComparer(sizer, SizeCharterMimic(), sample=args.shadow_sample)
+    store = None
+    if args.profile_store:
+        from sizecharter_store import ProfileStore
+        store = ProfileStore(args.profile_store)
+    app = SizingApp(sizer, workers=args.workers, max_pending=args.max_pending,
+                    request_timeout=args.timeout, shutdown_timeout=args.shutdown_timeout, shadow=shadow,
+                    batch_size=args.batch_size, batch_delay=args.batch_delay / 1000, store=store)
+    print(f"Starting SizeCharterTuned ASGI API on http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port, lifespan="on",
+                timeout_keep_alive=args.keep_alive,
+                timeout_graceful_shutdown=args.shutdown_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+"""
+Vectorized batch sizing over NumPy arrays.
+
+These functions back SizeCharterTuned.get_size_recommendations_batch and
+SizeCharterMimic.get_size_recommendations_batch. They mirror each engine's
+per-shopper get_size_recommendation step for step (shape inference,
+morphology adjustment, range matching, warnings and health checks), but runs
+every step as an array operation over all N shoppers at once.
+
+Measurements come in as a columnar block with NaN meaning "missing". Results
+come back as arrays of small integer codes:
+
+    size        ordinal into "sizes" (-1 = no match)
+    body_shape  index into "body_shapes" (-1 = none inferred)
+    warnings    bitmask over the engine's WARNING_MESSAGES
+    health      bitmask over MEASUREMENT_FIELDS, set where a measurement is
+                outside the engine's typical range
+
+The charter's charts are first compiled into "batch tables": plain nested
+dicts of NumPy arrays (see batch_tables). They are all the batch path needs,
+so they can be shared with other processes without the charter itself.
+
+NumPy is only needed by this module; importing the charter classes does not
+pull it in.
+"""
+import time
+from array import array
+
+import numpy as np
+
+from sizecharter_index import MEASUREMENT_FIELDS, NearestMatch
+
+FIELD_POSITIONS = {name: i for i, name in enumerate(MEASUREMENT_FIELDS)}
+CHEST, WAIST, HIPS, INSEAM, SHOULDERS, NECK, THIGH, CALF = range(len(MEASUREMENT_FIELDS))
+
+# Fields the morphology adjustments apply to, in both engines
+ADJUSTED_FIELDS = ("chest", "waist", "hips")
+
+# Shapes each engine's _infer_body_shape can return, per department
+BODY_SHAPES = {
+    "tuned": {
+        "womens": ("hourglass", "pear", "apple", "inverted_triangle", "rectangle"),
+        "mens": ("triangle", "oval", "rectangle"),
+        "maternity": ("prominent", "soft"),
+    },
+    "mimic": {
+        "womens": ("hourglass", "pear", "apple", "inverted_triangle", "spoon", "rectangle"),
+        "mens": ("triangle", "oval", "rectangle"),
+        "maternity": ("prominent", "soft"),
+    },
+}
+
+# Fields SizeCharterMimic requires to match
+MIMIC_MATCH_FIELDS = ("chest", "waist", "hips", "shoulders", "neck", "thigh", "calf")
+
+INVALID_GENDER = "Invalid gender/department. Choose from 'womens', 'mens', or 'maternity'."
+
+
+def batch_tables(charter, chart=None):
+    """
+    Compile a charter's chart (or the given chart, for the charter's engine)
+    into the NumPy tables the batch functions run on.
+
+    The result is a nested dict of plain values and arrays:
+
+        engine            the charter's BATCH_ENGINE, "tuned" or "mimic"
+        warning_messages  the engine's WARNING_MESSAGES
+        fallback_weights  (8,) closest-size fallback weights, or None when the
+                          charter has no fallback
+        health            (8, 2) typical (low, high) range per measurement field
+        departments       {department: {
+            sizes         size names in chart order
+            shape_names   every morphology shape of the department, plus any
+                          shape the engine can infer that the table lacks
+            morphology_shapes  the shapes of the chart's own morphology table
+            adjustments   (len(shape_names) + 1, 3) chest/waist/hips deltas per
+                          shape code; the last row is zeros for code -1
+            bounds/slots  {field: array} form of each IntervalIndex
+            lows/highs    (sizes, 8) range ends per size and field, NaN where a
+                          size has no range for the field
+        }}
+
+    The tables of the charter's own chart are cached on it until the chart or
+    its fallback weights change.
+    """
+    own = chart is None
+    if own:
+        chart = charter.chart
+    cached = getattr(charter, "_batch_tables", None)
+    if cached is not None and cached[0] is chart and cached[1] == charter.fallback_weights:
+        return cached[2]
+
+    engine = charter.BATCH_ENGINE
+    if engine == "tuned":
+        health = [charter.HEALTH_RANGE] * len(MEASUREMENT_FIELDS)
+    else:
+        health = [charter.SANE_RANGES[name] for name in MEASUREMENT_FIELDS]
+
+    departments = {}
+    for gender, rules in chart.sizing_rules.items():
+        morphology = chart.morphology_adjustments.get(gender, {})
+        names = list(morphology)
+        names.extend(name for name in BODY_SHAPES[engine].get(gender, ()) if name not in names)
+        names = tuple(names)
+
+        adjustments = np.zeros((len(names) + 1, len(ADJUSTED_FIELDS)))
+        for code, name in enumerate(names):
+            for key, val in morphology.get(name, {}).items():
+                if key in ADJUSTED_FIELDS:
+                    adjustments[code, ADJUSTED_FIELDS.index(key)] = val
+
+        lows = np.full((len(rules), len(MEASUREMENT_FIELDS)), np.nan)
+        highs = np.full((len(rules), len(MEASUREMENT_FIELDS)), np.nan)
+        for ordinal, limits in enumerate(rules.values()):
+            for name, (low, high) in limits.items():
+                if name in FIELD_POSITIONS:
+                    lows[ordinal, FIELD_POSITIONS[name]] = low
+                    highs[ordinal, FIELD_POSITIONS[name]] = high
+
+        compiled = chart.compiled[gender]
+        departments[gender] = {
+            "sizes": compiled.sizes,
+            "shape_names": names,
+            "morphology_shapes": tuple(morphology),
+            "adjustments": adjustments,
+            "bounds": {name: np.asarray(index.bounds, dtype=np.float64)
+                       for name, index in compiled.fields.items() if name in FIELD_POSITIONS},
+            "slots": {name: np.array([-1 if ordinal is None else ordinal for ordinal in index.slots], dtype=np.int16)
+                      for name, index in compiled.fields.items() if name in FIELD_POSITIONS},
+            "lows": lows,
+            "highs": highs,
+        }
+
+    weights = charter.fallback_weights
+    tables = {
+        "engine": engine,
+        "warning_messages": tuple(charter.WARNING_MESSAGES),
+        "fallback_weights": None if weights is None else np.array(weights, dtype=np.float64),
+        "health": np.array(health, dtype=np.float64),
+        "departments": departments,
+    }
+    if own:
+        charter._batch_tables = (chart, weights, tables)
+    return tables
+
+
+def as_columns(measurements):
+    """
+    Normalize a measurement block to a float64 array of shape (8, N).
+
+    Accepts either a mapping of field name to a 1-D array (absent fields are
+    treated as all-missing) or a 2-D array of shape (N, 8) with columns in
+    MEASUREMENT_FIELDS order.
+    """
+    if hasattr(measurements, "keys"):
+        unknown = set(measurements) - set(MEASUREMENT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown measurement fields: {', '.join(sorted(unknown))}")
+        lengths = {len(measurements[name]) for name in measurements}
+        if len(lengths) > 1:
+            raise ValueError("All measurement columns must have the same length.")
+        n = lengths.pop() if lengths else 0
+        columns = np.full((len(MEASUREMENT_FIELDS), n), np.nan)
+        for name, values in measurements.items():
+            columns[FIELD_POSITIONS[name]] = values
+        return columns
+
+    block = np.asarray(measurements, dtype=np.float64)
+    if block.ndim != 2 or block.shape[1] != len(MEASUREMENT_FIELDS):
+        raise ValueError(f"Expected an (N, {len(MEASUREMENT_FIELDS)}) measurement array, got shape {block.shape}.")
+    return np.ascontiguousarray(block.T)
+
+
+def shape_codes(names, shapes, n):
+    """
+    Encode a shape argument (None, one name, or one name per row) as codes into names.
+    Unknown or missing shapes get -1. An integer array is taken as codes already.
+    """
+    if shapes is None or isinstance(shapes, str):
+        code = names.index(shapes) if shapes in names else -1
+        return np.full(n, code, dtype=np.int8)
+    if isinstance(shapes, np.ndarray) and shapes.dtype.kind in "iu":
+        if len(shapes) != n:
+            raise ValueError("Shape arrays must have one entry per shopper.")
+        return shapes.astype(np.int8, copy=False)
+    lookup = {name: i for i, name in enumerate(names)}
+    codes = np.fromiter((lookup.get(shape, -1) if isinstance(shape, str) else -1 for shape in shapes),
+                        dtype=np.int8, count=len(shapes))
+    if len(codes) != n:
+        raise ValueError("Shape arrays must have one entry per shopper.")
+    return codes
+
+
+def interval_lookup(bounds, slots, values):
+    """
+    Vectorized IntervalIndex.lookup: size ordinals for values, -1 where nothing matches.
+    """
+    if not len(bounds):
+        return np.full(values.shape, -1, dtype=np.int16)
+    j = np.searchsorted(bounds, values, side="left")
+    on_point = bounds[np.minimum(j, len(bounds) - 1)] == values
+    return slots[2 * j + on_point]
+
+
+def _truthy(values):
+    # Mirrors `if value:` on an optional float; NaN stands in for None
+    return ~np.isnan(values) & (values != 0)
+
+
+def _adjust(columns, body_shape, department, abdomen_shape, hip_shape):
+    n = columns.shape[1]
+    names, table = department["shape_names"], department["adjustments"]
+    deltas = (table[body_shape]
+              + table[shape_codes(names, abdomen_shape, n)]
+              + table[shape_codes(names, hip_shape, n)])
+    adjusted = columns.copy()
+    adjusted[CHEST] += deltas[:, 0]
+    adjusted[WAIST] += deltas[:, 1]
+    adjusted[HIPS] += deltas[:, 2]
+    return adjusted
+
+
+def _health_bits(columns, ranges):
+    # ranges: one (low, high) row per MEASUREMENT_FIELDS entry
+    bits = np.zeros(columns.shape[1], dtype=np.uint8)
+    for i, (low, high) in enumerate(ranges):
+        outside = (columns[i] < low) | (columns[i] > high)
+        bits |= outside.astype(np.uint8) << i
+    return bits
+
+
+def _infer_tuned(gender, columns, names):
+    """
+    Vectorized SizeCharterTuned._infer_body_shape, as codes into names.
+    """
+    chest, waist, hips = columns[CHEST], columns[WAIST], columns[HIPS]
+    code = {name: names.index(name) for name in names}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if gender == "womens":
+            valid = _truthy(chest) & _truthy(waist) & _truthy(hips)
+            waist_hip_ratio = waist / hips
+            shapes = np.select(
+                [(np.abs(chest - hips) <= 3) & (waist_hip_ratio < 0.75),
+                 (hips > chest) & (waist_hip_ratio < 0.75),
+                 waist > hips,
+                 (chest > hips) & (waist_hip_ratio > 0.85)],
+                [code["hourglass"], code["pear"], code["apple"], code["inverted_triangle"]],
+                default=code["rectangle"])
+        elif gender == "mens":
+            valid = _truthy(chest) & _truthy(waist)
+            ratio = chest / waist
+            shapes = np.select([ratio > 1.25, ratio < 1.05],
+                               [code["triangle"], code["oval"]], default=code["rectangle"])
+        elif gender == "maternity":
+            valid = np.ones(columns.shape[1], dtype=bool)
+            prominent = _truthy(waist) & _truthy(hips) & (waist > 80)
+            shapes = np.where(prominent, code["prominent"], code["soft"])
+        else:
+            return np.full(columns.shape[1], -1, dtype=np.int8)
+    return np.where(valid, shapes, -1).astype(np.int8)
+
+
+def _infer_mimic(gender, columns, names):
+    """
+    Vectorized SizeCharterMimic._infer_body_shape, as codes into names.
+    """
+    chest, waist, hips, shoulders = columns[CHEST], columns[WAIST], columns[HIPS], columns[SHOULDERS]
+    code = {name: names.index(name) for name in names}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shoulder_waist_ratio = np.where(_truthy(shoulders) & _truthy(waist), shoulders / waist, 0)
+        if gender == "womens":
+            valid = _truthy(chest) & _truthy(waist) & _truthy(hips)
+            waist_hip_ratio = waist / hips
+            shapes = np.select(
+                [(np.abs(chest - hips) <= 3) & (waist_hip_ratio < 0.75),
+                 (hips > chest) & (waist_hip_ratio < 0.75),
+                 waist > hips,
+                 (chest > hips) & (waist_hip_ratio > 0.85),
+                 (shoulder_waist_ratio > 1.1) & (chest > hips)],
+                [code["hourglass"], code["pear"], code["apple"], code["inverted_triangle"], code["spoon"]],
+                default=code["rectangle"])
+        elif gender == "mens":
+            valid = _truthy(chest) & _truthy(waist)
+            ratio = chest / waist
+            shapes = np.select([(ratio > 1.25) & (shoulder_waist_ratio > 1.1), ratio < 1.05],
+                               [code["triangle"], code["oval"]], default=code["rectangle"])
+        elif gender == "maternity":
+            valid = np.ones(columns.shape[1], dtype=bool)
+            prominent = _truthy(waist) & _truthy(hips) & (waist > 80)
+            shapes = np.where(prominent, code["prominent"], code["soft"])
+        else:
+            return np.full(columns.shape[1], -1, dtype=np.int8)
+    return np.where(valid, shapes, -1).astype(np.int8)
+
+
+def _size_tuned(gender, department, adjusted):
+    # Max ordinal over every field that lands in a range (mens are sized on inseam, not hips)
+    size = np.full(adjusted.shape[1], -1, dtype=np.int16)
+    for name, bounds in department["bounds"].items():
+        if name == "hips" and gender == "mens":
+            continue
+        np.maximum(size, interval_lookup(bounds, department["slots"][name], adjusted[FIELD_POSITIONS[name]]), out=size)
+    return size
+
+
+def _tuned_warnings(adjusted):
+    # Fit warnings on adjusted chest/waist/hips; NaN compares False, like the None checks
+    a_chest, a_waist, a_hips = adjusted[CHEST], adjusted[WAIST], adjusted[HIPS]
+    chest_small = a_chest < 0.7 * a_waist
+    chest_large = ~chest_small & (a_chest > 1.3 * a_waist)
+    waist_large = a_waist > 1.3 * a_hips
+    waist_small = ~waist_large & (a_waist < 0.7 * a_hips)
+    return (chest_small.astype(np.uint8)
+            | chest_large.astype(np.uint8) << 1
+            | waist_large.astype(np.uint8) << 2
+            | waist_small.astype(np.uint8) << 3)
+
+
+def _nearest(department, adjusted, weights, with_distances=False):
+    """
+    Vectorized NearestSizeIndex.nearest: the closest size ordinal per shopper by
+    weighted squared distance (first size on ties), and whether any weighted
+    field with ranges was present; with_distances, also the (sizes, N) distances.
+    """
+    lows, highs = department["lows"], department["highs"]
+    n = adjusted.shape[1]
+    distances = np.zeros((len(lows), n))
+    informative = np.zeros(n, dtype=bool)
+    gap, term = np.empty(n), np.empty(n)
+    for position, weight in enumerate(weights):
+        if not weight or np.isnan(lows[:, position]).all():
+            continue
+        values = adjusted[position]
+        informative |= ~np.isnan(values)
+        for ordinal in range(len(lows)):
+            low, high = lows[ordinal, position], highs[ordinal, position]
+            if np.isnan(low):
+                continue
+            # At most one of low - value and value - high is positive; fmax turns a
+            # missing (NaN) value into no gap. weight * gap * gap keeps the scalar
+            # search's operation order, so both agree to the bit.
+            np.subtract(low, values, out=gap)
+            np.fmax(gap, np.subtract(values, high, out=term), out=gap)
+            np.fmax(gap, 0, out=gap)
+            if weight == 1:
+                np.square(gap, out=term)
+            else:
+                np.multiply(gap, weight, out=term)
+                term *= gap
+            distances[ordinal] += term
+    if with_distances:
+        return distances.argmin(axis=0).astype(np.int16), informative, distances
+    return distances.argmin(axis=0).astype(np.int16), informative
+
+
+def _closest_matches(department, adjusted, weights):
+    # The NearestSizeIndex.nearest result per shopper (None where no weighted field
+    # is present); the runner-up is the closest other size, first on ties
+    best, informative, distances = _nearest(department, adjusted, weights, with_distances=True)
+    sizes = department["sizes"]
+    columns = np.arange(adjusted.shape[1])
+    distance = distances[best, columns].tolist()
+    if len(sizes) > 1:
+        distances[best, columns] = np.inf
+        runner_up = distances.argmin(axis=0)
+        runner_up_distance = distances[runner_up, columns].tolist()
+        runner_up = [sizes[ordinal] for ordinal in runner_up.tolist()]
+    else:
+        runner_up = runner_up_distance = [None] * len(columns)
+    return [NearestMatch(sizes[ordinal], distance[k], runner_up[k], runner_up_distance[k]) if present else None
+            for k, (ordinal, present) in enumerate(zip(best.tolist(), informative.tolist()))]
+
+
+def _size_tuned_fallback(department, adjusted, size, weights):
+    # Closest size for the shoppers no range matched; returns (size, fallback)
+    missed = np.flatnonzero(size < 0)
+    fallback = np.zeros(len(size), dtype=bool)
+    if len(missed):
+        nearest, informative = _nearest(department, adjusted[:, missed], weights)
+        size[missed[informative]] = nearest[informative]
+        fallback[missed[informative]] = True
+    return size, fallback
+
+
+def _size_mimic(department, adjusted, weights):
+    """
+    First size (in chart order) whose every present field is in range, else the
+    closest size by weighted squared distance. Returns (size, fallback).
+    """
+    lows, highs = department["lows"], department["highs"]
+    n = adjusted.shape[1]
+    matches = np.ones((len(lows), n), dtype=bool)
+    for ordinal in range(len(lows)):
+        for name in MIMIC_MATCH_FIELDS:
+            position = FIELD_POSITIONS[name]
+            low, high = lows[ordinal, position], highs[ordinal, position]
+            if np.isnan(low):
+                continue
+            values = adjusted[position]
+            matches[ordinal] &= np.isnan(values) | ((low <= values) & (values <= high))
+
+    matched = matches.any(axis=0)
+    size = matches.argmax(axis=0).astype(np.int16)
+    missed = np.flatnonzero(~matched)
+    if len(missed) == n:
+        size = _nearest(department, adjusted, weights)[0]
+    elif len(missed):
+        # With no weighted field present every distance is 0 and the first size wins
+        size[missed] = _nearest(department, adjusted[:, missed], weights)[0]
+    return size, ~matched
+
+
+def _mimic_warnings(columns):
+    # Consistency warnings on the original measurements
+    chest, waist, hips = columns[CHEST], columns[WAIST], columns[HIPS]
+    return ((_truthy(chest) & _truthy(waist) & (chest < waist * 0.85)).astype(np.uint8)
+            | (_truthy(waist) & _truthy(hips) & (waist > hips * 1.1)).astype(np.uint8) << 1
+            | (_truthy(chest) & _truthy(hips) & (np.abs(chest - hips) > 20)).astype(np.uint8) << 2)
+
+
+def adjust_block(tables, gender, columns, abdomen_shape=None, hip_shape=None):
+    """
+    Infer body shapes for an (8, N) block of one department and apply the
+    morphology adjustments. Returns (body_shape codes, adjusted (8, N) block).
+    """
+    department = tables["departments"][gender]
+    names = department["shape_names"]
+    infer = _infer_tuned if tables["engine"] == "tuned" else _infer_mimic
+    body_shape = infer(gender, columns, names)
+    return body_shape, _adjust(columns, body_shape, department, abdomen_shape, hip_shape)
+
+
+def run_batch(tables, gender, measurements, abdomen_shape=None, hip_shape=None):
+    """
+    Size a block of shoppers of one department against compiled batch tables.
+
+    Mimic tables, and Tuned tables with fallback weights, also produce a
+    boolean "fallback" array, set where no size matched and the closest size
+    by weighted squared distance was used. "adjusted" is the (8, N) block of
+    morphology-adjusted measurements that was sized.
+    """
+    gender = gender.lower()
+    department = tables["departments"].get(gender)
+    if department is None:
+        raise ValueError(INVALID_GENDER)
+
+    columns = as_columns(measurements)
+    result = {"sizes": department["sizes"], "body_shapes": department["shape_names"]}
+    body_shape, adjusted = adjust_block(tables, gender, columns, abdomen_shape, hip_shape)
+
+    if tables["engine"] == "tuned":
+        result["size"] = _size_tuned(gender, department, adjusted)
+        if tables["fallback_weights"] is not None:
+            result["size"], result["fallback"] = _size_tuned_fallback(
+                department, adjusted, result["size"], tables["fallback_weights"])
+        result["warnings"] = _tuned_warnings(adjusted)
+    else:
+        result["size"], result["fallback"] = _size_mimic(department, adjusted, tables["fallback_weights"])
+        result["warnings"] = _mimic_warnings(columns)
+
+    result["body_shape"] = body_shape
+    result["health"] = _health_bits(columns, tables["health"])
+    result["adjusted"] = adjusted
+    return result
+
+
+def charter_batch(charter, gender, measurements, abdomen_shape=None, hip_shape=None):
+    """
+    Batch counterpart of charter.get_size_recommendation.
+    """
+    return run_batch(batch_tables(charter), gender, measurements, abdomen_shape, hip_shape)
+
+
+def batch_recommendations(charter, requests):
+    """
+    get_size_recommendation for many requests, sized in one vectorized pass per department.
+
+    requests is a sequence of (gender, measurements, abdomen_shape, hip_shape)
+    tuples, measurements being the eight optional values in MEASUREMENT_FIELDS
+    order. Returns, in order, the results get_size_recommendation would return
+    on the charter's current chart: the same result objects, or error dicts.
+    The charter's cache is consulted and filled as get_size_recommendation
+    does. Its metrics record each result with an equal share of the batch's
+    time, and no stage timings.
+    """
+    start = time.perf_counter()
+    chart = charter.chart
+    tables = batch_tables(charter)
+    if charter._batch_tables[0] is not chart:
+        # The chart was reloaded between the two reads
+        tables = batch_tables(charter, chart)
+    cache = charter.cache
+    results = [None] * len(requests)
+    keys = [None] * len(requests)
+    groups = {}
+    for i, (gender, measurements, abdomen_shape, hip_shape) in enumerate(requests):
+        if cache is not None:
+            measurements = cache.quantize(measurements)
+            key = (chart, gender, measurements, abdomen_shape, hip_shape)
+            results[i] = cache.get(key)
+            if results[i] is not None:
+                continue
+            keys[i] = key
+        department = gender.lower()
+        if department not in tables["departments"]:
+            results[i] = {"error": INVALID_GENDER}
+        else:
+            groups.setdefault(department, []).append((i, measurements, abdomen_shape, hip_shape))
+
+    for department, rows in groups.items():
+        # None becomes NaN in a float64 array
+        measurements = np.array([row[1] for row in rows], dtype=np.float64)
+        batch = run_batch(tables, department, measurements, [row[2] for row in rows], [row[3] for row in rows])
+        sizes, names = batch["sizes"], batch["body_shapes"]
+        size, body_shape = batch["size"].tolist(), batch["body_shape"].tolist()
+        warnings, health = batch["warnings"].tolist(), batch["health"].tolist()
+        # Closest-size details of the rows the fallback sized, from the same distances
+        nearest = {}
+        if "fallback" in batch:
+            missed = np.flatnonzero(batch["fallback"])
+            if len(missed):
+                nearest = dict(zip(missed.tolist(), _closest_matches(
+                    tables["departments"][department], batch["adjusted"][:, missed], tables["fallback_weights"])))
+        # Each row's original then adjusted values, laid out as pack_measurements packs them
+        packed = np.hstack([measurements, batch["adjusted"].T]).tobytes()
+        width = 2 * len(MEASUREMENT_FIELDS) * 8
+        for k, (i, _, abdomen_shape, hip_shape) in enumerate(rows):
+            results[i] = charter._result_from_batch(
+                chart, department, None if size[k] < 0 or k in nearest else sizes[size[k]],
+                nearest.get(k), names[body_shape[k]] if body_shape[k] >= 0 else None, abdomen_shape, hip_shape,
+                array("d", packed[k * width:(k + 1) * width]), warnings[k], health[k])
+
+    if cache is not None:
+        for key, result in zip(keys, results):
+            if key is not None:
+                cache.put(key, result)
+    if charter.metrics is not None and results:
+        share = (time.perf_counter() - start) / len(results)
+        for result in results:
+            charter.metrics.record(charter.BATCH_ENGINE, result, share)
+    return results
@@ -0,0 +1,391 @@
+"""
+Reproducible benchmarks for both charter engines and the HTTP path.
+
+Every run sizes the same seeded synthetic shopper population: per-department
+measurement distributions, realistic rates of missing fields, a small share
+of out-of-range values and occasional abdomen/hip shapes. Measured:
+
+    tuned, mimic   per-call latency of get_size_recommendation (uncached)
+    tuned_batch,   rows per second of get_size_recommendations_batch
+    mimic_batch
+    http           per-request latency of POST /api/size via Flask's test client
+    startup        cold-start cost in fresh interpreters: importing
+                   sizecharter_core (and, for comparison, sizecharter_api),
+                   constructing a charter and its first and second calls
+
+Latency benchmarks run several rounds and report the fastest one, as timeit
+does, to damp scheduler noise. Each benchmark also reports peak traced memory
+from a separate tracemalloc pass, so tracing does not distort the timings. Results are written as JSON;
+given a baseline file from an earlier run, regressions beyond the tolerance
+are listed and the exit status is 1:
+
+    python sizecharter_bench.py --output bench.json
+    python sizecharter_bench.py --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from sizecharter_index import MEASUREMENT_FIELDS
+
+# (mean, standard deviation) in cm per department and field
+POPULATIONS = {
+    "womens": {
+        "chest": (95, 10), "waist": (78, 11), "hips": (102, 10), "inseam": (77, 4),
+        "shoulders": (39, 2.5), "neck": (33, 2), "thigh": (57, 5), "calf": (36, 2.5),
+    },
+    "mens": {
+        "chest": (104, 10), "waist": (92, 12), "hips": (102, 8), "inseam": (82, 4),
+        "shoulders": (46, 3), "neck": (40, 2.5), "thigh": (58, 5), "calf": (38, 2.5),
+    },
+    "maternity": {
+        "chest": (100, 9), "waist": (95, 12), "hips": (108, 9), "inseam": (77, 4),
+        "shoulders": (39, 2.5), "neck": (34, 2), "thigh": (60, 5), "calf": (37, 2.5),
+    },
+}
+
+# Share of shoppers per department, and of each field left blank
+DEPARTMENT_MIX = {"womens": 0.5, "mens": 0.4, "maternity": 0.1}
+MISSING_RATES = {
+    "chest": 0.03, "waist": 0.03, "hips": 0.08, "inseam": 0.35,
+    "shoulders": 0.55, "neck": 0.6, "thigh": 0.7, "calf": 0.7,
+}
+OUT_OF_RANGE_RATE = 0.01
+SHAPE_RATE = 0.2
+ABDOMEN_SHAPES = ("flat", "soft", "prominent")
+HIP_SHAPES = ("straight", "curvy", "pear")
+
+# Metrics compared against a baseline: name -> True if higher is better
+COMPARED_METRICS = {"p50_us": False, "p99_us": False, "rows_per_s": True, "peak_kib": False,
+                    "import_ms": False, "first_call_ms": False}
+
+BENCHMARKS = ("tuned", "mimic", "tuned_batch", "mimic_batch", "http", "asgi", "asgi_batched", "startup")
+
+# Concurrent requests per burst in the ASGI benchmarks
+BURST = 64
+
+# Run in a fresh interpreter per startup round; prints the stage timings in ms as JSON
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from {module} import SizeCharterTuned
+imported = time.perf_counter()
+charter = SizeCharterTuned()
+constructed = time.perf_counter()
+charter.get_size_recommendation("womens", chest=88, waist=70, hips=95)
+first = time.perf_counter()
+charter.get_size_recommendation("womens", chest=90, waist=72, hips=97)
+second = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "construct_ms": (constructed - imported) * 1000,
+                  "first_call_ms": (first - constructed) * 1000, "second_call_ms": (second - first) * 1000}}))
+"""
+
+
+def make_population(rows, seed=0, department=None):
+    """
+    Build rows synthetic /api/size records, identical for identical arguments.
+
+    department pins every record to one department; by default they follow DEPARTMENT_MIX.
+    """
+    rng = random.Random(seed)
+    names, weights = zip(*DEPARTMENT_MIX.items())
+    records = []
+    for _ in range(rows):
+        gender = department or rng.choices(names, weights)[0]
+        record = {"gender": gender}
+        for name, (mean, sd) in POPULATIONS[gender].items():
+            if rng.random() < MISSING_RATES[name]:
+                continue
+            value = rng.gauss(mean, sd)
+            if rng.random() < OUT_OF_RANGE_RATE:
+                value *= rng.choice((0.3, 2.5))
+            record[name] = round(value, 1)
+        if rng.random() < SHAPE_RATE:
+            record["abdomen_shape"] = rng.choice(ABDOMEN_SHAPES)
+        if rng.random() < SHAPE_RATE:
+            record["hip_shape"] = rng.choice(HIP_SHAPES)
+        records.append(record)
+    return records
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _latency_summary(samples_ns):
+    samples = sorted(samples_ns)
+    total = sum(samples)
+    return {
+        "calls": len(samples),
+        "p50_us": _percentile(samples, 0.50) / 1000,
+        "p90_us": _percentile(samples, 0.90) / 1000,
+        "p99_us": _percentile(samples, 0.99) / 1000,
+        "max_us": samples[-1] / 1000,
+        "rows_per_s": len(samples) / (total / 1e9) if total else None,
+    }
+
+
+def _peak_kib(run):
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def _call_args(record):
+    kwargs = {name: record.get(name) for name in MEASUREMENT_FIELDS}
+    kwargs["abdomen_shape"] = record.get("abdomen_shape")
+    kwargs["hip_shape"] = record.get("hip_shape")
+    return record["gender"], kwargs
+
+
+def _fastest_round(call, items, rounds):
+    clock = time.perf_counter_ns
+    best = None
+    for _ in range(rounds):
+        samples = []
+        for item in items:
+            start = clock()
+            call(item)
+            samples.append(clock() - start)
+        summary = _latency_summary(samples)
+        if best is None or summary["p50_us"] < best["p50_us"]:
+            best = summary
+    return best
+
+
+def bench_calls(charter, records, rounds=3, memory_rows=2000):
+    """
+    Per-call latency of charter.get_size_recommendation over records.
+    """
+    calls = [_call_args(record) for record in records]
+    recommend = charter.get_size_recommendation
+    for gender, kwargs in calls[:200]:
+        recommend(gender, **kwargs)
+    result = _fastest_round(lambda call: recommend(call[0], **call[1]), calls, rounds)
+    result["peak_kib"] = _peak_kib(lambda: [recommend(gender, **kwargs) for gender, kwargs in calls[:memory_rows]])
+    return result
+
+
+def bench_batch(charter, records, rounds=3):
+    """
+    Rows per second of charter.get_size_recommendations_batch, one call per department.
+    """
+    import numpy as np
+
+    blocks = {}
+    for record in records:
+        gender, kwargs = _call_args(record)
+        rows, abdomen, hips = blocks.setdefault(gender, ([], [], []))
+        rows.append([np.nan if kwargs[name] is None else kwargs[name] for name in MEASUREMENT_FIELDS])
+        abdomen.append(kwargs["abdomen_shape"])
+        hips.append(kwargs["hip_shape"])
+    blocks = {gender: (np.array(rows), abdomen, hips) for gender, (rows, abdomen, hips) in blocks.items()}
+
+    def run():
+        for gender, (rows, abdomen, hips) in blocks.items():
+            charter.get_size_recommendations_batch(gender, rows, abdomen, hips)
+
+    run()
+    best = min(_timed(run) for _ in range(rounds))
+    return {"rows": len(records), "seconds": best, "rows_per_s": len(records) / best, "peak_kib": _peak_kib(run)}
+
+
+def _timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def bench_http(records, rounds=3, memory_rows=500):
+    """
+    Per-request latency of POST /api/size through Flask's test client.
+
+    The app's charter has no recommendation cache, so every round does the full work.
+    """
+    from sizecharter_api import create_app
+    from sizecharter_core import SizeCharterTuned
+
+    app = create_app(sizer=SizeCharterTuned())
+    return _bench_client(app.test_client(), records, rounds, memory_rows)
+
+
+def _bench_client(client, records, rounds, memory_rows):
+    bodies = [json.dumps(record) for record in records]
+
+    def post(body):
+        response = client.post("/api/size", data=body, content_type="application/json")
+        response.get_data()
+        return response
+
+    for body in bodies[:100]:
+        post(body)
+    result = _fastest_round(post, bodies, rounds)
+    result["peak_kib"] = _peak_kib(lambda: [post(body) for body in bodies[:memory_rows]])
+    return result
+
+
+def bench_asgi(records, rounds=3, batch_size=None, burst=BURST):
+    """
+    Throughput and latency of POST /api/size on the ASGI app under bursts of
+    burst concurrent requests, driven in-process without a socket.
+
+    batch_size enables micro-batching. Latencies are per request, from its
+    burst being sent to its response.
+    """
+    import asyncio
+    from sizecharter_asgi import SizingApp
+    from sizecharter_core import SizeCharterTuned
+
+    bodies = [json.dumps(record).encode() for record in records]
+
+    async def post(app, body):
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop()
+
+        async def send(message):
+            sent.append(message)
+
+        await app({"type": "http", "method": "POST", "path": "/api/size"}, receive, send)
+        return time.perf_counter_ns()
+
+    async def run():
+        app = SizingApp(sizer=SizeCharterTuned(), max_pending=burst, batch_size=batch_size)
+        app.startup()
+        best = None
+        for _ in range(rounds):
+            samples = []
+            for i in range(0, len(bodies), burst):
+                start = time.perf_counter_ns()
+                done = await asyncio.gather(*(post(app, body) for body in bodies[i:i + burst]))
+                samples.extend(end - start for end in done)
+            summary = _latency_summary(samples)
+            # Requests overlap, so throughput is rows over wall time, not over summed latencies
+            wall = sum(max(samples[i:i + burst]) for i in range(0, len(samples), burst))
+            summary["rows_per_s"] = len(samples) / (wall / 1e9)
+            if best is None or summary["rows_per_s"] > best["rows_per_s"]:
+                best = summary
+        if app.batcher is not None:
+            best["mean_batch"] = app.batcher.stats()["mean_batch"]
+        await app.shutdown()
+        return best
+
+    return asyncio.run(run())
+
+
+def bench_startup(rounds=5, module="sizecharter_core"):
+    """
+    Cold-start cost of importing module and sizing the first shoppers, in fresh interpreters.
+
+    Each stage reports its fastest round; interpreter startup itself is excluded.
+    """
+    import os
+    import subprocess
+
+    script = STARTUP_SCRIPT.format(module=module)
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = [json.loads(subprocess.run([sys.executable, "-c", script], cwd=here, check=True,
+                                      capture_output=True, text=True).stdout)
+            for _ in range(rounds)]
+    return {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+
+def run_benchmarks(rows=20000, seed=0, only=BENCHMARKS):
+    """
+    Run the selected benchmarks on one seeded population; returns the JSON report.
+    """
+    from sizecharter_core import SizeCharterTuned
+    from sizecharter_mimic import SizeCharterMimic
+
+    records = make_population(rows, seed)
+    results = {}
+    for name in only:
+        if name == "tuned":
+            results[name] = bench_calls(SizeCharterTuned(), records)
+        elif name == "mimic":
+            results[name] = bench_calls(SizeCharterMimic(), records)
+        elif name == "tuned_batch":
+            results[name] = bench_batch(SizeCharterTuned(), records)
+        elif name == "mimic_batch":
+            results[name] = bench_batch(SizeCharterMimic(), records)
+        elif name == "http":
+            # The HTTP path carries per-request framework overhead; a tenth of the rows is plenty
+            results[name] = bench_http(records[:max(1, rows // 10)])
+        elif name == "asgi":
+            results[name] = bench_asgi(records[:max(1, rows // 4)])
+        elif name == "asgi_batched":
+            results[name] = bench_asgi(records[:max(1, rows // 4)], batch_size=BURST)
+        elif name == "startup":
+            results[name] = bench_startup()
+            results["startup_flask"] = bench_startup(module="sizecharter_api")
+        else:
+            raise ValueError(f"Unknown benchmark: {name}")
+    return {
+        "meta": {
+            "rows": rows,
+            "seed": seed,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance=0.10):
+    """
+    List the metrics in report that are worse than baseline by more than tolerance.
+
+    Each regression is a dict with the benchmark, metric, both values and the
+    relative change (positive = worse).
+    """
+    regressions = []
+    for name, current in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            new, old = current.get(metric), previous.get(metric)
+            if not new or not old:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append({"benchmark": name, "metric": metric,
+                                    "baseline": old, "current": new, "change": round(change, 4)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sizing engines and HTTP path.")
+    parser.add_argument("--rows", type=int, default=20000, help="shoppers in the synthetic population")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma-separated benchmarks to run")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative slowdown")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.rows, args.seed, [name for name in args.only.split(",") if name])
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
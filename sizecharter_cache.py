@@ -0,0 +1,102 @@
+"""
+Memoization of size recommendations.
+
+A recommendation is a pure function of the department, the eight measurements
+and the two optional shapes, so repeat inputs (saved profiles, re-renders) can
+skip the computation entirely. Pass a RecommendationCache to a charter's
+constructor to put it in front of get_size_recommendation.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    """
+    Bounded, thread-safe LRU cache of recommendation results with an optional TTL.
+
+    maxsize  most entries kept before the least recently used is evicted
+    ttl      seconds an entry stays valid, or None to keep it until evicted
+    quantum  if set, measurements are snapped to this step (e.g. 0.5 cm) before
+             both keying and computing, so nearby inputs share one entry and the
+             cached result is exactly what the snapped input produces
+
+    Cached results are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, quantum=None, clock=time.monotonic):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if quantum is not None and quantum <= 0:
+            raise ValueError("quantum must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.quantum = quantum
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def quantize(self, measurements):
+        """
+        Snap a tuple of optional measurements to the configured quantum.
+        """
+        quantum = self.quantum
+        if quantum is None:
+            return tuple(measurements)
+        # The outer round() keeps e.g. 851 * 0.1 from becoming 85.10000000000001
+        return tuple(None if value is None else round(round(value / quantum) * quantum, 6)
+                     for value in measurements)
+
+    def get(self, key):
+        """
+        Return the cached result for key, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, expires = entry
+            if expires is not None and self._clock() >= expires:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        expires = self._clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (result, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every entry, e.g. because the charter's tables changed.
+        """
+        with self._lock:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
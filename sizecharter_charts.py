@@ -0,0 +1,174 @@
+"""
+Size charts loaded from versioned JSON files, with hot reload.
+
+A chart file holds one charter's tables:
+
+    {
+      "name": "tuned",
+      "version": "2",
+      "sizing_rules": {"womens": {"XS": {"chest": [78, 83], ...}, ...}, ...},
+      "morphology_adjustments": {"womens": {"pear": {"hips": 3}, ...}, ...}
+    }
+
+Sizes are listed smallest first, ranges are closed [low, high] pairs in cm.
+The default charts of SizeCharterTuned and SizeCharterMimic live in charts/.
+
+A ChartFile hands out the compiled Chart of its file and, at most every
+poll_interval seconds, checks whether the file changed. A changed file is
+parsed, validated and compiled off to the side and then swapped in with a
+single reference assignment, so in-flight requests finish on the chart they
+started with. A file that fails to load leaves the previous chart in service.
+Replace chart files atomically (write a temporary file, then rename it).
+"""
+import json
+import os
+import threading
+import time
+from numbers import Real
+
+from sizecharter_index import MEASUREMENT_FIELDS, Chart
+
+CHART_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "charts")
+
+
+def default_chart_path(name):
+    """
+    Path of a chart shipped in charts/, e.g. default_chart_path("tuned").
+    """
+    return os.path.join(CHART_DIR, f"{name}.json")
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+
+def validate_chart(doc):
+    """
+    Raise ValueError describing the first problem in a decoded chart document.
+    """
+    if not isinstance(doc, dict):
+        raise ValueError("Chart must be a JSON object")
+    rules = doc.get("sizing_rules")
+    if not isinstance(rules, dict) or not rules:
+        raise ValueError("Chart needs a non-empty 'sizing_rules' object")
+    for department, sizes in rules.items():
+        if not isinstance(sizes, dict) or not sizes:
+            raise ValueError(f"sizing_rules.{department} must be a non-empty object of sizes")
+        for size, limits in sizes.items():
+            if not isinstance(limits, dict):
+                raise ValueError(f"sizing_rules.{department}.{size} must be an object of ranges")
+            for field, bounds in limits.items():
+                where = f"sizing_rules.{department}.{size}.{field}"
+                if field not in MEASUREMENT_FIELDS:
+                    raise ValueError(f"{where}: unknown measurement field")
+                if (not isinstance(bounds, (list, tuple)) or len(bounds) != 2
+                        or not all(_is_number(bound) for bound in bounds)):
+                    raise ValueError(f"{where} must be a [low, high] pair of numbers")
+                if bounds[0] > bounds[1]:
+                    raise ValueError(f"{where}: low is above high")
+
+    adjustments = doc.get("morphology_adjustments", {})
+    if not isinstance(adjustments, dict):
+        raise ValueError("'morphology_adjustments' must be an object")
+    for department, shapes in adjustments.items():
+        if not isinstance(shapes, dict):
+            raise ValueError(f"morphology_adjustments.{department} must be an object of shapes")
+        for shape, deltas in shapes.items():
+            if not isinstance(deltas, dict) or not all(_is_number(delta) for delta in deltas.values()):
+                raise ValueError(f"morphology_adjustments.{department}.{shape} must map fields to numbers")
+
+
+def chart_from_dict(doc):
+    """
+    Validate and compile a decoded chart document into a Chart.
+    """
+    validate_chart(doc)
+    return Chart(doc["sizing_rules"], doc.get("morphology_adjustments", {}),
+                 name=doc.get("name"), version=doc.get("version"))
+
+
+def load_chart(path):
+    """
+    Load, validate and compile one chart file.
+    """
+    with open(path, "rb") as f:
+        return chart_from_dict(json.load(f))
+
+
+class ChartFile:
+    """
+    Chart source backed by a chart file that is reloaded when it changes.
+
+    path           the chart file
+    poll_interval  seconds between checks of the file's modification time;
+                   None loads the file once and never reloads it
+    lazy           defer the first load to the first current() call
+
+    The file is loaded eagerly by default, so a broken file fails
+    construction; a lazy source raises from its first current() instead.
+    Later reload failures are kept in last_error and the old chart stays
+    current.
+    """
+
+    def __init__(self, path, poll_interval=2.0, clock=time.monotonic, lazy=False):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.last_error = None
+        self.reloads = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._signature = None
+        self._chart = None
+        if not lazy:
+            self._load()
+
+    def _load(self):
+        self._signature = self._stat()
+        self._chart = load_chart(self.path)
+        self._next_check = self._clock() + (self.poll_interval or 0)
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def current(self):
+        """
+        The current Chart, reloading the file first if it is due for a check and changed.
+        """
+        if self._chart is None:
+            with self._lock:
+                if self._chart is None:
+                    self._load()
+        if self.poll_interval is not None and self._clock() >= self._next_check:
+            # One thread checks; the others keep serving the current chart meanwhile
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._next_check = self._clock() + self.poll_interval
+                    self.reload()
+                finally:
+                    self._lock.release()
+        return self._chart
+
+    def reload(self, force=False):
+        """
+        Reload the file if it changed since the last load (or always, with force).
+        Returns True if a new chart was swapped in.
+        """
+        try:
+            signature = self._stat()
+            if signature == self._signature and not force:
+                return False
+            chart = load_chart(self.path)
+        except (OSError, ValueError) as exc:
+            # Keep serving the last good chart; a half-written file is retried next check
+            self.last_error = f"{type(exc).__name__}: {exc}"
+            return False
+        self._chart = chart
+        self._signature = signature
+        self.last_error = None
+        self.reloads += 1
+        return True
+
+    def __repr__(self):
+        version = self._chart.version if self._chart is not None else None
+        return f"ChartFile({self.path!r}, version={version!r})"
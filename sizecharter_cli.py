@@ -0,0 +1,240 @@
+"""
+Command-line sizing of large CSV or NDJSON shopper files.
+
+Reads /api/size records from a file or stdin, sizes them chunk by chunk with
+either engine's vectorized batch path and writes each chunk's results as soon
+as it is done, so memory stays bounded by the chunk size whatever the input
+size:
+
+    python sizecharter_cli.py shoppers.csv -o sizes.csv --engine mimic
+    zcat export.ndjson.gz | python sizecharter_cli.py --processes 8 > sizes.ndjson
+
+CSV input needs a header row naming the fields ("gender", "chest", ...);
+empty cells are missing values. Output rows carry the input's 0-based record
+"index", its "id" if it has one, and either the result or an "error", as
+ParallelSizer writes them. CSV output flattens warnings into one column,
+separated by WARNING_SEPARATOR. Progress and throughput go to stderr. With
+--processes, chunks are sized on a process pool (see sizecharter_parallel)
+and still written in input order.
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from itertools import islice
+
+from sizecharter_batch import batch_tables
+from sizecharter_parallel import ParallelSizer, size_records
+
+FORMATS = ("ndjson", "csv")
+
+DEFAULT_CHUNK_ROWS = 10000
+
+# Columns of CSV output, and the separator joining a record's warnings
+OUTPUT_COLUMNS = ("index", "id", "recommended_size", "body_shape", "health", "warnings", "error")
+WARNING_SEPARATOR = " | "
+
+
+def guess_format(path, default="ndjson"):
+    """
+    The record format a file name implies: "csv" for .csv files, else default.
+    """
+    return "csv" if path and path.lower().endswith(".csv") else default
+
+
+def read_chunks(source, input_format, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Split a binary stream into chunks of at most chunk_rows raw records.
+
+    Yields (start, header, items) with start the index of the chunk's first
+    record. NDJSON items are lines; CSV items are rows of cell strings,
+    numbered after the header row, which is passed along as header.
+    """
+    if input_format == "csv":
+        reader = csv.reader(io.TextIOWrapper(source, encoding="utf-8", newline=""))
+        header = next(reader, None)
+        if header is None:
+            return
+        header = tuple(name.strip() for name in header)
+    elif input_format == "ndjson":
+        reader, header = source, None
+    else:
+        raise ValueError(f"Unknown format: {input_format}")
+    start = 0
+    while True:
+        items = list(islice(reader, chunk_rows))
+        if not items:
+            return
+        yield start, header, items
+        start += len(items)
+
+
+def _decode(input_format, header, item):
+    # One raw record as size_records takes it: a dict, None when blank, or an error message
+    if input_format == "csv":
+        if not any(cell.strip() for cell in item):
+            return None
+        return {name: cell for name, cell in zip(header, item) if cell.strip()}
+    if not item.strip():
+        return None
+    try:
+        return json.loads(item)
+    except ValueError as exc:
+        return f"Malformed JSON: {exc}"
+
+
+def size_chunk(tables, input_format, output_format, start, header, items):
+    """
+    Size one chunk from read_chunks against batch tables.
+
+    Returns (output text, records sized, records with an error); blank
+    records produce no output and are not counted.
+    """
+    records = [_decode(input_format, header, item) for item in items]
+    results = [result for result in size_records(tables, start, records) if result is not None]
+    errors = sum(1 for result in results if "error" in result)
+    if output_format == "ndjson":
+        return "".join(json.dumps(result) + "\n" for result in results), len(results), errors
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for result in results:
+        row = dict(result, warnings=WARNING_SEPARATOR.join(result.get("warnings", ())))
+        writer.writerow([row.get(column, "") for column in OUTPUT_COLUMNS])
+    return buffer.getvalue(), len(results), errors
+
+
+class Progress:
+    """
+    Prints records sized, errors and throughput to stream, at most every interval seconds.
+    """
+
+    def __init__(self, stream=sys.stderr, interval=1.0, clock=time.perf_counter):
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.next_report = self.started + interval
+        self.rows = 0
+        self.errors = 0
+
+    def update(self, rows, errors):
+        self.rows += rows
+        self.errors += errors
+        now = self.clock()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self._report(now, "sized")
+
+    def finish(self):
+        """
+        Print the final line and return the run's summary.
+        """
+        now = self.clock()
+        self._report(now, "done:")
+        seconds = now - self.started
+        return {"rows": self.rows, "errors": self.errors, "seconds": seconds,
+                "rows_per_s": self.rows / seconds if seconds else None}
+
+    def _report(self, now, label):
+        if self.stream is None:
+            return
+        seconds = now - self.started
+        rate = self.rows / seconds if seconds else 0
+        self.stream.write(f"{label} {self.rows} records ({self.errors} errors) "
+                          f"in {seconds:.1f}s, {rate:,.0f} records/s\n")
+        self.stream.flush()
+
+
+def size_stream(charter, source, target, input_format="ndjson", output_format=None,
+                chunk_rows=DEFAULT_CHUNK_ROWS, processes=1, progress=None):
+    """
+    Size every record of a binary stream into a text stream, chunk by chunk.
+
+    output_format defaults to input_format. processes > 1 sizes chunks on a
+    ParallelSizer pool. progress is a Progress (default: one that prints
+    nothing). Returns the summary from Progress.finish().
+    """
+    output_format = output_format or input_format
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown format: {output_format}")
+    progress = progress or Progress(stream=None)
+    chunks = ((input_format, output_format, start, header, items)
+              for start, header, items in read_chunks(source, input_format, chunk_rows))
+    if output_format == "csv":
+        target.write(",".join(OUTPUT_COLUMNS) + "\n")
+
+    def write(outputs):
+        for text, rows, errors in outputs:
+            target.write(text)
+            target.flush()
+            progress.update(rows, errors)
+
+    if processes > 1:
+        with ParallelSizer(charter, processes) as runner:
+            write(runner.map(size_chunk, chunks))
+    else:
+        tables = batch_tables(charter)
+        write(size_chunk(tables, *chunk) for chunk in chunks)
+    return progress.finish()
+
+
+def make_charter(engine, chart_path=None):
+    """
+    A charter of the named engine ("tuned" or "mimic"), on chart_path's chart if given.
+    """
+    charts = None
+    if chart_path:
+        from sizecharter_charts import load_chart
+        charts = load_chart(chart_path)
+    if engine == "tuned":
+        from sizecharter_core import SizeCharterTuned
+        return SizeCharterTuned(charts=charts)
+    if engine == "mimic":
+        from sizecharter_mimic import SizeCharterMimic
+        return SizeCharterMimic(charts=charts)
+    raise ValueError(f"Unknown engine: {engine}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Size CSV or NDJSON shopper records in bounded memory.")
+    parser.add_argument("input", nargs="?", default="-", help="input file (default: stdin)")
+    parser.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+    parser.add_argument("--engine", choices=("tuned", "mimic"), default="tuned")
+    parser.add_argument("--chart", help="chart file to size with (default: the engine's bundled chart)")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="input format (default: csv for .csv files, else ndjson)")
+    parser.add_argument("--output-format", choices=FORMATS, help="output format (default: as input)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="records per chunk")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes; 1 sizes in-process")
+    parser.add_argument("--progress-interval", type=float, default=1.0, help="seconds between progress lines")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args(argv)
+
+    if args.chunk_rows < 1:
+        parser.error("--chunk-rows must be at least 1")
+    input_format = args.format or guess_format(args.input)
+    output_format = args.output_format or guess_format(args.output, input_format)
+    charter = make_charter(args.engine, args.chart)
+    progress = Progress(stream=None if args.quiet else sys.stderr, interval=args.progress_interval)
+
+    source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    target = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        size_stream(charter, source, target, input_format, output_format,
+                    args.chunk_rows, args.processes, progress)
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head): stop quietly, as Unix tools do
+        sys.stdout = None
+        return 1
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+Memory-mapped columnar measurement files for bulk sizing.
+
+A column file is a fixed-size JSON header followed by one contiguous,
+fixed-width array per column:
+
+    bytes 0-7       magic b"SZCOLS01"
+    bytes 8-4095    JSON header, space padded: row count, column names, dtypes
+                    and offsets, plus free-form metadata
+    then            each column, 64-byte aligned
+
+Measurement files hold a float32 column per MEASUREMENT_FIELDS entry (NaN =
+missing) and uint8 "department", "abdomen_shape" and "hip_shape" codes into
+the header's "departments" and "shapes" lists (NO_CODE = missing or unknown).
+
+size_column_file sizes a measurement file chunk by chunk straight from the
+memory map and writes the results as a side file of code columns ("size",
+"body_shape", "warnings", "health", "fallback"), with the size and shape
+names of each department in its metadata. Only one chunk is ever resident, so files larger
+than RAM stream through:
+
+    ndjson_to_columns("shoppers.ndjson", "shoppers.cols")
+    sizes = size_column_file(SizeCharterMimic(), "shoppers.cols")
+"""
+import json
+
+import numpy as np
+
+from sizecharter_batch import batch_tables, run_batch
+from sizecharter_charts import default_chart_path, load_chart
+from sizecharter_index import MEASUREMENT_FIELDS
+from sizecharter_request import parse_size_request
+
+MAGIC = b"SZCOLS01"
+HEADER_BYTES = 4096
+ALIGNMENT = 64
+
+# Code stored for a missing or unknown department or shape
+NO_CODE = 255
+
+MEASUREMENT_COLUMNS = dict(
+    [(name, "float32") for name in MEASUREMENT_FIELDS]
+    + [("department", "uint8"), ("abdomen_shape", "uint8"), ("hip_shape", "uint8")]
+)
+
+SIZE_COLUMNS = {"size": "int16", "body_shape": "int8", "warnings": "uint8", "health": "uint8", "fallback": "uint8"}
+
+DEFAULT_CHUNK_ROWS = 1 << 20
+READ_BYTES = 1 << 20
+
+# float32 keeps about 7 significant digits; measurements are rounded back to
+# this many decimals when read, so e.g. 85.1 sizes exactly as it does from JSON
+STORED_DECIMALS = 4
+
+
+class ColumnFile:
+    """
+    A column file opened as memory-mapped NumPy arrays.
+
+    file[name] is the memmap of one column; metadata is the header's free-form
+    dict. Columns of a file opened with mode "r" are read-only.
+    """
+
+    def __init__(self, path, mode="r"):
+        with open(path, "rb") as f:
+            head = f.read(HEADER_BYTES)
+        if len(head) < HEADER_BYTES or not head.startswith(MAGIC):
+            raise ValueError(f"{path} is not a column file")
+        header = json.loads(head[len(MAGIC):])
+        self.path = path
+        self.mode = mode
+        self.rows = header["rows"]
+        self.metadata = header["metadata"]
+        self._layout = header["columns"]
+        self.columns = {
+            name: np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(self.rows,))
+            for name, (dtype, offset) in self._layout.items()
+        }
+
+    @classmethod
+    def create(cls, path, rows, columns, metadata=None):
+        """
+        Create a zero-filled column file and open it for writing.
+
+        columns maps column name to dtype, in file order.
+        """
+        layout = {}
+        offset = HEADER_BYTES
+        for name, dtype in columns.items():
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            layout[name] = (np.dtype(dtype).str, offset)
+            offset += rows * np.dtype(dtype).itemsize
+        with open(path, "wb") as f:
+            f.write(_header(rows, layout, metadata or {}))
+            f.truncate(offset)
+        return cls(path, mode="r+")
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.rows
+
+    def flush(self):
+        """
+        Write column changes and the (possibly updated) metadata back to disk.
+        """
+        for column in self.columns.values():
+            column.flush()
+        with open(self.path, "r+b") as f:
+            f.write(_header(self.rows, self._layout, self.metadata))
+
+    def close(self):
+        if self.mode != "r":
+            self.flush()
+        self.columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _header(rows, layout, metadata):
+    text = json.dumps({"rows": rows, "columns": layout, "metadata": metadata}).encode()
+    if len(MAGIC) + len(text) > HEADER_BYTES:
+        raise ValueError("Column file header is too large")
+    return MAGIC + text.ljust(HEADER_BYTES - len(MAGIC))
+
+
+def create_measurement_file(path, rows, departments=("womens", "mens", "maternity"), shapes=()):
+    """
+    Create an empty measurement file for rows shoppers; all values start missing.
+    """
+    store = ColumnFile.create(path, rows, MEASUREMENT_COLUMNS,
+                              {"departments": list(departments), "shapes": list(shapes)})
+    for name in MEASUREMENT_FIELDS:
+        store[name][:] = np.nan
+    for name in ("department", "abdomen_shape", "hip_shape"):
+        store[name][:] = NO_CODE
+    return store
+
+
+def chart_vocabulary(charts):
+    """
+    The departments and morphology shapes named by any of charts, as
+    (departments, shapes) sets.
+    """
+    departments, shapes = set(), set()
+    for chart in charts:
+        departments.update(chart.sizing_rules)
+        for table in chart.morphology_adjustments.values():
+            shapes.update(table)
+    return departments, shapes
+
+
+def _code(vocabulary, name, known):
+    # Code for name in vocabulary, adding it if it is new; names outside known
+    # would size as no department or shape anyway, so they are not kept
+    if not isinstance(name, str) or name not in known:
+        return NO_CODE
+    try:
+        return vocabulary.index(name)
+    except ValueError:
+        if len(vocabulary) >= NO_CODE:
+            raise ValueError(f"More than {NO_CODE} distinct values in a code column") from None
+        vocabulary.append(name)
+        return len(vocabulary) - 1
+
+
+def ndjson_to_columns(input_path, output_path, chunk_rows=DEFAULT_CHUNK_ROWS, charts=None):
+    """
+    Convert an NDJSON file of /api/size records into a measurement file.
+
+    Row i is line i of the input; blank, malformed or invalid lines, and records
+    naming their own "chart", become rows with no department. Departments and
+    shapes that none of charts (default: the bundled charts) knows are stored
+    as NO_CODE. Returns the number of rows written.
+    """
+    if charts is None:
+        charts = [load_chart(default_chart_path(name)) for name in ("tuned", "mimic")]
+    known_departments, known_shapes = chart_vocabulary(charts)
+    if max(len(known_departments), len(known_shapes)) >= NO_CODE:
+        raise ValueError(f"More than {NO_CODE - 1} departments or shapes in the charts")
+    rows = 0
+    last = b"\n"
+    with open(input_path, "rb") as source:
+        for block in iter(lambda: source.read(READ_BYTES), b""):
+            rows += block.count(b"\n")
+            last = block[-1:]
+    if last != b"\n":
+        rows += 1
+
+    store = create_measurement_file(output_path, rows)
+    departments, shapes = store.metadata["departments"], store.metadata["shapes"]
+    with store, open(input_path, "rb") as source:
+        start = 0
+        while start < rows:
+            lines = [line for _, line in zip(range(chunk_rows), source)]
+            if not lines:
+                break
+            block = np.full((len(lines), len(MEASUREMENT_FIELDS)), np.nan, dtype=np.float32)
+            codes = np.full((len(lines), 3), NO_CODE, dtype=np.uint8)
+            for pos, line in enumerate(lines):
+                try:
+                    kwargs, error = parse_size_request(json.loads(line)) if line.strip() else (None, True)
+                except ValueError:
+                    continue
+                if error or "chart" in kwargs:
+                    continue
+                block[pos] = [np.nan if kwargs[name] is None else kwargs[name] for name in MEASUREMENT_FIELDS]
+                codes[pos] = (_code(departments, kwargs["gender"].lower(), known_departments),
+                              _code(shapes, kwargs["abdomen_shape"], known_shapes),
+                              _code(shapes, kwargs["hip_shape"], known_shapes))
+            stop = start + len(lines)
+            for i, name in enumerate(MEASUREMENT_FIELDS):
+                store[name][start:stop] = block[:, i]
+            store["department"][start:stop] = codes[:, 0]
+            store["abdomen_shape"][start:stop] = codes[:, 1]
+            store["hip_shape"][start:stop] = codes[:, 2]
+            start = stop
+    return rows
+
+
+def read_measurements(store, rows):
+    """
+    The measurement columns of the given rows of a measurement file, as
+    float64 arrays with the float32 storage error rounded away.
+    """
+    return {field: np.round(store[field][rows].astype(np.float64), STORED_DECIMALS) for field in MEASUREMENT_FIELDS}
+
+
+def department_codes(tables, departments, shapes):
+    """
+    Map a measurement file's codes onto batch tables.
+
+    Returns ({file department code: name} for the departments the tables know,
+    {file department code: array mapping file shape codes to the department's
+    shape codes, -1 where unknown}).
+    """
+    known = {code: name for code, name in enumerate(departments) if name in tables["departments"]}
+    remaps = {}
+    for code, name in known.items():
+        names = tables["departments"][name]["shape_names"]
+        remap = np.full(NO_CODE + 1, -1, dtype=np.int8)
+        remap[:len(shapes)] = [names.index(shape) if shape in names else -1 for shape in shapes]
+        remaps[code] = remap
+    return known, remaps
+
+
+def size_column_file(charter, input_path, output_path=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Size every row of a measurement file with charter's batch path.
+
+    Results go to a side column file (default: input_path + ".sizes"), which is
+    returned open for reading. "size" and "body_shape" are codes into the
+    metadata's per-department "sizes" and "body_shapes" lists (-1 = none);
+    rows with no known department get -1 for both. "fallback" is set where
+    the closest-size fallback chose the size.
+    """
+    tables = batch_tables(charter)
+    output_path = output_path or input_path + ".sizes"
+    with ColumnFile(input_path) as store:
+        known, remaps = department_codes(tables, store.metadata["departments"], store.metadata["shapes"])
+        metadata = {
+            "engine": tables["engine"],
+            "sizes": {name: list(tables["departments"][name]["sizes"]) for name in known.values()},
+            "body_shapes": {name: list(tables["departments"][name]["shape_names"]) for name in known.values()},
+            "warning_messages": list(tables["warning_messages"]),
+        }
+        with ColumnFile.create(output_path, store.rows, SIZE_COLUMNS, metadata) as out:
+            out["size"][:] = -1
+            out["body_shape"][:] = -1
+            for start in range(0, store.rows, chunk_rows):
+                stop = min(start + chunk_rows, store.rows)
+                department = np.asarray(store["department"][start:stop])
+                for code, name in known.items():
+                    rows = np.flatnonzero(department == code) + start
+                    if not len(rows):
+                        continue
+                    remap = remaps[code]
+                    result = run_batch(tables, name, read_measurements(store, rows),
+                                       remap[store["abdomen_shape"][rows]], remap[store["hip_shape"][rows]])
+                    for column in SIZE_COLUMNS:
+                        if column in result:
+                            out[column][rows] = result[column]
+    return ColumnFile(output_path)
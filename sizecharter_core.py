@@ -0,0 +1,283 @@
+"""
+The SizeCharterTuned sizing engine, importable without any web dependency.
+
+Serverless functions, CLI workers and other embedders only need the sizing
+math, so this module imports nothing beyond the standard library and the
+other sizecharter modules it builds on. Its chart is read and compiled on
+the first recommendation, not at import or construction:
+
+    from sizecharter_core import SizeCharterTuned
+    SizeCharterTuned().get_size_recommendation("womens", chest=88, waist=70, hips=95)
+
+sizecharter_mimic holds the SizeCharterMimic engine on the same terms.
+NumPy is only imported by the batch methods. sizecharter_api layers the
+Flask app on top.
+"""
+from sizecharter_charts import ChartFile, default_chart_path
+from sizecharter_index import MEASUREMENT_FIELDS, ChartTables, field_weights
+from sizecharter_result import SizeRecommendation, explain_fields, fields_outside, pack_measurements
+
+class SizeCharterTuned(ChartTables):
+    # Which vectorized engine sizecharter_batch runs for this class
+    BATCH_ENGINE = "tuned"
+
+    # Fit warnings, in the bit order used by get_size_recommendations_batch
+    WARNING_MESSAGES = (
+        "Chest measurement is significantly smaller than waist; consider fit options.",
+        "Chest measurement is significantly larger than waist; consider fit options.",
+        "Waist measurement is significantly larger than hips; consider fit options.",
+        "Waist measurement is significantly smaller than hips; consider fit options.",
+    )
+
+    # Measurements outside this range (cm) are flagged by the health check
+    HEALTH_RANGE = (30, 180)
+
+    # Per-field weights of the optional closest-size fallback's squared distance
+    FALLBACK_WEIGHTS = {name: 1.0 for name in MEASUREMENT_FIELDS}
+
+    def __init__(self, cache=None, metrics=None, charts=None, fallback=False, fallback_weights=None):
+        # Optional RecommendationCache in front of get_size_recommendation
+        self.cache = cache
+        # Optional SizingMetrics recording stage timings and outcome counters
+        self.metrics = metrics
+        # Chart source: a Chart, or a ChartFile that hot-reloads (default: charts/tuned.json,
+        # loaded on first use)
+        self.charts = charts if charts is not None else ChartFile(default_chart_path("tuned"), lazy=True)
+        # With fallback, a shopper no range matches gets the closest size by weighted
+        # squared distance instead of "No exact match found" (weights: FALLBACK_WEIGHTS)
+        self.fallback_weights = field_weights(fallback_weights or self.FALLBACK_WEIGHTS) if fallback else None
+
+    def _infer_body_shape(self, gender, chest, waist, hips):
+        """
+        Infer body shape based on key ratios and measurements.
+        Returns a string body shape name or None if cannot infer.
+        """
+        if gender == "womens" and chest and waist and hips:
+            waist_hip_ratio = waist / hips if hips else 0
+            chest_waist_ratio = chest / waist if waist else 0
+            # Basic heuristics for women's shapes:
+            if abs(chest - hips) <= 3 and waist_hip_ratio < 0.75:
+                return "hourglass"
+            if hips > chest and waist_hip_ratio < 0.75:
+                return "pear"
+            if waist > hips:
+                return "apple"
+            if chest > hips and waist_hip_ratio > 0.85:
+                return "inverted_triangle"
+            return "rectangle"
+        
+        elif gender == "mens" and chest and waist:
+            ratio = chest / waist if waist else 0
+            if ratio > 1.25:
+                return "triangle"
+            elif ratio < 1.05:
+                return "oval"
+            else:
+                return "rectangle"
+        
+        elif gender == "maternity":
+            # Maternity shapes inferred differently, but simplified here
+            return "prominent" if waist and hips and waist > 80 else "soft"
+
+        return None
+
+    def get_size_recommendation(self, gender, chest=None, waist=None, hips=None, inseam=None,
+                                shoulders=None, neck=None, thigh=None, calf=None,
+                                abdomen_shape=None, hip_shape=None, chart=None):
+        # chart sizes against a specific Chart (e.g. from a ChartRegistry) instead of self.chart
+        if chart is None:
+            chart = self.chart
+        if self.metrics is not None:
+            return self.metrics.measure(
+                self, chart, gender, (chest, waist, hips, inseam, shoulders, neck, thigh, calf), abdomen_shape, hip_shape)
+        if self.cache is not None:
+            return self._cached_recommendation(
+                chart, gender, (chest, waist, hips, inseam, shoulders, neck, thigh, calf), abdomen_shape, hip_shape)
+        return self._recommend(chart, gender, chest, waist, hips, inseam, shoulders, neck, thigh, calf,
+                               abdomen_shape=abdomen_shape, hip_shape=hip_shape)
+
+    def _recommend(self, chart, gender, chest=None, waist=None, hips=None, inseam=None,
+                   shoulders=None, neck=None, thigh=None, calf=None,
+                   abdomen_shape=None, hip_shape=None, probe=None):
+        # chart is the Chart snapshot to size against; probe, if given, is a
+        # sizecharter_metrics.StageTimer timing each stage
+        gender = gender.lower()
+        if gender not in chart.sizing_rules:
+            return {"error": "Invalid gender/department. Choose from 'womens', 'mens', or 'maternity'."}
+
+        # Infer body shape
+        body_shape = self._infer_body_shape(gender, chest, waist, hips)
+        if probe is not None:
+            probe.lap("shape_inference")
+
+        # Compose adjustments from morphology (body_shape + abdomen_shape + hip_shape)
+        adjustments = chart.adjustments_for(gender, body_shape, abdomen_shape, hip_shape)
+
+        # Apply adjustments to measurements
+        adj_chest = chest + adjustments.get("chest", 0) if chest is not None else None
+        adj_waist = waist + adjustments.get("waist", 0) if waist is not None else None
+        adj_hips = hips + adjustments.get("hips", 0) if hips is not None else None
+        adj_shoulders = shoulders  # no adjustments for new fields yet
+        adj_neck = neck
+        adj_thigh = thigh
+        adj_calf = calf
+        if probe is not None:
+            probe.lap("adjustment")
+
+        department = chart.compiled[gender]
+        size_for = department.size_for
+
+        # Get the ordinal of the smallest matching size for each measurement (or None if no match)
+        sizes = {}
+        sizes['chest'] = size_for("chest", adj_chest)
+        sizes['waist'] = size_for("waist", adj_waist)
+        if gender != "mens":  # mens use inseam, womens and maternity use hips
+            sizes['hips'] = size_for("hips", adj_hips)
+        else:
+            sizes['hips'] = None
+        sizes['inseam'] = size_for("inseam", inseam)
+        sizes['shoulders'] = size_for("shoulders", adj_shoulders)
+        sizes['neck'] = size_for("neck", adj_neck)
+        sizes['thigh'] = size_for("thigh", adj_thigh)
+        sizes['calf'] = size_for("calf", adj_calf)
+
+        # Find dominant size as max ordinal of any measurement size (larger sizes mean bigger ordinal)
+        size_indices = [ordinal for ordinal in sizes.values() if ordinal is not None]
+        nearest = None
+        if size_indices:
+            recommended_size = department.sizes[max(size_indices)]
+        else:
+            recommended_size = "No exact match found"
+        if probe is not None:
+            probe.lap("range_matching")
+        if not size_indices and self.fallback_weights is not None:
+            nearest = chart.nearest_index(gender, self.fallback_weights).nearest(
+                (adj_chest, adj_waist, adj_hips, inseam, adj_shoulders, adj_neck, adj_thigh, adj_calf))
+            if nearest is not None:
+                recommended_size = nearest.size
+            if probe is not None:
+                probe.lap("fallback_distance")
+
+        # Flag big differences between chest, waist, hips (bits over WARNING_MESSAGES)
+        warnings = 0
+        if adj_chest is not None and adj_waist is not None:
+            if adj_chest < 0.7 * adj_waist:
+                warnings |= 1
+            elif adj_chest > 1.3 * adj_waist:
+                warnings |= 2
+        if adj_waist is not None and adj_hips is not None:
+            if adj_waist > 1.3 * adj_hips:
+                warnings |= 4
+            elif adj_waist < 0.7 * adj_hips:
+                warnings |= 8
+
+        # Health info (bits over MEASUREMENT_FIELDS)
+        original = (chest, waist, hips, inseam, shoulders, neck, thigh, calf)
+        health = 0
+        low, high = self.HEALTH_RANGE
+        for bit, val in enumerate(original):
+            if val is not None and (val < low or val > high):
+                health |= 1 << bit
+        if probe is not None:
+            probe.lap("health_checks")
+
+        result = TunedRecommendation(
+            recommended_size, gender, body_shape, abdomen_shape, hip_shape,
+            pack_measurements(original, (adj_chest, adj_waist, adj_hips, inseam, adj_shoulders, adj_neck, adj_thigh, adj_calf)),
+            adjustments, warnings, health, nearest)
+        if probe is not None:
+            probe.lap("result_building")
+        return result
+
+    def _explain(self, chart, result):
+        # The explanation of explain_size_recommendation, read off the compiled ranges
+        # with the result's own adjusted measurements
+        gender = result.gender
+        names = [name for name in MEASUREMENT_FIELDS if name != "hips" or gender != "mens"]
+        fields, ordinals = explain_fields(chart.compiled[gender], result.adjusted, names)
+        if ordinals:
+            # The largest per-field size wins
+            top = max(ordinals.values())
+            return result._explanation("largest_field_size",
+                                       [name for name, ordinal in ordinals.items() if ordinal == top], fields)
+        if result.nearest is not None:
+            limits = chart.sizing_rules[gender][result.recommended_size]
+            return result._explanation("closest_size", fields_outside(limits, result.adjusted, names), fields)
+        return result._explanation("no_match", [], fields)
+
+    def _result_from_batch(self, chart, gender, size, nearest, body_shape, abdomen_shape, hip_shape,
+                           measurements, warnings, health):
+        # The _recommend result for a row sized by sizecharter_batch.batch_recommendations: size
+        # is the matched size (None if no range matched), nearest the fallback's NearestMatch
+        if size is None:
+            size = nearest.size if nearest is not None else "No exact match found"
+        return TunedRecommendation(
+            size, gender, body_shape, abdomen_shape, hip_shape, measurements,
+            chart.adjustments_for(gender, body_shape, abdomen_shape, hip_shape), warnings, health, nearest)
+
+    def get_size_recommendations_batch(self, gender, measurements, abdomen_shape=None, hip_shape=None):
+        """
+        Vectorized get_size_recommendation for N shoppers of one department.
+
+        measurements is a mapping of field name to array, or an (N, 8) array in
+        MEASUREMENT_FIELDS order, with NaN meaning missing. abdomen_shape and
+        hip_shape are None, one shape for everyone, or one shape per shopper.
+
+        Returns a dict of arrays: "size" (ordinals into "sizes", -1 = no match),
+        "body_shape" (codes into "body_shapes", -1 = none), "warnings" (bitmask
+        over WARNING_MESSAGES) and "health" (bitmask over MEASUREMENT_FIELDS of
+        out-of-range measurements).
+        Requires NumPy.
+        """
+        from sizecharter_batch import charter_batch
+        return charter_batch(self, gender, measurements, abdomen_shape, hip_shape)
+
+    def get_fit_sensitivity_batch(self, gender, measurements, abdomen_shape=None, hip_shape=None,
+                                  delta=1.0, variants=None):
+        """
+        How close N shoppers of one department sit to a size boundary, and how
+        their size moves with each (abdomen_shape, hip_shape) pair and with each
+        measurement moved by -delta and +delta cm, in one vectorized pass.
+
+        Arguments are as for get_size_recommendations_batch; variants is a
+        sequence of shape pairs (default: every pair of the department's
+        morphology shapes). See sizecharter_sensitivity.run_sensitivity for the
+        arrays returned.
+        Requires NumPy.
+        """
+        from sizecharter_sensitivity import charter_sensitivity
+        return charter_sensitivity(self, gender, measurements, abdomen_shape, hip_shape, delta, variants)
+
+
+class TunedRecommendation(SizeRecommendation):
+    """
+    SizeRecommendation rendered in SizeCharterTuned's details layout.
+    """
+    __slots__ = ()
+
+    @property
+    def fallback(self):
+        # True when the opt-in closest-size fallback chose the size
+        return self.nearest is not None
+
+    def _build_details(self):
+        health_messages = [f"{key.capitalize()} measurement is unusually low or high."
+                           for key in self._flagged_fields()]
+        details = {
+            "gender": self.gender,
+            "original_measurements": self._original_measurements(),
+            "adjusted_measurements": self._adjusted_measurements(),
+            "body_shape": self.body_shape,
+            "abdomen_shape": self.abdomen_shape,
+            "hip_shape": self.hip_shape,
+            "morphology_adjustments": dict(self.adjustments),
+            "warnings": [message for bit, message in enumerate(SizeCharterTuned.WARNING_MESSAGES)
+                         if self.warnings >> bit & 1],
+            "health": {
+                "status": "warning" if health_messages else "healthy",
+                "messages": health_messages or ["All measurements within typical range."]
+            }
+        }
+        if self.nearest is not None:
+            details["closest_sizes"] = self._nearest_details()
+        return details
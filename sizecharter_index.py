@@ -0,0 +1,380 @@
+"""
+Compiled lookup structures for the sizing charts.
+
+The charts are nested dicts keyed by size and then by measurement field.
+Scanning them on every lookup costs O(sizes) per field plus a sort, so the
+charter classes compile each (department, field) column once into a sorted
+boundary index and resolve a measurement with a single bisect.
+"""
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Mapping
+from types import MappingProxyType
+
+MEASUREMENT_FIELDS = ("chest", "waist", "hips", "inseam", "shoulders", "neck", "thigh", "calf")
+
+# Most shape combinations ChartTables memoizes adjustments for, per chart
+ADJUSTMENT_MEMO_SIZE = 4096
+
+
+class IntervalIndex:
+    """
+    Sorted boundary index over the closed (low, high) ranges of one field.
+
+    The distinct range endpoints split the number line into alternating open
+    gaps and single boundary points. Slot 2*j is the gap just below bounds[j],
+    slot 2*j+1 is the point bounds[j] itself; each slot stores the smallest
+    size ordinal whose range covers it, or None.
+    """
+    __slots__ = ("bounds", "slots")
+
+    def __init__(self, ranges):
+        # ranges: iterable of (ordinal, low, high)
+        ranges = list(ranges)
+        bounds = sorted({point for _, low, high in ranges for point in (low, high)})
+
+        slots = []
+        for j, point in enumerate(bounds):
+            below = bounds[j - 1] if j else None
+            gap = [o for o, low, high in ranges if below is not None and low <= below and point <= high]
+            hit = [o for o, low, high in ranges if low <= point <= high]
+            slots.append(min(gap) if gap else None)
+            slots.append(min(hit) if hit else None)
+        slots.append(None)  # everything above the last boundary
+
+        self.bounds = bounds
+        self.slots = slots
+
+    def lookup(self, value):
+        """
+        Return the smallest size ordinal whose range contains value, or None.
+        """
+        bounds = self.bounds
+        j = bisect_left(bounds, value)
+        if j < len(bounds) and bounds[j] == value:
+            return self.slots[2 * j + 1]
+        return self.slots[2 * j]
+
+    def explain(self, value):
+        """
+        Return (lookup(value), margin): margin is the distance from value to the
+        nearest range endpoint where the lookup result changes, or None if it
+        never does.
+        """
+        bounds, slots = self.bounds, self.slots
+        j = bisect_left(bounds, value)
+        slot = 2 * j + 1 if j < len(bounds) and bounds[j] == value else 2 * j
+        ordinal = slots[slot]
+        margin = None
+        # The boundary between slots k and k + 1 lies at bounds[k // 2]
+        for k in range(slot - 1, -1, -1):
+            if slots[k] != ordinal:
+                margin = value - bounds[k // 2]
+                break
+        for k in range(slot + 1, len(slots)):
+            if slots[k] != ordinal:
+                above = bounds[(k - 1) // 2] - value
+                if margin is None or above < margin:
+                    margin = above
+                break
+        return ordinal, margin
+
+
+class CompiledDepartment:
+    """
+    Compiled form of one department's size chart.
+
+    sizes keeps the chart order (smallest first), ranks maps a size name to its
+    ordinal in that order and fields maps each measurement field to its
+    IntervalIndex. Fields no size defines a range for are simply absent.
+    """
+    __slots__ = ("sizes", "ranks", "fields")
+
+    def __init__(self, rules):
+        self.sizes = tuple(rules)
+        self.ranks = {size: ordinal for ordinal, size in enumerate(self.sizes)}
+
+        names = []
+        for limits in rules.values():
+            for name in limits:
+                if name not in names:
+                    names.append(name)
+
+        self.fields = {}
+        for name in names:
+            ranges = [(ordinal, limits[name][0], limits[name][1])
+                      for ordinal, limits in enumerate(rules.values()) if name in limits]
+            self.fields[name] = IntervalIndex(ranges)
+
+    def size_for(self, name, value):
+        """
+        Return the ordinal of the smallest size matching one measurement, or None.
+        """
+        if value is None:
+            return None
+        index = self.fields.get(name)
+        if index is None:
+            return None
+        return index.lookup(value)
+
+
+# Result of NearestSizeIndex.nearest: the closest size and the next closest, with
+# their weighted squared distances (runner_up is None for single-size departments)
+NearestMatch = namedtuple("NearestMatch", ("size", "distance", "runner_up", "runner_up_distance"))
+
+
+def field_weights(weights):
+    """
+    Normalize a {field: weight} mapping to a tuple in MEASUREMENT_FIELDS order.
+    Unlisted fields get weight 0 and are ignored by the nearest-size search.
+    """
+    unknown = set(weights) - set(MEASUREMENT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown measurement fields: {', '.join(sorted(unknown))}")
+    if any(weight < 0 for weight in weights.values()):
+        raise ValueError("Field weights must not be negative")
+    return tuple(float(weights.get(name, 0)) for name in MEASUREMENT_FIELDS)
+
+
+class NearestSizeIndex:
+    """
+    Weighted nearest-size search over one department's ranges.
+
+    The distance of a size is the sum, over the weighted fields it has a range
+    for, of weight * (how far the value lies outside the range) ** 2. Like an
+    IntervalIndex, each field's distinct range endpoints split the number line
+    into gap and point slots; each slot precomputes the (ordinal, a, b) terms
+    of the sizes whose range the slot lies outside of, so a value's distance to
+    such a size is (a + b * value) ** 2. A lookup is then one bisect per present
+    field plus a few multiply-adds, without visiting the sizes whose range
+    contains the value.
+    """
+    __slots__ = ("sizes", "fields")
+
+    def __init__(self, rules, weights):
+        # rules: one department's sizing_rules; weights: a field_weights tuple
+        self.sizes = tuple(rules)
+        self.fields = []
+        for position, (name, weight) in enumerate(zip(MEASUREMENT_FIELDS, weights)):
+            ranges = [(ordinal, limits[name][0], limits[name][1])
+                      for ordinal, limits in enumerate(rules.values()) if name in limits]
+            if not weight or not ranges:
+                continue
+            bounds = sorted({point for _, low, high in ranges for point in (low, high)})
+            slots = []
+            for point in bounds:
+                # A value in the gap below point (or at point) is above the ranges
+                # ending before it and below the ranges starting after it
+                slots.append(tuple((o, -high, 1) if high < point else (o, low, -1)
+                                   for o, low, high in ranges if high < point or low >= point))
+                slots.append(tuple((o, -high, 1) if high < point else (o, low, -1)
+                                   for o, low, high in ranges if high < point or low > point))
+            slots.append(tuple((o, -high, 1) for o, low, high in ranges))
+            self.fields.append((position, weight, bounds, slots))
+
+    def nearest(self, values):
+        """
+        The NearestMatch for adjusted values in MEASUREMENT_FIELDS order (None = missing),
+        or None if no weighted field the department has ranges for is present.
+
+        Ties go to the size listed first in the chart.
+        """
+        distances = [0.0] * len(self.sizes)
+        informative = False
+        for position, weight, bounds, slots in self.fields:
+            value = values[position]
+            if value is None:
+                continue
+            informative = True
+            j = bisect_left(bounds, value)
+            for ordinal, a, b in slots[2 * j + 1 if j < len(bounds) and bounds[j] == value else 2 * j]:
+                gap = a + b * value
+                distances[ordinal] += weight * gap * gap
+        if not informative:
+            return None
+
+        best = runner_up = None
+        for ordinal, distance in enumerate(distances):
+            if best is None or distance < distances[best]:
+                best, runner_up = ordinal, best
+            elif runner_up is None or distance < distances[runner_up]:
+                runner_up = ordinal
+        if runner_up is None:
+            return NearestMatch(self.sizes[best], distances[best], None, None)
+        return NearestMatch(self.sizes[best], distances[best], self.sizes[runner_up], distances[runner_up])
+
+
+def compile_sizing_rules(sizing_rules):
+    """
+    Compile a full sizing_rules table into {department: CompiledDepartment}.
+    """
+    return {department: CompiledDepartment(rules) for department, rules in sizing_rules.items()}
+
+
+def freeze_chart(table):
+    """
+    Return a read-only copy of a nested chart table.
+
+    Dicts become MappingProxyType views and lists become tuples, so a frozen
+    chart can only be changed by assigning a whole new table.
+    """
+    if isinstance(table, Mapping):
+        return MappingProxyType({key: freeze_chart(value) for key, value in table.items()})
+    if isinstance(table, list):
+        return tuple(freeze_chart(value) for value in table)
+    return table
+
+
+class Chart:
+    """
+    One immutable, compiled version of a charter's charts.
+
+    sizing_rules and morphology_adjustments are frozen copies of the tables and
+    compiled maps each department to its CompiledDepartment. A Chart is never
+    modified after construction, so a request that picked one up keeps a
+    consistent view even if its charter switches to a newer chart meanwhile.
+    Its identity keys cached results.
+
+    A Chart is also its own chart source: current() returns it.
+    """
+    __slots__ = ("name", "version", "sizing_rules", "morphology_adjustments", "compiled",
+                 "_adjustment_memo", "_nearest_memo", "_fingerprint")
+
+    def __init__(self, sizing_rules, morphology_adjustments, name=None, version=None):
+        self.name = name
+        self.version = version
+        self.sizing_rules = freeze_chart(sizing_rules)
+        self.morphology_adjustments = freeze_chart(morphology_adjustments)
+        self.compiled = compile_sizing_rules(self.sizing_rules)
+        self._adjustment_memo = {}
+        self._nearest_memo = {}
+        self._fingerprint = None
+
+    def current(self):
+        return self
+
+    def fingerprint(self):
+        """
+        Hex digest of the tables, equal for charts that size identically.
+
+        Unlike version, it changes whenever the tables do, even if a chart
+        file was edited without bumping its version.
+        """
+        if self._fingerprint is None:
+            # Imported here: only the profile store needs fingerprints, and core startup stays lean
+            import hashlib
+            import json
+            text = json.dumps([self.sizing_rules, self.morphology_adjustments], default=dict, sort_keys=True)
+            self._fingerprint = hashlib.sha256(text.encode()).hexdigest()[:32]
+        return self._fingerprint
+
+    def adjustments_for(self, gender, body_shape, abdomen_shape, hip_shape):
+        """
+        Combined morphology deltas for one shape combination, memoized.
+
+        The returned mapping is shared and read-only. Arbitrary client-supplied
+        shape names are only memoized until ADJUSTMENT_MEMO_SIZE entries exist.
+        """
+        key = (gender, body_shape, abdomen_shape, hip_shape)
+        adjustments = self._adjustment_memo.get(key)
+        if adjustments is None:
+            table = self.morphology_adjustments.get(gender, {})
+            combined = {}
+            for morph in key[1:]:
+                if morph and morph in table:
+                    for name, val in table[morph].items():
+                        combined[name] = combined.get(name, 0) + val
+            adjustments = MappingProxyType(combined)
+            if len(self._adjustment_memo) < ADJUSTMENT_MEMO_SIZE:
+                self._adjustment_memo[key] = adjustments
+        return adjustments
+
+    def nearest_index(self, gender, weights):
+        """
+        The NearestSizeIndex of one department for a field_weights tuple, compiled on first use.
+        """
+        key = (gender, weights)
+        index = self._nearest_memo.get(key)
+        if index is None:
+            index = self._nearest_memo[key] = NearestSizeIndex(self.sizing_rules[gender], weights)
+        return index
+
+    def __repr__(self):
+        return f"Chart(name={self.name!r}, version={self.version!r})"
+
+
+class ChartTables:
+    """
+    Mixin giving a charter its charts through a chart source.
+
+    self.charts is anything with a current() method returning a Chart: a Chart
+    itself, or a sizecharter_charts.ChartFile that reloads when its file
+    changes. Each recommendation reads self.chart once and uses that snapshot
+    throughout.
+
+    Assigning sizing_rules or morphology_adjustments replaces the source with
+    a fixed Chart built from the new table and clears the charter's cache.
+    """
+
+    @property
+    def chart(self):
+        return self.charts.current()
+
+    @property
+    def sizing_rules(self):
+        return self.chart.sizing_rules
+
+    @sizing_rules.setter
+    def sizing_rules(self, rules):
+        chart = self.chart
+        self._set_chart(Chart(rules, chart.morphology_adjustments, chart.name))
+
+    @property
+    def morphology_adjustments(self):
+        return self.chart.morphology_adjustments
+
+    @morphology_adjustments.setter
+    def morphology_adjustments(self, adjustments):
+        chart = self.chart
+        self._set_chart(Chart(chart.sizing_rules, adjustments, chart.name))
+
+    def explain_size_recommendation(self, gender, chest=None, waist=None, hips=None, inseam=None,
+                                    shoulders=None, neck=None, thigh=None, calf=None,
+                                    abdomen_shape=None, hip_shape=None, chart=None):
+        """
+        get_size_recommendation, plus why it chose that size.
+
+        Returns (result, explanation); explanation is None for an error result.
+        It lists, per measurement the engine sized on, the adjusted value, the
+        size its range alone gives ("size") and the distance in cm to the
+        nearest range endpoint that would change that size ("margin"), with
+        the rule that picked the result and the "deciding_fields" that rule
+        turned on. get_size_recommendation itself is unaffected.
+        """
+        if chart is None:
+            chart = self.chart
+        result = self.get_size_recommendation(gender, chest, waist, hips, inseam, shoulders, neck, thigh, calf,
+                                              abdomen_shape, hip_shape, chart=chart)
+        if isinstance(result, dict):
+            return result, None
+        return result, self._explain(chart, result)
+
+    def _set_chart(self, chart):
+        self.charts = chart
+        cache = getattr(self, "cache", None)
+        if cache is not None:
+            cache.clear()
+
+    def _cached_recommendation(self, chart, gender, measurements, abdomen_shape, hip_shape, probe=None):
+        """
+        Serve get_size_recommendation through self.cache, computing with self._recommend on a miss.
+        """
+        cache = self.cache
+        measurements = cache.quantize(measurements)
+        key = (chart, gender, measurements, abdomen_shape, hip_shape)
+        result = cache.get(key)
+        if result is None:
+            result = self._recommend(chart, gender, *measurements, abdomen_shape=abdomen_shape,
+                                     hip_shape=hip_shape, probe=probe)
+            cache.put(key, result)
+        return result
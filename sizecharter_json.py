@@ -0,0 +1,33 @@
+"""
+JSON encoding and decoding for the request/response hot path.
+
+Uses orjson when it is installed (pip install orjson), which is several
+times faster than the standard library on sizing payloads, and falls back to
+the json module otherwise. Both produce compact UTF-8 JSON.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data):
+    """
+    Decode JSON from bytes or str; raises ValueError if it is malformed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """
+    Encode obj as compact UTF-8 JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _ENCODER.encode(obj).encode()
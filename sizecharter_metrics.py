@@ -0,0 +1,202 @@
+"""
+Optional hot-path instrumentation for the charters, exported in Prometheus text format.
+
+Pass a SizingMetrics to a charter's constructor and every
+get_size_recommendation call records:
+
+    sizecharter_recommendation_seconds       histogram, per engine
+    sizecharter_stage_seconds                histogram, per engine and stage
+    sizecharter_recommendations_total        counter, per engine and department
+    sizecharter_body_shapes_total            counter, per engine, department and inferred shape
+    sizecharter_no_match_total               counter, results with no size
+    sizecharter_fallbacks_total              counter, closest-size fallbacks
+    sizecharter_health_warnings_total        counter, results with a health warning
+
+Stages are shape_inference, adjustment, range_matching, fallback_distance
+(only when the closest-size fallback runs), health_checks and result_building. Cache
+hits are counted but have no stage timings. The Flask app also records
+sizecharter_http_request_seconds and serves everything on GET /metrics.
+
+A charter without metrics pays a single None check per call.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds; the hot path runs in microseconds, HTTP in milliseconds
+LATENCY_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class StageTimer:
+    """
+    Collects (stage, seconds) laps while one recommendation is computed.
+    """
+    __slots__ = ("last", "laps")
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.laps = []
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.laps.append((stage, now - self.last))
+        self.last = now
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram; counts are per bucket and cumulated when rendered.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(pairs):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class SizingMetrics:
+    """
+    Thread-safe registry of the sizing counters and latency histograms.
+
+    Series are keyed by metric name and a tuple of (label, value) pairs.
+    """
+
+    HELP = {
+        "sizecharter_recommendation_seconds": "Time spent in get_size_recommendation.",
+        "sizecharter_stage_seconds": "Time spent per sizing stage (cache misses only).",
+        "sizecharter_recommendations_total": "Recommendations served.",
+        "sizecharter_body_shapes_total": "Recommendations by inferred body shape.",
+        "sizecharter_no_match_total": "Recommendations where no size matched.",
+        "sizecharter_fallbacks_total": "Recommendations sized by closest-size fallback.",
+        "sizecharter_health_warnings_total": "Recommendations with a health warning.",
+        "sizecharter_http_request_seconds": "HTTP request latency.",
+    }
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            self._count((name, labels), amount)
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observe((name, labels), value)
+
+    def measure(self, charter, chart, gender, measurements, abdomen_shape, hip_shape):
+        """
+        Compute one recommendation for charter on chart (through its cache, if any) and record it.
+        """
+        probe = StageTimer()
+        start = probe.last
+        if charter.cache is not None:
+            result = charter._cached_recommendation(chart, gender, measurements, abdomen_shape, hip_shape, probe)
+        else:
+            result = charter._recommend(chart, gender, *measurements, abdomen_shape=abdomen_shape,
+                                        hip_shape=hip_shape, probe=probe)
+        elapsed = time.perf_counter() - start
+        self.record(charter.BATCH_ENGINE, result, elapsed, probe.laps)
+        return result
+
+    def record(self, engine, result, elapsed, laps=()):
+        """
+        Record one finished recommendation, its total time and its stage laps.
+        """
+        engine_label = (("engine", engine),)
+        with self._lock:
+            self._observe(("sizecharter_recommendation_seconds", engine_label), elapsed)
+            for stage, seconds in laps:
+                self._observe(("sizecharter_stage_seconds", engine_label + (("stage", stage),)), seconds)
+
+            department = getattr(result, "gender", None)
+            if department is None:
+                # An error dict for an unknown department
+                self._count(("sizecharter_recommendations_total", engine_label + (("department", "invalid"),)))
+                return
+            labels = engine_label + (("department", department),)
+            self._count(("sizecharter_recommendations_total", labels))
+            self._count(("sizecharter_body_shapes_total", labels + (("body_shape", result.body_shape or "none"),)))
+            if result.recommended_size == "No exact match found":
+                self._count(("sizecharter_no_match_total", labels))
+            if getattr(result, "fallback", False):
+                self._count(("sizecharter_fallbacks_total", labels))
+            if result.health_warning:
+                self._count(("sizecharter_health_warnings_total", labels))
+
+    def _count(self, key, amount=1):
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def _observe(self, key, value):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def render(self, extra=()):
+        """
+        The Prometheus text exposition of every series.
+
+        extra is an iterable of (name, kind, labels, value) series to append,
+        e.g. from cache_series.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.HELP:
+                    lines.append(f"# HELP {name} {self.HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, kind, labels, value in extra:
+            header(name, kind)
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def cache_series(cache, prefix="sizecharter_cache"):
+    """
+    A RecommendationCache's stats as extra series for SizingMetrics.render.
+    """
+    if cache is None:
+        return []
+    stats = cache.stats()
+    series = [(f"{prefix}_entries", "gauge", (), stats["size"])]
+    for name in ("hits", "misses", "evictions", "expirations", "invalidations"):
+        series.append((f"{prefix}_{name}_total", "counter", (), stats[name]))
+    return series
@@ -0,0 +1,119 @@
+"""
+Micro-batching and request coalescing for the ASGI server.
+
+Under burst load many /api/size requests arrive within a few milliseconds of
+each other. A MicroBatcher collects them for up to max_delay seconds or
+max_batch distinct requests, whichever comes first. It then sizes the whole
+batch with one vectorized pass per department on the sizing pool
+(sizecharter_batch.batch_recommendations) and hands each request its result.
+Identical requests in flight at the same time are coalesced: they share one
+computation and one result object.
+
+Results equal those of get_size_recommendation, and go through the charter's
+cache and metrics as usual. A request waits at most max_delay longer than
+it would alone, plus its share of the batch's sizing time. Each row still
+gets a full result object and JSON encoding, so the vectorized pass alone
+does not raise throughput measurably (see sizecharter_bench's asgi and
+asgi_batched). The gain comes from coalescing identical requests:
+
+    app = SizingApp(batch_size=64, batch_delay=0.002)
+"""
+import asyncio
+
+from sizecharter_batch import batch_recommendations
+from sizecharter_index import MEASUREMENT_FIELDS
+from sizecharter_result import SizeRecommendation
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests on an event loop and sizes them in batches.
+
+    charter    the charter to size with, on its current chart
+    max_batch  distinct requests that trigger a batch at once
+    max_delay  seconds the first request of a batch waits for others
+    executor   where batches are sized (default: the loop's default executor)
+
+    All methods must be called from the event loop's thread.
+    """
+
+    def __init__(self, charter, max_batch=64, max_delay=0.002, executor=None):
+        self.charter = charter
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.executor = executor
+        self.requests = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.rows = 0
+        # request key -> future of its result, from submission until delivery
+        self._inflight = {}
+        # keys of the batch being collected
+        self._batch = []
+        self._timer = None
+
+    async def recommend(self, kwargs):
+        """
+        The get_size_recommendation result for request kwargs (without a "chart").
+        """
+        key = (kwargs["gender"], tuple(kwargs[name] for name in MEASUREMENT_FIELDS),
+               kwargs["abdomen_shape"], kwargs["hip_shape"])
+        self.requests += 1
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._inflight[key] = loop.create_future()
+            self._batch.append(key)
+            if len(self._batch) >= self.max_batch:
+                self.flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_delay, self.flush)
+        else:
+            self.coalesced += 1
+        # A request that times out must not cancel the result others share
+        return await asyncio.shield(future)
+
+    def flush(self):
+        """
+        Start sizing the requests collected so far.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        keys, self._batch = self._batch, []
+        if not keys:
+            return
+        self.batches += 1
+        self.rows += len(keys)
+        job = asyncio.get_running_loop().run_in_executor(self.executor, self._size, keys)
+        job.add_done_callback(lambda done: self._deliver(keys, done))
+
+    def _size(self, keys):
+        # Runs on the sizing pool; results are encoded there too, so the loop only sends bytes
+        results = batch_recommendations(self.charter, keys)
+        for result in results:
+            if isinstance(result, SizeRecommendation):
+                result.to_json_bytes()
+        return results
+
+    def _deliver(self, keys, done):
+        error = done.exception() if not done.cancelled() else asyncio.CancelledError()
+        results = done.result() if error is None else None
+        for i, key in enumerate(keys):
+            future = self._inflight.pop(key)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(results[i])
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+            "rows": self.rows,
+            "mean_batch": self.rows / self.batches if self.batches else None,
+            "pending": len(self._batch),
+        }
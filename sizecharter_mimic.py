@@ -1,54 +1,46 @@
-import json
-
-class SizeCharterMimic:
-    def __init__(self):
-        self.sizing_rules = {
-            "womens": {
-                "XS": {"chest": (78, 83), "waist": (60, 65), "hips": (86, 91), "shoulders": (36, 38), "neck": (30, 32), "thigh": (48, 52), "calf": (32, 34)},
-                "S":  {"chest": (84, 89), "waist": (66, 71), "hips": (92, 97), "shoulders": (39, 41), "neck": (33, 34), "thigh": (53, 57), "calf": (35, 37)},
-                "M":  {"chest": (90, 95), "waist": (72, 77), "hips": (98, 103), "shoulders": (42, 44), "neck": (35, 36), "thigh": (58, 62), "calf": (38, 40)},
-                "L":  {"chest": (96, 102), "waist": (78, 84), "hips": (104, 110), "shoulders": (45, 47), "neck": (37, 39), "thigh": (63, 67), "calf": (41, 43)},
-                "XL": {"chest": (103, 109), "waist": (85, 91), "hips": (111, 117), "shoulders": (48, 50), "neck": (40, 41), "thigh": (68, 72), "calf": (44, 46)},
-                "XXL":{"chest": (110, 116), "waist": (92, 98), "hips": (118, 124), "shoulders": (51, 53), "neck": (42, 44), "thigh": (73, 77), "calf": (47, 49)},
-            },
-            "mens": {
-                "XS": {"chest": (81, 86), "waist": (66, 71), "inseam": (76, 79), "shoulders": (42, 44), "neck": (36, 37), "thigh": (54, 58), "calf": (34, 36)},
-                "S":  {"chest": (87, 92), "waist": (72, 77), "inseam": (80, 83), "shoulders": (45, 47), "neck": (38, 39), "thigh": (59, 63), "calf": (37, 39)},
-                "M":  {"chest": (93, 98), "waist": (78, 83), "inseam": (84, 87), "shoulders": (48, 50), "neck": (40, 41), "thigh": (64, 68), "calf": (40, 42)},
-                "L":  {"chest": (99, 104), "waist": (84, 89), "inseam": (88, 91), "shoulders": (51, 53), "neck": (42, 43), "thigh": (69, 73), "calf": (43, 45)},
-                "XL": {"chest": (105, 110), "waist": (90, 95), "inseam": (92, 95), "shoulders": (54, 56), "neck": (44, 46), "thigh": (74, 78), "calf": (46, 48)},
-                "XXL":{"chest": (111, 116), "waist": (96, 101), "inseam": (96, 99), "shoulders": (57, 59), "neck": (47, 48), "thigh": (79, 83), "calf": (49, 51)},
-            },
-            "maternity": {
-                "S":  {"chest": (84, 89), "waist": (70, 75), "hips": (92, 97), "shoulders": (38, 40), "neck": (31, 33), "thigh": (50, 54), "calf": (33, 35)},
-                "M":  {"chest": (90, 95), "waist": (76, 81), "hips": (98, 103), "shoulders": (41, 43), "neck": (34, 35), "thigh": (55, 59), "calf": (36, 38)},
-                "L":  {"chest": (96, 102), "waist": (82, 88), "hips": (104, 110), "shoulders": (44, 46), "neck": (36, 38), "thigh": (60, 64), "calf": (39, 41)},
-            }
-        }
+from sizecharter_charts import ChartFile, default_chart_path
+from sizecharter_index import MEASUREMENT_FIELDS, ChartTables, field_weights
+from sizecharter_result import SizeRecommendation, explain_fields, fields_outside, pack_measurements
+
+class SizeCharterMimic(ChartTables):
+    # Which vectorized engine sizecharter_batch runs for this class
+    BATCH_ENGINE = "mimic"
+
+    # Consistency warnings, in the bit order used by get_size_recommendations_batch
+    WARNING_MESSAGES = (
+        "Chest measurement is significantly smaller than waist. Check input or consider a looser fit.",
+        "Waist measurement is unusually larger than hips. Verify measurements.",
+        "Chest and hips measurements differ greatly, which is uncommon.",
+    )
+
+    # Realistic human ranges for sanity check (cm)
+    SANE_RANGES = {
+        "chest": (40, 180),
+        "waist": (40, 150),
+        "hips": (40, 170),
+        "inseam": (30, 120),
+        "shoulders": (30, 70),
+        "neck": (25, 50),
+        "thigh": (30, 80),
+        "calf": (20, 60)
+    }
 
-        self.morphology_adjustments = {
-            "womens": {
-                "hourglass": {"hips": +2, "waist": -1},
-                "pear": {"hips": +3, "waist": 0},
-                "apple": {"waist": +3, "hips": -1},
-                "rectangle": {"waist": +1, "hips": 0},
-                "inverted_triangle": {"chest": +2, "waist": 0},
-                "spoon": {"hips": +3, "waist": +1},
-                "diamond": {"waist": +2, "hips": 0}
-            },
-            "mens": {
-                "triangle": {"chest": +2, "waist": -1},
-                "rectangle": {},
-                "inverted_triangle": {"chest": +2},
-                "oval": {"waist": +3},
-                "trapezoid": {}
-            },
-            "maternity": {
-                "prominent": {"waist": +4, "hips": +1},
-                "soft": {"waist": +2},
-                "flat": {}
-            }
-        }
+    # Per-field weights of the closest-size fallback's squared distance
+    FALLBACK_WEIGHTS = {"chest": 1.0, "waist": 1.0, "hips": 1.0}
+
+    # Fields a size's ranges must all contain (inseam is not matched)
+    MATCH_FIELDS = ("chest", "waist", "hips", "shoulders", "neck", "thigh", "calf")
+
+    def __init__(self, cache=None, metrics=None, charts=None, fallback_weights=None):
+        # Optional RecommendationCache in front of get_size_recommendation
+        self.cache = cache
+        # Optional SizingMetrics recording stage timings and outcome counters
+        self.metrics = metrics
+        # Chart source: a Chart, or a ChartFile that hot-reloads (default: charts/mimic.json,
+        # loaded on first use)
+        self.charts = charts if charts is not None else ChartFile(default_chart_path("mimic"), lazy=True)
+        # Weights of the closest-size fallback used when no size matches every field
+        self.fallback_weights = field_weights(fallback_weights or self.FALLBACK_WEIGHTS)
 
     def _infer_body_shape(self, gender, chest, waist, hips, shoulders=None, neck=None, thigh=None, calf=None):
         """
@@ -89,7 +81,8 @@ class SizeCharterMimic:
 
         return None
 
-    def _dominant_measurements(self, chest, waist, hips, shoulders, neck, thigh, calf):
+    @staticmethod
+    def _dominant_measurements(chest, waist, hips, shoulders, neck, thigh, calf):
         """
         Detect which measurements dominate size decision.
         Returns list of dominant measurement names.
@@ -110,33 +103,48 @@ class SizeCharterMimic:
     def _check_measurement_consistency(self, chest, waist, hips):
         """
         Provide warnings for common mismatches or unusual proportions.
+        Returns a bitmask over WARNING_MESSAGES.
         """
-        warnings = []
+        warnings = 0
         if chest and waist and chest < waist * 0.85:
-            warnings.append("Chest measurement is significantly smaller than waist. Check input or consider a looser fit.")
+            warnings |= 1
         if waist and hips and waist > hips * 1.1:
-            warnings.append("Waist measurement is unusually larger than hips. Verify measurements.")
+            warnings |= 2
         if chest and hips and abs(chest - hips) > 20:
-            warnings.append("Chest and hips measurements differ greatly, which is uncommon.")
+            warnings |= 4
         return warnings
 
     def get_size_recommendation(self, gender, chest=None, waist=None, hips=None, inseam=None,
                                 shoulders=None, neck=None, thigh=None, calf=None,
-                                abdomen_shape=None, hip_shape=None):
+                                abdomen_shape=None, hip_shape=None, chart=None):
+        # chart sizes against a specific Chart (e.g. from a ChartRegistry) instead of self.chart
+        if chart is None:
+            chart = self.chart
+        if self.metrics is not None:
+            return self.metrics.measure(
+                self, chart, gender, (chest, waist, hips, inseam, shoulders, neck, thigh, calf), abdomen_shape, hip_shape)
+        if self.cache is not None:
+            return self._cached_recommendation(
+                chart, gender, (chest, waist, hips, inseam, shoulders, neck, thigh, calf), abdomen_shape, hip_shape)
+        return self._recommend(chart, gender, chest, waist, hips, inseam, shoulders, neck, thigh, calf,
+                               abdomen_shape=abdomen_shape, hip_shape=hip_shape)
+
+    def _recommend(self, chart, gender, chest=None, waist=None, hips=None, inseam=None,
+                   shoulders=None, neck=None, thigh=None, calf=None,
+                   abdomen_shape=None, hip_shape=None, probe=None):
+        # chart is the Chart snapshot to size against; probe, if given, is a
+        # sizecharter_metrics.StageTimer timing each stage
         gender = gender.lower()
-        if gender not in self.sizing_rules:
+        if gender not in chart.sizing_rules:
             return {"error": "Invalid gender/department. Choose from 'womens', 'mens', or 'maternity'."}
 
         # Infer body shape intelligently with more parameters
         body_shape = self._infer_body_shape(gender, chest, waist, hips, shoulders, neck, thigh, calf)
+        if probe is not None:
+            probe.lap("shape_inference")
 
         # Compose adjustments from morphology (body_shape + abdomen_shape + hip_shape)
-        adjustments = {}
-
-        for morph in [body_shape, abdomen_shape, hip_shape]:
-            if morph and morph in self.morphology_adjustments.get(gender, {}):
-                for key, val in self.morphology_adjustments[gender][morph].items():
-                    adjustments[key] = adjustments.get(key, 0) + val
+        adjustments = chart.adjustments_for(gender, body_shape, abdomen_shape, hip_shape)
 
         # Apply adjustments to measurements
         adj_chest = chest + adjustments.get("chest", 0) if chest is not None else None
@@ -146,9 +154,11 @@ class SizeCharterMimic:
         adj_neck = neck
         adj_thigh = thigh
         adj_calf = calf
+        if probe is not None:
+            probe.lap("adjustment")
 
         # Select sizing rules by gender
-        rules = self.sizing_rules[gender]
+        rules = chart.sizing_rules[gender]
         matching_sizes = []
 
         # Match sizes based on adjusted measurements (chest, waist, hips + shoulders/neck/thigh/calf optionally)
@@ -171,64 +181,150 @@ class SizeCharterMimic:
                 in_range("calf", adj_calf)):
 
                 matching_sizes.append(size)
+        if probe is not None:
+            probe.lap("range_matching")
 
         # Choose best size
+        fallback = not matching_sizes
+        nearest = None
         if matching_sizes:
             order = list(rules.keys())
             matching_sizes.sort(key=lambda x: order.index(x))
             recommended_size = matching_sizes[0]
         else:
-            # Try to find closest size by minimal absolute distance on key measurements
-            def distance(size):
-                limits = rules[size]
-                dist = 0
-                for key, val in [("chest", adj_chest), ("waist", adj_waist), ("hips", adj_hips)]:
-                    if val is not None and key in limits:
-                        low, high = limits[key]
-                        if val < low:
-                            dist += (low - val)**2
-                        elif val > high:
-                            dist += (val - high)**2
-                return dist
-
-            candidates = sorted(rules.keys(), key=distance)
-            recommended_size = candidates[0] if candidates else "No match found"
-
-        # Health & consistency check
-        health_status = "healthy"
-        health_msgs = []
-
-        # Realistic human ranges for sanity check (cm)
-        sane_ranges = {
-            "chest": (40, 180),
-            "waist": (40, 150),
-            "hips": (40, 170),
-            "inseam": (30, 120),
-            "shoulders": (30, 70),
-            "neck": (25, 50),
-            "thigh": (30, 80),
-            "calf": (20, 60)
-        }
-
-        for key, val in [("chest", chest), ("waist", waist), ("hips", hips), ("inseam", inseam),
-                         ("shoulders", shoulders), ("neck", neck), ("thigh", thigh), ("calf", calf)]:
+            # Closest size by weighted squared distance; with no weighted field present
+            # every size is equally close and the smallest one is used
+            nearest = chart.nearest_index(gender, self.fallback_weights).nearest(
+                (adj_chest, adj_waist, adj_hips, inseam, adj_shoulders, adj_neck, adj_thigh, adj_calf))
+            if nearest is not None:
+                recommended_size = nearest.size
+            else:
+                recommended_size = next(iter(rules), "No match found")
+            if probe is not None:
+                probe.lap("fallback_distance")
+
+        # Health & consistency check (bits over MEASUREMENT_FIELDS and WARNING_MESSAGES)
+        original = (chest, waist, hips, inseam, shoulders, neck, thigh, calf)
+        health = 0
+        for bit, (key, val) in enumerate(zip(MEASUREMENT_FIELDS, original)):
             if val is not None:
-                low, high = sane_ranges[key]
+                low, high = self.SANE_RANGES[key]
                 if val < low or val > high:
-                    health_status = "warning"
-                    health_msgs.append(f"{key.capitalize()} measurement ({val} cm) is outside typical human range ({low}-{high} cm).")
+                    health |= 1 << bit
+        warnings = self._check_measurement_consistency(chest, waist, hips)
+        if probe is not None:
+            probe.lap("health_checks")
+
+        # Final structured result; details and guidance are rendered on demand
+        result = MimicRecommendation(
+            recommended_size, gender, body_shape, abdomen_shape, hip_shape,
+            pack_measurements(original, (adj_chest, adj_waist, adj_hips, inseam, shoulders, neck, thigh, calf)),
+            adjustments, warnings, health, fallback, nearest)
+        if probe is not None:
+            probe.lap("result_building")
+        return result
+
+    def _explain(self, chart, result):
+        # The explanation of explain_size_recommendation, read off the compiled ranges
+        # with the result's own adjusted measurements
+        gender = result.gender
+        rules = chart.sizing_rules[gender]
+        department = chart.compiled[gender]
+        fields, _ = explain_fields(department, result.adjusted, self.MATCH_FIELDS)
+        if result.fallback:
+            limits = rules[result.recommended_size]
+            return result._explanation("closest_size", fields_outside(limits, result.adjusted, self.MATCH_FIELDS),
+                                       fields)
+        # The smallest size every field fits wins: the deciding fields rule out the size below it
+        rank = department.ranks[result.recommended_size]
+        deciding = fields_outside(rules[department.sizes[rank - 1]], result.adjusted, self.MATCH_FIELDS) if rank else []
+        return result._explanation("smallest_size_matching_all", deciding, fields)
+
+    def _result_from_batch(self, chart, gender, size, nearest, body_shape, abdomen_shape, hip_shape,
+                           measurements, warnings, health):
+        # The _recommend result for a row sized by sizecharter_batch.batch_recommendations: size is the
+        # matched size (None if none matched every field), nearest the fallback's NearestMatch
+        fallback = size is None
+        if fallback:
+            size = nearest.size if nearest is not None else next(iter(chart.sizing_rules[gender]), "No match found")
+        return MimicRecommendation(
+            size, gender, body_shape, abdomen_shape, hip_shape, measurements,
+            chart.adjustments_for(gender, body_shape, abdomen_shape, hip_shape), warnings, health, fallback, nearest)
+
+    def get_size_recommendations_batch(self, gender, measurements, abdomen_shape=None, hip_shape=None):
+        """
+        Vectorized get_size_recommendation for N shoppers of one department.
+
+        measurements is a mapping of field name to array, or an (N, 8) array in
+        MEASUREMENT_FIELDS order, with NaN meaning missing. abdomen_shape and
+        hip_shape are None, one shape for everyone, or one shape per shopper.
+
+        Returns a dict of arrays: "size" (ordinals into "sizes", -1 = no match),
+        "body_shape" (codes into "body_shapes", -1 = none), "warnings" (bitmask
+        over WARNING_MESSAGES) and "health" (bitmask over MEASUREMENT_FIELDS of
+        out-of-range measurements).
+        A boolean "fallback" array marks rows where no size matched every field
+        and the closest size by squared distance was used.
+        Requires NumPy.
+        """
+        from sizecharter_batch import charter_batch
+        return charter_batch(self, gender, measurements, abdomen_shape, hip_shape)
 
-        # Add consistency warnings
-        consistency_warnings = self._check_measurement_consistency(chest, waist, hips)
-        if consistency_warnings:
-            health_status = "warning"
-            health_msgs.extend(consistency_warnings)
+    def get_fit_sensitivity_batch(self, gender, measurements, abdomen_shape=None, hip_shape=None,
+                                  delta=1.0, variants=None):
+        """
+        How close N shoppers of one department sit to a size boundary, and how
+        their size moves with each (abdomen_shape, hip_shape) pair and with each
+        measurement moved by -delta and +delta cm, in one vectorized pass.
+
+        Arguments are as for get_size_recommendations_batch; variants is a
+        sequence of shape pairs (default: every pair of the department's
+        morphology shapes). See sizecharter_sensitivity.run_sensitivity for the
+        arrays returned.
+        Requires NumPy.
+        """
+        from sizecharter_sensitivity import charter_sensitivity
+        return charter_sensitivity(self, gender, measurements, abdomen_shape, hip_shape, delta, variants)
+
+
+class MimicRecommendation(SizeRecommendation):
+    """
+    SizeRecommendation rendered in SizeCharterMimic's details layout.
 
+    fallback is True when no size matched every field and the closest size by
+    squared distance was recommended.
+    """
+    __slots__ = ("fallback",)
+
+    def __init__(self, recommended_size, gender, body_shape, abdomen_shape, hip_shape,
+                 measurements, adjustments, warnings=0, health=0, fallback=False, nearest=None):
+        super().__init__(recommended_size, gender, body_shape, abdomen_shape, hip_shape,
+                         measurements, adjustments, warnings, health, nearest)
+        self.fallback = fallback
+
+    @property
+    def health_warning(self):
+        # Consistency warnings are reported under health as well
+        return bool(self.health or self.warnings)
+
+    def _build_details(self):
+        original = self._original_measurements()
+
+        health_msgs = []
+        for key in self._flagged_fields():
+            low, high = SizeCharterMimic.SANE_RANGES[key]
+            health_msgs.append(f"{key.capitalize()} measurement ({original[key]} cm) is outside typical human range ({low}-{high} cm).")
+        # Add consistency warnings
+        health_msgs.extend(message for bit, message in enumerate(SizeCharterMimic.WARNING_MESSAGES)
+                           if self.warnings >> bit & 1)
+        health_status = "warning" if health_msgs else "healthy"
         if not health_msgs:
             health_msgs.append("All measurements within typical range.")
 
         # Determine dominant measurements
-        dominant_measures = self._dominant_measurements(chest, waist, hips, shoulders, neck, thigh, calf)
+        dominant_measures = SizeCharterMimic._dominant_measurements(
+            original["chest"], original["waist"], original["hips"], original["shoulders"],
+            original["neck"], original["thigh"], original["calf"])
 
         # Compose detailed guidance messages
         guidance = []
@@ -238,43 +334,24 @@ class SizeCharterMimic:
         if health_status == "warning":
             guidance.append("⚠️ Please double-check measurements or consider consulting sizing charts.")
 
-        # Final structured result
-        return {
-            "recommended_size": recommended_size,
-            "details": {
-                "gender": gender,
-                "original_measurements": {
-                    "chest": chest,
-                    "waist": waist,
-                    "hips": hips,
-                    "inseam": inseam,
-                    "shoulders": shoulders,
-                    "neck": neck,
-                    "thigh": thigh,
-                    "calf": calf,
-                },
-                "adjusted_measurements": {
-                    "chest": round(adj_chest, 1) if adj_chest is not None else None,
-                    "waist": round(adj_waist, 1) if adj_waist is not None else None,
-                    "hips": round(adj_hips, 1) if adj_hips is not None else None,
-                    "inseam": inseam,
-                    "shoulders": shoulders,
-                    "neck": neck,
-                    "thigh": thigh,
-                    "calf": calf,
-                },
-                "body_shape": body_shape,
-                "abdomen_shape": abdomen_shape,
-                "hip_shape": hip_shape,
-                "morphology_adjustments": adjustments,
-                "dominant_measurements": dominant_measures,
-                "health": {
-                    "status": health_status,
-                    "messages": health_msgs
-                },
-                "guidance": guidance,
-            }
+        details = {
+            "gender": self.gender,
+            "original_measurements": original,
+            "adjusted_measurements": self._adjusted_measurements(),
+            "body_shape": self.body_shape,
+            "abdomen_shape": self.abdomen_shape,
+            "hip_shape": self.hip_shape,
+            "morphology_adjustments": dict(self.adjustments),
+            "dominant_measurements": dominant_measures,
+            "health": {
+                "status": health_status,
+                "messages": health_msgs
+            },
+            "guidance": guidance,
         }
+        if self.nearest is not None:
+            details["closest_sizes"] = self._nearest_details()
+        return details
 
 
 if __name__ == '__main__':
@@ -295,4 +372,4 @@ if __name__ == '__main__':
     }
 
     result = mimic.get_size_recommendation(**example_input)
-    print(json.dumps(result, indent=2))
+    print(result.to_json(indent=2))
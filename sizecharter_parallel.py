@@ -0,0 +1,296 @@
+"""
+Multi-process batch sizing of NDJSON files.
+
+ParallelSizer splits an NDJSON input (one /api/size record per line) into
+blocks of whole lines and sizes them on a process pool with the vectorized
+batch path. Results come back as NDJSON in input order:
+
+    {"index": 0, "id": "c-17", "recommended_size": "M", "body_shape": "pear",
+     "health": "healthy", "warnings": []}
+
+"index" is the 0-based line number in the input and "id" is echoed when the
+record has one. A line that cannot be sized yields {"index": ..., "error": ...}.
+
+Workers never receive the charter. Its compiled batch tables are copied once
+into a shared memory block, and each worker maps them as zero-copy NumPy
+views. Workers parse, size and encode their own blocks, so the parent only
+moves bytes. At most two blocks per worker are in flight, which keeps memory
+bounded whatever the input size.
+
+    with ParallelSizer(SizeCharterMimic(), processes=8) as runner:
+        runner.run("shoppers.ndjson", "sizes.ndjson")
+"""
+import json
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sizecharter_batch import INVALID_GENDER, batch_tables, run_batch
+from sizecharter_index import MEASUREMENT_FIELDS
+from sizecharter_request import parse_size_request
+
+# Where one array of the shared tables lives inside the shared memory block
+SharedArray = namedtuple("SharedArray", "offset dtype shape")
+
+DEFAULT_BLOCK_BYTES = 1 << 20
+
+CHART_NOT_SUPPORTED = "Per-record charts are not supported here; size each chart's records separately."
+
+_worker_shm = None
+_worker_tables = None
+
+
+def share_tables(tables):
+    """
+    Copy every array in a batch tables structure into one shared memory block.
+
+    Returns (shm, descriptor): the descriptor is the same structure with each
+    array replaced by a SharedArray, small enough to pass to worker processes.
+    The caller owns shm and must close() and unlink() it.
+    """
+    arrays = []
+
+    def collect(obj):
+        if isinstance(obj, np.ndarray):
+            arrays.append(obj)
+            return len(arrays) - 1
+        if isinstance(obj, dict):
+            return {key: collect(value) for key, value in obj.items()}
+        return obj
+
+    layout = collect(tables)
+    offsets = []
+    total = 0
+    for array in arrays:
+        total = (total + 7) & ~7  # keep every array 8-byte aligned
+        offsets.append(total)
+        total += array.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    for array, offset in zip(arrays, offsets):
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf, offset=offset)[...] = array
+
+    def describe(obj):
+        if isinstance(obj, dict):
+            return {key: describe(value) for key, value in obj.items()}
+        if isinstance(obj, int) and not isinstance(obj, bool):
+            array = arrays[obj]
+            return SharedArray(offsets[obj], array.dtype.str, array.shape)
+        return obj
+
+    return shm, describe(layout)
+
+
+def attach_tables(descriptor, buffer):
+    """
+    Rebuild batch tables from a share_tables descriptor as read-only views into buffer.
+    """
+    if isinstance(descriptor, SharedArray):
+        view = np.ndarray(descriptor.shape, np.dtype(descriptor.dtype), buffer=buffer, offset=descriptor.offset)
+        view.flags.writeable = False
+        return view
+    if isinstance(descriptor, dict):
+        return {key: attach_tables(value, buffer) for key, value in descriptor.items()}
+    return descriptor
+
+
+def _init_worker(shm_name, descriptor):
+    global _worker_shm, _worker_tables
+    # Pool workers share the parent's resource tracker, so attaching here
+    # registers nothing new; the parent unlinks the block in close()
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_tables = attach_tables(descriptor, _worker_shm.buf)
+
+
+def _apply(task):
+    function, args = task
+    return function(_worker_tables, *args)
+
+
+def size_lines(tables, start, lines):
+    """
+    Size NDJSON lines against batch tables; returns the NDJSON output text.
+
+    start is the input line number of lines[0]. Blank lines produce no output.
+    """
+    records = []
+    for line in lines:
+        if not line.strip():
+            records.append(None)
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError as exc:
+            records.append(f"Malformed JSON: {exc}")
+    return "".join(json.dumps(record) + "\n" for record in size_records(tables, start, records)
+                   if record is not None)
+
+
+def size_records(tables, start, records):
+    """
+    Size decoded /api/size records against batch tables.
+
+    records holds decoded bodies, None for blank input (no output) or an
+    error message for input that could not be decoded. Returns one output
+    dict per record (None for blanks), shaped as described above; start is
+    the index of records[0].
+    """
+    results = [None] * len(records)
+    groups = {}
+    for pos, data in enumerate(records):
+        if data is None:
+            continue
+        if isinstance(data, str):
+            results[pos] = {"index": start + pos, "error": data}
+            continue
+        kwargs, error = parse_size_request(data)
+        if error is None and "chart" in kwargs:
+            error = CHART_NOT_SUPPORTED
+        elif error is None and kwargs["gender"].lower() not in tables["departments"]:
+            error = INVALID_GENDER
+        record = {"index": start + pos}
+        if type(data) is dict and "id" in data:
+            record["id"] = data["id"]
+        results[pos] = record
+        if error:
+            record["error"] = error
+            continue
+        group = groups.setdefault(kwargs["gender"].lower(), ([], [], [], []))
+        group[0].append(pos)
+        group[1].append([np.nan if kwargs[name] is None else kwargs[name] for name in MEASUREMENT_FIELDS])
+        group[2].append(kwargs["abdomen_shape"])
+        group[3].append(kwargs["hip_shape"])
+
+    messages = tables["warning_messages"]
+    tuned = tables["engine"] == "tuned"
+    for gender, (positions, rows, abdomen_shapes, hip_shapes) in groups.items():
+        result = run_batch(tables, gender, np.array(rows, dtype=np.float64), abdomen_shapes, hip_shapes)
+        sizes, names = result["sizes"], result["body_shapes"]
+        size, body_shape = result["size"].tolist(), result["body_shape"].tolist()
+        warnings, health = result["warnings"].tolist(), result["health"].tolist()
+        for k, pos in enumerate(positions):
+            record = results[pos]
+            record["recommended_size"] = sizes[size[k]] if size[k] >= 0 else "No exact match found"
+            record["body_shape"] = names[body_shape[k]] if body_shape[k] >= 0 else None
+            # Mimic reports its consistency warnings through the health status
+            record["health"] = "warning" if health[k] or (warnings[k] and not tuned) else "healthy"
+            record["warnings"] = [message for bit, message in enumerate(messages) if warnings[k] >> bit & 1]
+
+    return results
+
+
+def iter_blocks(stream, block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Yield (first line number, bytes) blocks of whole lines read from a binary stream.
+    """
+    start = 0
+    while True:
+        block = stream.read(block_bytes)
+        if not block:
+            return
+        if not block.endswith(b"\n"):
+            block += stream.readline()
+        if block.endswith(b"\n"):
+            block = block[:-1]
+        yield start, block
+        start += block.count(b"\n") + 1
+
+
+class ParallelSizer:
+    """
+    Process pool that sizes NDJSON blocks against one charter's shared tables.
+
+    charter      a SizeCharterTuned or SizeCharterMimic
+    processes    pool size (default: all cores)
+    block_bytes  approximate input bytes per task
+    """
+
+    def __init__(self, charter, processes=None, block_bytes=DEFAULT_BLOCK_BYTES):
+        self.processes = processes or os.cpu_count() or 1
+        self.block_bytes = block_bytes
+        # map() generators started and not yet finished or closed
+        self._open_maps = 0
+        self._shm, descriptor = share_tables(batch_tables(charter))
+        self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                          initargs=(self._shm.name, descriptor))
+
+    def size_stream(self, stream):
+        """
+        Size every line of a binary NDJSON stream, yielding output text blocks in input order.
+        """
+        return self.map(size_lines, ((start, block.split(b"\n")) for start, block in
+                                     iter_blocks(stream, self.block_bytes)))
+
+    def map(self, function, tasks):
+        """
+        Yield function(tables, *args) for each args tuple of tasks, computed on
+        the pool in input order, where tables are the workers' shared tables.
+
+        function must be a module-level function, so workers can import it.
+        At most two tasks per worker are in flight at a time.
+        """
+        permits = threading.BoundedSemaphore(2 * self.processes)
+        stopped = threading.Event()
+
+        def bounded():
+            for args in tasks:
+                permits.acquire()
+                if stopped.is_set():
+                    return
+                yield function, args
+
+        self._open_maps += 1
+        try:
+            for result in self._pool.imap(_apply, bounded()):
+                permits.release()
+                yield result
+        finally:
+            # The caller may stop early: wake the pool's task handler if it waits
+            # for a permit, so it stops submitting and close() can join it
+            self._open_maps -= 1
+            stopped.set()
+            try:
+                permits.release()
+            except ValueError:
+                pass
+
+    def run(self, input_path, output_path):
+        """
+        Size an NDJSON file into an NDJSON results file.
+        """
+        with open(input_path, "rb") as source, open(output_path, "w", encoding="utf-8") as target:
+            for text in self.size_stream(source):
+                target.write(text)
+
+    def close(self):
+        if self._open_maps:
+            # A map() still open holds the task handler on a permit; joining would wait forever
+            self.terminate()
+            return
+        self._pool.close()
+        self._pool.join()
+        self._release()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+        self._release()
+
+    def _release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
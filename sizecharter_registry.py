@@ -0,0 +1,168 @@
+"""
+Registry of many size charts addressed by chart ID.
+
+Each brand (or brand x department) chart is a chart file in one directory,
+in the format described in sizecharter_charts; its chart ID is the path below
+that directory without ".json", e.g. "acme/womens" for acme/womens.json. The
+registry loads and compiles a chart the first time its ID is asked for, keeps
+recently used charts in memory and evicts the least recently used ones once
+their estimated footprint exceeds memory_budget. Loaded charts hot-reload
+like any ChartFile.
+
+    registry = ChartRegistry("/srv/charts", memory_budget=256 << 20)
+    charter.get_size_recommendation("womens", chest=88, chart=registry.get("acme/womens"))
+
+Results cached by a charter keep a reference to their chart, so an evicted
+chart's memory is only released once those entries leave the cache too.
+"""
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from sizecharter_charts import CHART_DIR, ChartFile
+
+# Path segments of letters, digits, "_", "-" and "."; a segment cannot start with "."
+CHART_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*(/[A-Za-z0-9][A-Za-z0-9_.-]*)*")
+
+
+def chart_footprint(chart):
+    """
+    Estimated bytes held by a Chart: its tables, compiled index and memo.
+    """
+    seen = set()
+    stack = [chart]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, int, float, type(None))):
+            continue
+        if hasattr(obj, "items"):
+            for key, value in obj.items():
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return total
+
+
+class ChartRegistry:
+    """
+    Lazily loaded, LRU-evicted set of charts read from a directory.
+
+    directory      root of the chart files (default: the bundled charts/)
+    memory_budget  estimated bytes of compiled charts to keep loaded
+    poll_interval  seconds between change checks of a loaded chart file,
+                   or None to never reload
+
+    At least one chart always stays loaded, however large it is.
+    """
+
+    def __init__(self, directory=CHART_DIR, memory_budget=64 << 20, poll_interval=2.0):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.footprint = 0
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        # chart ID -> [ChartFile, Chart the footprint was measured on, footprint]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path_for(self, chart_id):
+        """
+        The file a chart ID maps to; raises KeyError for a malformed ID.
+        """
+        if not isinstance(chart_id, str) or not CHART_ID.fullmatch(chart_id):
+            raise KeyError(f"Invalid chart ID: {chart_id!r}")
+        return os.path.join(self.directory, *chart_id.split("/")) + ".json"
+
+    def get(self, chart_id):
+        """
+        The current Chart for chart_id, loading it on first use.
+
+        Raises KeyError if there is no such chart and ValueError if its file is invalid.
+        """
+        with self._lock:
+            entry = self._entries.get(chart_id)
+            if entry is not None:
+                self._entries.move_to_end(chart_id)
+                self.hits += 1
+
+        if entry is None:
+            path = self.path_for(chart_id)
+            try:
+                source = ChartFile(path, poll_interval=self.poll_interval)
+            except FileNotFoundError:
+                raise KeyError(f"Unknown chart: {chart_id}") from None
+            chart = source.current()
+            entry = [source, chart, chart_footprint(chart)]
+            with self._lock:
+                if chart_id not in self._entries:
+                    self._entries[chart_id] = entry
+                    self.footprint += entry[2]
+                    self.loads += 1
+                    self._evict()
+                entry = self._entries.get(chart_id, entry)
+
+        chart = entry[0].current()
+        if chart is not entry[1]:
+            # The file was reloaded: re-measure the new chart
+            size = chart_footprint(chart)
+            with self._lock:
+                if self._entries.get(chart_id) is entry:
+                    self.footprint += size - entry[2]
+                    entry[1], entry[2] = chart, size
+                    self._evict()
+        return chart
+
+    def _evict(self):
+        while self.footprint > self.memory_budget and len(self._entries) > 1:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.footprint -= size
+            self.evictions += 1
+
+    def __contains__(self, chart_id):
+        with self._lock:
+            return chart_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.footprint = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "charts": len(self._entries),
+                "footprint": self.footprint,
+                "memory_budget": self.memory_budget,
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+            }
+
+
+def resolve_chart(registry, kwargs):
+    """
+    Replace a chart ID in parsed request kwargs with its Chart from registry.
+
+    Raises KeyError for an unknown chart and ValueError for an invalid chart file.
+    """
+    chart_id = kwargs.get("chart")
+    if chart_id is not None:
+        kwargs["chart"] = registry.get(chart_id)
+    return kwargs
@@ -0,0 +1,271 @@
+"""
+Decoding of sizing requests, shared by the HTTP front ends and batch tools.
+
+SIZE_REQUEST validates /api/size bodies straight into get_size_recommendation
+keyword arguments, reporting every invalid field; parse_size_request is its
+single-message form for record-at-a-time callers. iter_records
+incrementally decodes a stream of such bodies, given either as NDJSON or as
+one JSON array, without holding more than one record in memory.
+"""
+import codecs
+import json
+import re
+
+from sizecharter_index import MEASUREMENT_FIELDS
+from sizecharter_json import loads
+
+# Largest single streamed record accepted, and the read size used to stream records
+MAX_RECORD_BYTES = 1 << 20
+STREAM_CHUNK_BYTES = 1 << 16
+
+# Insignificant whitespace between JSON tokens
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def to_float_or_none(val):
+    if val is None or val == '':
+        return None
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        return None
+
+
+def field_error(field, message):
+    """
+    One structured validation error; field is None for errors about the whole body.
+    """
+    return {"field": field, "message": message}
+
+
+def error_body(errors):
+    """
+    Error response body: the first message under "error", as before, plus every error under "errors".
+    """
+    return {"error": errors[0]["message"], "errors": errors}
+
+
+class RequestSchema:
+    """
+    Compiled validator/decoder for /api/size request bodies.
+
+    The schema is a sequence of (field, kind) pairs, in the order the fields
+    appear in the decoded keyword arguments:
+
+        "department"   required non-empty string
+        "measurement"  optional finite number; numeric strings are accepted
+                       and null or "" mean missing
+        "name"         optional string
+
+    Optional "name" fields listed in omit_missing are left out of the keyword
+    arguments when absent instead of being passed as None. Unknown fields are
+    ignored. decode() checks every field and reports all problems at once.
+    """
+
+    def __init__(self, schema, omit_missing=()):
+        self.schema = tuple(schema)
+        kinds = {"department", "measurement", "name"}
+        unknown = [kind for _, kind in self.schema if kind not in kinds]
+        if unknown:
+            raise ValueError(f"Unknown field kinds: {', '.join(unknown)}")
+        self._department = tuple(name for name, kind in self.schema if kind == "department")
+        self._measurements = tuple(name for name, kind in self.schema if kind == "measurement")
+        self._names = tuple((name, name in omit_missing) for name, kind in self.schema if kind == "name")
+
+    def decode(self, data):
+        """
+        Validate one decoded body. Returns (kwargs, None), or (None, list of field_error dicts).
+        """
+        if type(data) is not dict:
+            return None, [field_error(None, "Request body must be a JSON object")]
+        get = data.get
+        errors = []
+        kwargs = {}
+
+        for name in self._department:
+            value = get(name)
+            if not value or type(value) is not str:
+                errors.append(field_error(name, f"{name.capitalize()} is required"))
+            kwargs[name] = value
+
+        for name in self._measurements:
+            value = get(name)
+            if value is None:
+                kwargs[name] = None
+                continue
+            kind = type(value)
+            # type() rather than isinstance() so booleans are rejected
+            if kind is float or kind is int or kind is str:
+                if kind is str:
+                    value = value.strip()
+                    if not value:
+                        kwargs[name] = None
+                        continue
+                try:
+                    number = float(value)
+                except (ValueError, OverflowError):
+                    number = None
+                # Rejects NaN and infinities, which x - x does not map to 0
+                if number is not None and number - number == 0:
+                    kwargs[name] = number
+                    continue
+            errors.append(field_error(name, f"{name} must be a number"))
+
+        for name, omit in self._names:
+            value = get(name)
+            if value is None:
+                if not omit:
+                    kwargs[name] = None
+            elif type(value) is str:
+                kwargs[name] = value
+            else:
+                errors.append(field_error(name, f"{name} must be a string"))
+
+        if errors:
+            return None, errors
+        return kwargs, None
+
+    def loads(self, body):
+        """
+        Decode and validate a raw JSON body (bytes or str), as decode() does.
+        """
+        data, errors = load_body(body)
+        if errors:
+            return None, errors
+        return self.decode(data)
+
+
+def load_body(body):
+    """
+    Parse a raw JSON body (bytes or str). Returns (data, None), or (None, list of field_error dicts).
+    """
+    try:
+        return loads(body), None
+    except ValueError as exc:
+        return None, [field_error(None, f"Malformed JSON: {exc}")]
+
+
+# The /api/size body: get_size_recommendation's arguments, plus an optional chart ID
+SIZE_REQUEST = RequestSchema(
+    [("gender", "department")]
+    + [(name, "measurement") for name in MEASUREMENT_FIELDS]
+    + [("abdomen_shape", "name"), ("hip_shape", "name"), ("chart", "name")],
+    omit_missing=("chart",),
+)
+
+
+def parse_size_request(data):
+    """
+    Turn one decoded request body into get_size_recommendation keyword arguments.
+    Returns (kwargs, None), or (None, error message) if the record is unusable;
+    use SIZE_REQUEST.decode for the full list of errors.
+
+    A "chart" ID in the body is passed through as kwargs["chart"]; the caller
+    resolves it to a Chart (see sizecharter_registry.resolve_chart).
+    """
+    kwargs, errors = SIZE_REQUEST.decode(data)
+    if errors:
+        return None, errors[0]["message"]
+    return kwargs, None
+
+
+def _iter_ndjson(stream, head):
+    """
+    Yield one decoded record (or the ValueError it raised) per non-blank NDJSON line.
+
+    Lines are split out of STREAM_CHUNK_BYTES reads, so only the current line
+    is buffered; a line longer than MAX_RECORD_BYTES ends the iteration.
+    """
+    pending = head
+    while True:
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield loads(line)
+            except ValueError as exc:
+                yield exc
+        if len(pending) > MAX_RECORD_BYTES:
+            yield ValueError("Record too large")
+            return
+        chunk = stream.read(STREAM_CHUNK_BYTES)
+        if not chunk:
+            break
+        pending += chunk
+    if pending.strip():
+        try:
+            yield loads(pending)
+        except ValueError as exc:
+            yield exc
+
+
+def _iter_json_array(stream, head):
+    """
+    Incrementally decode the elements of a top-level JSON array.
+
+    Reads the stream in STREAM_CHUNK_BYTES pieces and yields each element as soon
+    as it is complete, so only one record is held in memory at a time. A
+    structural error is yielded as a ValueError and ends the iteration.
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    decoder = json.JSONDecoder()
+
+    def read():
+        chunk = stream.read(STREAM_CHUNK_BYTES)
+        return utf8.decode(chunk, final=not chunk), not chunk
+
+    buffer = utf8.decode(head)
+    pos = buffer.index("[") + 1
+    eof = False
+    expect_value = True
+    after_comma = False
+    while True:
+        # Skip whitespace by index; consumed input is only dropped when more is read
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                yield ValueError("Unterminated JSON array")
+                return
+            buffer, eof = read()
+            pos = 0
+            continue
+        if buffer[pos] == "]":
+            if after_comma:
+                yield ValueError("Expected a record after ','")
+            return
+        if not expect_value:
+            if buffer[pos] != ",":
+                yield ValueError("Expected ',' or ']' between records")
+                return
+            pos += 1
+            expect_value = after_comma = True
+            continue
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as exc:
+            # Most likely a record split across chunks: read more and retry
+            if eof or len(buffer) - pos > MAX_RECORD_BYTES:
+                yield exc
+                return
+            chunk, eof = read()
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        expect_value = after_comma = False
+        yield record
+
+
+def iter_records(stream):
+    """
+    Yield decoded records from either a JSON array or an NDJSON body, sniffed from the first byte.
+    """
+    head = b""
+    while not head.strip():
+        chunk = stream.read(STREAM_CHUNK_BYTES)
+        if not chunk:
+            return iter(())
+        head += chunk
+    if head.lstrip().startswith(b"["):
+        return _iter_json_array(stream, head)
+    return _iter_ndjson(stream, head)
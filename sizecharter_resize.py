@@ -0,0 +1,277 @@
+"""
+Incremental re-sizing of a stored population when its chart changes.
+
+A chart edit usually moves a few range ends, and only shoppers whose adjusted
+measurement lies between an end's old and new position can change size. A ColumnResizer keeps the adjusted measurements of a
+measurement file (see sizecharter_columnar) sorted per department and field.
+Given a new chart, it diffs the chart against the one the stored results were
+computed with and looks the affected rows up with a binary search per edited
+range. It then re-sizes only those rows, updates the results file in place and
+returns a changelog of (row, old size, new size):
+
+    resizer = ColumnResizer(SizeCharterTuned(), "shoppers.cols")  # results in shoppers.cols.sizes
+    for row, old, new in resizer.resize(load_chart("charts/tuned-v2.json")):
+        ...
+
+Keep the resizer around between edits: building the index costs somewhat more
+than sizing everyone once, while each resize() afterwards only touches the
+affected rows. Rows are re-sized when
+
+    - the adjusted value of a field lies between the old and new low end, or
+      the old and new high end, of a size's range for that field, or the size
+      gained or lost a range for the field (then every row with a value for
+      the field is affected);
+    - a morphology adjustment of one of their shapes changed;
+    - they were sized by the closest-size fallback and a range of a field
+      the fallback weighs changed in their department;
+    - their department's sizes or shapes changed, or the department was
+      added to or removed from the chart: then every row of it.
+
+Departments whose adjustments changed are re-indexed after the resize.
+"""
+import numpy as np
+
+from sizecharter_batch import FIELD_POSITIONS, adjust_block, as_columns, batch_tables, run_batch
+from sizecharter_columnar import (DEFAULT_CHUNK_ROWS, SIZE_COLUMNS, ColumnFile, department_codes,
+                                  read_measurements)
+
+
+def _same(old, new):
+    # Elementwise equality where two NaNs (no range) count as equal
+    return (old == new) | (np.isnan(old) & np.isnan(new))
+
+
+def chart_changes(old_tables, new_tables):
+    """
+    What differs, per department, between two batch tables of one engine.
+
+    Each changed department maps to a dict:
+
+        full      sizes or shape names differ, or the department is new or gone
+        shapes    shape codes whose adjustments differ
+        spans     {field: (k, 2) array of closed [low, high] value spans}; a
+                  shopper's size can only change through that field if its
+                  adjusted value lies in one of them (between a changed
+                  range's old and new low end, or its old and new high end)
+        distance  a range of a field the closest-size fallback weighs changed
+
+    Unchanged departments are left out.
+    """
+    if old_tables["engine"] != new_tables["engine"]:
+        raise ValueError("Both charts must be compiled for the same engine")
+    old_departments, new_departments = old_tables["departments"], new_tables["departments"]
+    weights = new_tables["fallback_weights"]
+
+    changes = {}
+    for gender in sorted(set(old_departments) | set(new_departments)):
+        old, new = old_departments.get(gender), new_departments.get(gender)
+        if (old is None or new is None or old["sizes"] != new["sizes"]
+                or old["shape_names"] != new["shape_names"]):
+            changes[gender] = {"full": True, "shapes": (), "spans": {}, "distance": True}
+            continue
+
+        shapes = tuple(code for code in range(len(old["shape_names"]))
+                       if not np.array_equal(old["adjustments"][code], new["adjustments"][code]))
+        spans = {}
+        for name, position in FIELD_POSITIONS.items():
+            old_low, old_high = old["lows"][:, position], old["highs"][:, position]
+            new_low, new_high = new["lows"][:, position], new["highs"][:, position]
+            changed = ~(_same(old_low, new_low) & _same(old_high, new_high))
+            if not changed.any():
+                continue
+            old_low, old_high = old_low[changed], old_high[changed]
+            new_low, new_high = new_low[changed], new_high[changed]
+            # Coverage only changes between the old and new low ends and between
+            # the old and new high ends; a size gaining or losing its range for
+            # the field can affect any value
+            both = ~np.isnan(old_low) & ~np.isnan(new_low)
+            bounds = [np.column_stack([np.fmin(old_low, new_low)[both], np.fmax(old_low, new_low)[both]]),
+                      np.column_stack([np.fmin(old_high, new_high)[both], np.fmax(old_high, new_high)[both]])]
+            if not both.all():
+                bounds.append(np.array([[-np.inf, np.inf]]))
+            spans[name] = np.concatenate(bounds)
+        if shapes or spans:
+            changes[gender] = {"full": False, "shapes": shapes, "spans": spans,
+                               "distance": weights is not None and any(
+                                   weights[FIELD_POSITIONS[name]] for name in spans)}
+    return changes
+
+
+class DepartmentIndex:
+    """
+    The adjusted measurements of one department's rows, sorted per field.
+
+    rows holds the rows' numbers in the population. For each field, order
+    lists positions into rows by ascending adjusted value and values the
+    matching values; rows missing the field are left out.
+    """
+    __slots__ = ("rows", "order", "values")
+
+    def __init__(self, rows, adjusted):
+        self.rows = rows
+        self.order = {}
+        self.values = {}
+        dtype = np.int32 if len(rows) < 2 ** 31 else np.int64
+        for name, position in FIELD_POSITIONS.items():
+            column = adjusted[position]
+            present = np.flatnonzero(~np.isnan(column))
+            order = present[np.argsort(column[present], kind="stable")]
+            self.order[name] = order.astype(dtype)
+            self.values[name] = column[order]
+
+    def within(self, spans):
+        """
+        Positions into rows of every row whose adjusted value of some field lies in one of its spans.
+        """
+        hit = np.zeros(len(self.rows), dtype=bool)
+        for name, bounds in spans.items():
+            values, order = self.values[name], self.order[name]
+            starts = np.searchsorted(values, bounds[:, 0], side="left")
+            stops = np.searchsorted(values, bounds[:, 1], side="right")
+            for start, stop in zip(starts, stops):
+                hit[order[start:stop]] = True
+        return np.flatnonzero(hit)
+
+
+class ColumnResizer:
+    """
+    Keeps a measurement file's stored size results current across chart edits.
+
+    charter     the charter whose engine produced the results
+    input_path  the measurement file
+    sizes_path  its results, as written by size_column_file (default: input_path + ".sizes")
+    chart       the chart those results were computed with (default: the charter's current chart)
+    """
+
+    def __init__(self, charter, input_path, sizes_path=None, chart=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.charter = charter
+        self.input_path = input_path
+        self.sizes_path = sizes_path or input_path + ".sizes"
+        self.chart = chart or charter.chart
+        self.tables = batch_tables(charter, self.chart)
+        self.chunk_rows = chunk_rows
+        self.store = ColumnFile(input_path)
+        with ColumnFile(self.sizes_path) as sizes:
+            if sizes.rows != self.store.rows:
+                raise ValueError(f"{self.sizes_path} does not hold results for {input_path}")
+            if sizes.metadata.get("engine") != self.tables["engine"]:
+                raise ValueError(f"{self.sizes_path} was not sized by the {self.tables['engine']} engine")
+        self.indexes = {}
+        for gender in self.tables["departments"]:
+            self._build_index(gender)
+
+    def _department_rows(self, gender):
+        departments = self.store.metadata["departments"]
+        if gender not in departments:
+            return np.empty(0, dtype=np.int64)
+        code = departments.index(gender)
+        column = self.store["department"]
+        return np.concatenate([np.flatnonzero(column[start:start + self.chunk_rows] == code) + start
+                               for start in range(0, self.store.rows, self.chunk_rows)] or [np.empty(0, np.int64)])
+
+    def _shape_codes(self, tables, gender, rows):
+        departments, shapes = self.store.metadata["departments"], self.store.metadata["shapes"]
+        _, remaps = department_codes(tables, departments, shapes)
+        remap = remaps[departments.index(gender)]
+        return remap[self.store["abdomen_shape"][rows]], remap[self.store["hip_shape"][rows]]
+
+    def _build_index(self, gender):
+        rows = self._department_rows(gender)
+        blocks = []
+        for start in range(0, len(rows), self.chunk_rows):
+            chunk = rows[start:start + self.chunk_rows]
+            abdomen, hips = self._shape_codes(self.tables, gender, chunk)
+            columns = as_columns(read_measurements(self.store, chunk))
+            blocks.append(adjust_block(self.tables, gender, columns, abdomen, hips)[1])
+        adjusted = np.concatenate(blocks, axis=1) if blocks else np.empty((len(FIELD_POSITIONS), 0))
+        self.indexes[gender] = DepartmentIndex(rows, adjusted)
+
+    def _affected(self, gender, change, sizes):
+        if change["full"]:
+            return self._department_rows(gender)
+        index = self.indexes[gender]
+        rows = index.rows[index.within(change["spans"])]
+        extra = []
+        if change["shapes"]:
+            shapes = np.array(change["shapes"])
+            abdomen, hips = self._shape_codes(self.tables, gender, index.rows)
+            moved = (np.isin(sizes["body_shape"][index.rows], shapes)
+                     | np.isin(abdomen, shapes) | np.isin(hips, shapes))
+            extra.append(index.rows[moved])
+        if change["distance"]:
+            extra.append(index.rows[sizes["fallback"][index.rows] != 0])
+        if extra:
+            rows = np.union1d(rows, np.concatenate(extra))
+        return rows
+
+    def resize(self, chart):
+        """
+        Switch the stored results to chart, re-sizing only the rows the edit can affect.
+
+        Returns the changelog: (row, old size, new size) for every row whose
+        size changed, in row order; a size is None where there was no match
+        (or the department is not in the chart).
+        """
+        new_tables = batch_tables(self.charter, chart)
+        changes = chart_changes(self.tables, new_tables)
+        log_rows, log_old, log_new = [], [], []
+
+        with ColumnFile(self.sizes_path, mode="r+") as sizes:
+            for gender, change in changes.items():
+                rows = self._affected(gender, change, sizes) if gender in self.indexes else self._department_rows(gender)
+                if not len(rows):
+                    continue
+                old_codes = np.array(sizes["size"][rows])
+                old_sizes = self.tables["departments"][gender]["sizes"] if gender in self.tables["departments"] else ()
+
+                if gender in new_tables["departments"]:
+                    abdomen, hips = self._shape_codes(new_tables, gender, rows)
+                    result = run_batch(new_tables, gender, read_measurements(self.store, rows), abdomen, hips)
+                    new_sizes = result["sizes"]
+                    for column in SIZE_COLUMNS:
+                        sizes[column][rows] = result[column] if column in result else 0
+                    sizes.metadata["sizes"][gender] = list(new_sizes)
+                    sizes.metadata["body_shapes"][gender] = list(result["body_shapes"])
+                else:
+                    # As size_column_file leaves rows of an unknown department
+                    new_sizes = ()
+                    for column in SIZE_COLUMNS:
+                        sizes[column][rows] = -1 if column in ("size", "body_shape") else 0
+                    sizes.metadata["sizes"].pop(gender, None)
+                    sizes.metadata["body_shapes"].pop(gender, None)
+
+                # Size names by code, with code -1 indexing the trailing None
+                old_names = np.array(list(old_sizes) + [None], dtype=object)[old_codes]
+                new_names = np.array(list(new_sizes) + [None], dtype=object)[sizes["size"][rows]]
+                moved = old_names != new_names
+                log_rows.append(rows[moved])
+                log_old.append(old_names[moved])
+                log_new.append(new_names[moved])
+
+        self.chart, self.tables = chart, new_tables
+        for gender, change in changes.items():
+            if gender not in new_tables["departments"]:
+                self.indexes.pop(gender, None)
+            elif change["full"] or change["shapes"]:
+                self._build_index(gender)
+
+        if not log_rows:
+            return []
+        rows, old, new = np.concatenate(log_rows), np.concatenate(log_old), np.concatenate(log_new)
+        order = np.argsort(rows, kind="stable")
+        return list(zip(rows[order].tolist(), old[order].tolist(), new[order].tolist()))
+
+    def close(self):
+        self.store.close()
+
+
+def resize_column_file(charter, old_chart, new_chart, input_path, sizes_path=None):
+    """
+    One-off incremental resize of a measurement file's results from old_chart to new_chart.
+    Returns the changelog, as ColumnResizer.resize does.
+    """
+    resizer = ColumnResizer(charter, input_path, sizes_path, chart=old_chart)
+    try:
+        return resizer.resize(new_chart)
+    finally:
+        resizer.close()
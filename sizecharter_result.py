@@ -0,0 +1,191 @@
+"""
+Compact result type for get_size_recommendation.
+
+A SizeRecommendation keeps only what the sizing pass produced: the size, the
+shapes, one fixed-position float array holding the original then the adjusted
+measurements (each in MEASUREMENT_FIELDS order, NaN for missing), the combined
+morphology deltas and two small bitmasks. The verbose "details" tree the API
+returns is only built when a caller asks for it, and then cached on the object,
+as is its JSON encoding (to_json_bytes), so a cached result is encoded once.
+
+It is a read-only mapping with the keys "recommended_size" and "details", so
+result["recommended_size"] and result["details"][...] behave as they did when
+results were plain dicts.
+"""
+import math
+from array import array
+from collections.abc import Mapping
+
+from sizecharter_index import MEASUREMENT_FIELDS
+
+MISSING = float("nan")
+FIELD_COUNT = len(MEASUREMENT_FIELDS)
+
+# Fields whose adjusted values are reported rounded to 0.1 cm
+ROUNDED_FIELDS = ("chest", "waist", "hips")
+
+
+def pack_measurements(original, adjusted):
+    """
+    Pack original and adjusted optional measurements into one float array,
+    NaN standing in for None.
+    """
+    return array("d", [MISSING if value is None else value for value in original + adjusted])
+
+
+def unpack_measurements(values):
+    """
+    Inverse of pack_measurements: a list with None for each missing value.
+    """
+    return [None if math.isnan(value) else value for value in values]
+
+
+def explain_fields(department, adjusted, names):
+    """
+    Report the adjusted measurements (packed, MEASUREMENT_FIELDS order) of the
+    fields in names against a CompiledDepartment.
+
+    Returns (fields, ordinals): {name: {"value", "size", "margin"}} for each
+    present field, and {name: ordinal} for those a range matched.
+    """
+    fields = {}
+    ordinals = {}
+    for name, value in zip(MEASUREMENT_FIELDS, adjusted):
+        if math.isnan(value) or name not in names:
+            continue
+        index = department.fields.get(name)
+        ordinal, margin = index.explain(value) if index is not None else (None, None)
+        fields[name] = {"value": round(value, 2),
+                        "size": None if ordinal is None else department.sizes[ordinal],
+                        "margin": None if margin is None else round(margin, 2)}
+        if ordinal is not None:
+            ordinals[name] = ordinal
+    return fields, ordinals
+
+
+def fields_outside(limits, adjusted, names):
+    """
+    The fields in names whose present adjusted value lies outside one size's ranges.
+    """
+    outside = []
+    for name, value in zip(MEASUREMENT_FIELDS, adjusted):
+        if name in names and name in limits and not math.isnan(value):
+            low, high = limits[name]
+            if not low <= value <= high:
+                outside.append(name)
+    return outside
+
+
+class SizeRecommendation(Mapping):
+    """
+    Base result type; each engine subclasses it to render its own details tree.
+
+    warnings is a bitmask over the engine's WARNING_MESSAGES and health a
+    bitmask over MEASUREMENT_FIELDS of out-of-range original measurements.
+    nearest is the sizecharter_index.NearestMatch of the closest-size fallback
+    when it chose the size, else None.
+    Results may be shared through a cache and must not be mutated.
+    """
+    __slots__ = ("recommended_size", "gender", "body_shape", "abdomen_shape", "hip_shape",
+                 "measurements", "adjustments", "warnings", "health", "nearest", "_details", "_json")
+
+    def __init__(self, recommended_size, gender, body_shape, abdomen_shape, hip_shape,
+                 measurements, adjustments, warnings=0, health=0, nearest=None):
+        self.recommended_size = recommended_size
+        self.gender = gender
+        self.body_shape = body_shape
+        self.abdomen_shape = abdomen_shape
+        self.hip_shape = hip_shape
+        self.measurements = measurements
+        self.adjustments = adjustments
+        self.warnings = warnings
+        self.health = health
+        self.nearest = nearest
+        self._details = None
+        self._json = None
+
+    @property
+    def original(self):
+        return self.measurements[:FIELD_COUNT]
+
+    @property
+    def adjusted(self):
+        return self.measurements[FIELD_COUNT:]
+
+    @property
+    def details(self):
+        details = self._details
+        if details is None:
+            details = self._details = self._build_details()
+        return details
+
+    @property
+    def health_warning(self):
+        """
+        True if the details' health status is "warning".
+        """
+        return bool(self.health)
+
+    def _build_details(self):
+        raise NotImplementedError
+
+    def _original_measurements(self):
+        return dict(zip(MEASUREMENT_FIELDS, unpack_measurements(self.original)))
+
+    def _adjusted_measurements(self):
+        adjusted = dict(zip(MEASUREMENT_FIELDS, unpack_measurements(self.adjusted)))
+        for key in ROUNDED_FIELDS:
+            if adjusted[key] is not None:
+                adjusted[key] = round(adjusted[key], 1)
+        return adjusted
+
+    def _nearest_details(self):
+        # The closest-size fallback's answer, reported when it decided the size
+        nearest = self.nearest
+        return {"size": nearest.size, "distance": round(nearest.distance, 4),
+                "runner_up": nearest.runner_up,
+                "runner_up_distance": None if nearest.runner_up is None else round(nearest.runner_up_distance, 4)}
+
+    def _explanation(self, rule, deciding_fields, fields):
+        return {"recommended_size": self.recommended_size, "rule": rule,
+                "deciding_fields": deciding_fields, "fields": fields}
+
+    def _flagged_fields(self):
+        return [key for bit, key in enumerate(MEASUREMENT_FIELDS) if self.health >> bit & 1]
+
+    def to_dict(self):
+        return {"recommended_size": self.recommended_size, "details": self.details}
+
+    def to_json(self, **kwargs):
+        """
+        Serialize to the API's JSON shape; keyword arguments go to json.dumps.
+        """
+        import json
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_json_bytes(self):
+        """
+        The API's JSON shape as compact UTF-8 bytes, encoded once and cached.
+        """
+        body = self._json
+        if body is None:
+            # Imported here so sizing alone never loads a JSON library
+            from sizecharter_json import dumps
+            body = self._json = dumps(self.to_dict())
+        return body
+
+    def __getitem__(self, key):
+        if key == "recommended_size":
+            return self.recommended_size
+        if key == "details":
+            return self.details
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(("recommended_size", "details"))
+
+    def __len__(self):
+        return 2
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.recommended_size!r}, gender={self.gender!r})"
@@ -0,0 +1,272 @@
+"""
+Fit sensitivity of whole catalogs: how close each shopper sits to a size
+boundary, and how their size moves with the shape options and small
+measurement errors.
+
+For a block of shoppers of one department, run_sensitivity sizes every
+(abdomen_shape, hip_shape) pair of the department's morphology table, and
+every present measurement moved by -delta and +delta, in one vectorized pass.
+Calling get_size_recommendation per variant repeats the whole computation
+for each variant. Here the shared part is computed once: shape inference,
+the body-shape adjustment, and each field's range lookups (Tuned), range
+compatibility (Mimic) and fallback distance terms. A variant then only
+recomputes the terms of the fields it moves. Pairs whose deltas are equal
+are sized once. Terms are recombined in run_batch's order, so each variant's
+size is exactly what get_size_recommendation returns for it.
+
+    report = charter.get_fit_sensitivity_batch("womens", block, delta=1.0)
+    risky = np.argsort(report["margin"])        # shoppers nearest a boundary first
+
+Perturbations move the adjusted value of one field and keep the inferred body
+shape, so they isolate how close that field sits to a range boundary.
+Requires NumPy.
+"""
+from itertools import product
+
+import numpy as np
+
+from sizecharter_batch import (FIELD_POSITIONS, INVALID_GENDER, MIMIC_MATCH_FIELDS, adjust_block, as_columns,
+                               batch_tables, interval_lookup, shape_codes)
+from sizecharter_index import MEASUREMENT_FIELDS
+
+DEFAULT_DELTA = 1.0
+
+# Shoppers evaluated at a time; bounds the (variants, sizes, N) working arrays
+CHUNK_ROWS = 8192
+
+# Fields the morphology adjustments move, as positions
+ADJUSTED_POSITIONS = (FIELD_POSITIONS["chest"], FIELD_POSITIONS["waist"], FIELD_POSITIONS["hips"])
+
+
+def shape_variants(tables, gender):
+    """
+    Every (abdomen_shape, hip_shape) pair of a department's morphology shapes, None included.
+    """
+    shapes = (None,) + tables["departments"][gender]["morphology_shapes"]
+    return tuple(product(shapes, shapes))
+
+
+def _change_points(bounds, slots):
+    # Per IntervalIndex slot, the nearest boundary below and above where the
+    # lookup result changes (NaN if it never does), as IntervalIndex.explain finds them
+    below = np.full(len(slots), np.nan)
+    above = np.full(len(slots), np.nan)
+    for s in range(1, len(slots)):
+        below[s] = bounds[(s - 1) // 2] if slots[s - 1] != slots[s] else below[s - 1]
+    for s in range(len(slots) - 2, -1, -1):
+        above[s] = bounds[s // 2] if slots[s + 1] != slots[s] else above[s + 1]
+    return below, above
+
+
+def field_margins(bounds, slots, values):
+    """
+    Vectorized IntervalIndex.explain margins: distance from each value to the
+    nearest range endpoint where the field's size changes, NaN where none does
+    or the value is missing.
+    """
+    if not len(bounds):
+        return np.full(values.shape, np.nan)
+    below, above = _change_points(bounds, slots)
+    j = np.searchsorted(bounds, values, side="left")
+    on_point = bounds[np.minimum(j, len(bounds) - 1)] == values
+    slot = 2 * j + on_point
+    with np.errstate(invalid="ignore"):
+        return np.fmin(values - below[slot], above[slot] - values)
+
+
+class _Sizer:
+    """
+    One department's per-field terms and how the engine combines them.
+
+    A field's term is its size ordinal (Tuned) or its (sizes, N) range
+    compatibility (Mimic); its distance is its (sizes, N) contribution to the
+    closest-size fallback's weighted squared distance. The distances of the
+    shoppers as given are computed once; a variant recomputes those of the
+    fields it moves, for the shoppers no range matches only.
+    """
+
+    def __init__(self, tables, gender, department):
+        self.engine = tables["engine"]
+        self.department = department
+        self.weights = tables["fallback_weights"]
+        lows = department["lows"]
+        if self.engine == "tuned":
+            # mens are sized on inseam, not hips
+            self.fields = tuple(FIELD_POSITIONS[name] for name in department["bounds"]
+                                if name != "hips" or gender != "mens")
+        else:
+            self.fields = tuple(FIELD_POSITIONS[name] for name in MIMIC_MATCH_FIELDS
+                                if not np.isnan(lows[:, FIELD_POSITIONS[name]]).all())
+        self.distance_fields = () if self.weights is None else tuple(
+            position for position, weight in enumerate(self.weights)
+            if weight and not np.isnan(lows[:, position]).all())
+        self.positions = tuple(sorted(set(self.fields) | set(self.distance_fields)))
+
+    def term(self, position, values):
+        department = self.department
+        if self.engine == "tuned":
+            name = MEASUREMENT_FIELDS[position]
+            return interval_lookup(department["bounds"][name], department["slots"][name], values)
+        low = department["lows"][:, position, None]
+        high = department["highs"][:, position, None]
+        return np.isnan(low) | np.isnan(values) | ((low <= values) & (values <= high))
+
+    def distance(self, position, values):
+        # The _nearest term of one field, in the same operation order
+        low = self.department["lows"][:, position, None]
+        high = self.department["highs"][:, position, None]
+        gap = np.fmax(np.fmax(low - values, values - high), 0)
+        weight = self.weights[position]
+        # Sizes without a range for the field get a NaN gap, which fmax turns into 0
+        return np.square(gap) if weight == 1 else np.multiply(gap, weight) * gap
+
+    def terms(self, adjusted, positions):
+        # adjusted maps each position in positions to its (N,) values
+        return {position: self.term(position, adjusted[position]) for position in positions if position in self.fields}
+
+    def distances(self, adjusted):
+        return {position: self.distance(position, adjusted[position]) for position in self.distance_fields}
+
+    def size(self, terms, distances, informative, moved=None):
+        """
+        Combine every field's term and distance into size ordinals, as run_batch
+        does; moved maps the fields a variant moves to their (N,) values.
+        """
+        n = len(informative)
+        if self.engine == "tuned":
+            size = np.full(n, -1, dtype=np.int16)
+            for position in self.fields:
+                np.maximum(size, terms[position], out=size)
+            missed = (size < 0) & informative if self.weights is not None else None
+        else:
+            matches = np.ones((len(self.department["sizes"]), n), dtype=bool)
+            for position in self.fields:
+                matches &= terms[position]
+            matched = matches.any(axis=0)
+            size = matches.argmax(axis=0).astype(np.int16)
+            missed = ~matched
+        if missed is not None and missed.any():
+            missed = np.flatnonzero(missed)
+            total = np.zeros((len(self.department["sizes"]), len(missed)))
+            for position in self.distance_fields:
+                if moved and position in moved:
+                    total += self.distance(position, moved[position][missed])
+                else:
+                    total += distances[position][:, missed]
+            size[missed] = total.argmin(axis=0)
+        return size
+
+
+def _block_sensitivity(tables, gender, columns, abdomen_shape, hip_shape, variants, delta):
+    department = tables["departments"][gender]
+    sizer = _Sizer(tables, gender, department)
+    n = columns.shape[1]
+    body_shape, adjusted = adjust_block(tables, gender, columns, abdomen_shape, hip_shape)
+    terms = sizer.terms(adjusted, sizer.positions)
+    distances = sizer.distances(adjusted)
+    informative = np.zeros(n, dtype=bool)
+    for position in sizer.distance_fields:
+        informative |= ~np.isnan(adjusted[position])
+    base = sizer.size(terms, distances, informative)
+
+    # Shape variants: body shape inferred once, only the adjusted fields re-matched;
+    # pairs with equal deltas share one computation
+    names, table = department["shape_names"], department["adjustments"]
+    variant_size = np.empty((len(variants), n), dtype=np.int16)
+    computed = {}
+    for v, (abdomen, hip) in enumerate(variants):
+        abdomen_code = shape_codes(names, abdomen, n)
+        hip_code = shape_codes(names, hip, n)
+        key = (tuple(table[abdomen_code[0]]), tuple(table[hip_code[0]])) if n else None
+        size = computed.get(key)
+        if size is None:
+            # As _adjust computes it, so sizes match run_batch to the bit
+            deltas = table[body_shape] + table[abdomen_code] + table[hip_code]
+            moved = {position: columns[position] + deltas[:, i] for i, position in enumerate(ADJUSTED_POSITIONS)}
+            size = computed[key] = sizer.size({**terms, **sizer.terms(moved, ADJUSTED_POSITIONS)}, distances,
+                                              informative, moved)
+        variant_size[v] = size
+
+    # One field at a time, moved by -delta and +delta
+    perturbed = np.broadcast_to(base, (len(columns), 2, n)).copy()
+    for position in sizer.positions:
+        present = ~np.isnan(adjusted[position])
+        if not present.any():
+            continue
+        for side, step in enumerate((-delta, delta)):
+            moved = {position: adjusted[position] + step}
+            perturbed[position, side] = sizer.size({**terms, **sizer.terms(moved, (position,))}, distances,
+                                                   informative, moved)
+
+    # Nearest boundary over the fields the engine matches on
+    margins = np.full((len(columns), n), np.nan)
+    for position in sizer.fields:
+        name = MEASUREMENT_FIELDS[position]
+        margins[position] = field_margins(department["bounds"][name], department["slots"][name], adjusted[position])
+    known = ~np.isnan(margins).all(axis=0)
+    margin_field = np.where(known, np.argmin(np.where(np.isnan(margins), np.inf, margins), axis=0), -1)
+
+    changed = (variant_size != base).sum(axis=0) + (perturbed != base).sum(axis=(0, 1))
+    return {
+        "size": base,
+        "variant_size": variant_size,
+        "perturbed_size": perturbed,
+        "margin": np.where(known, np.fmin.reduce(margins, axis=0), np.nan),
+        "margin_field": margin_field.astype(np.int8),
+        "changed": changed.astype(np.int16),
+    }
+
+
+def run_sensitivity(tables, gender, measurements, abdomen_shape=None, hip_shape=None,
+                    delta=DEFAULT_DELTA, variants=None):
+    """
+    Fit sensitivity of a block of shoppers of one department against batch tables.
+
+    measurements, abdomen_shape and hip_shape are as for run_batch; variants
+    is a sequence of (abdomen_shape, hip_shape) pairs (default: shape_variants).
+    Returns a dict:
+
+        sizes           size names in chart order
+        variants        the (abdomen_shape, hip_shape) pairs evaluated
+        delta           the perturbation, in cm
+        size            (N,) ordinals of the shoppers as given, as run_batch
+        variant_size    (V, N) ordinals per shape pair
+        perturbed_size  (8, 2, N) ordinals with one adjusted field moved by
+                        -delta ([:, 0]) or +delta ([:, 1]); equal to size
+                        where the field is missing or not sized on
+        margin          (N,) cm from the nearest range endpoint that changes a
+                        matched field's size (as explain_size_recommendation's
+                        margins), NaN if no such field is present
+        margin_field    (N,) position of that field in MEASUREMENT_FIELDS, -1 if none
+        changed         (N,) how many variants and perturbations change the size
+    """
+    gender = gender.lower()
+    if gender not in tables["departments"]:
+        raise ValueError(INVALID_GENDER)
+    if variants is None:
+        variants = shape_variants(tables, gender)
+    variants = tuple(variants)
+    columns = as_columns(measurements)
+    n = columns.shape[1]
+
+    def rows(shapes, start, stop):
+        # A per-shopper shape sequence is sliced along with the block
+        return shapes if shapes is None or isinstance(shapes, str) else shapes[start:stop]
+
+    parts = [_block_sensitivity(tables, gender, columns[:, start:start + CHUNK_ROWS],
+                                rows(abdomen_shape, start, start + CHUNK_ROWS),
+                                rows(hip_shape, start, start + CHUNK_ROWS), variants, delta)
+             for start in range(0, n, CHUNK_ROWS)]
+    if not parts:
+        parts = [_block_sensitivity(tables, gender, columns, abdomen_shape, hip_shape, variants, delta)]
+    report = {key: np.concatenate([part[key] for part in parts], axis=-1) for key in parts[0]}
+    report.update(sizes=tables["departments"][gender]["sizes"], variants=variants, delta=delta)
+    return report
+
+
+def charter_sensitivity(charter, gender, measurements, abdomen_shape=None, hip_shape=None,
+                        delta=DEFAULT_DELTA, variants=None):
+    """
+    run_sensitivity on the charter's current batch tables.
+    """
+    return run_sensitivity(batch_tables(charter), gender, measurements, abdomen_shape, hip_shape, delta, variants)
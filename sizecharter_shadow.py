@@ -0,0 +1,195 @@
+"""
+Shadow mode: compare a second engine against the one serving requests.
+
+A ShadowComparer sits beside the serving (primary) charter. After each
+request is answered, its arguments and the served size are handed to
+submit(), which only puts them on a bounded queue. Background threads size the
+request again with the shadow charter and tally where the two disagree.
+The request never waits for the shadow engine. When the queue is full the
+comparison is dropped and counted, so a slow shadow engine cannot build up
+memory or back-pressure:
+
+    shadow = ShadowComparer(SizeCharterTuned(), SizeCharterMimic(), sample=0.1)
+    app = create_app(sizer=shadow.primary, shadow=shadow)   # GET /api/shadow for the stats
+
+Requests that name their own chart are skipped: a chart is compiled for one
+engine. Shadow threads share the interpreter with request threads, so the
+comparison still costs CPU time; lower sample to bound it.
+"""
+import queue
+import random
+import threading
+
+# Shadow sizes compared per department: larger, smaller or not comparable with the served size
+DIRECTIONS = ("shadow_larger", "shadow_smaller", "incomparable")
+
+# Most frequent (department, served, shadow) disagreements listed by stats()
+TOP_DISAGREEMENTS = 20
+
+
+class ShadowComparer:
+    """
+    Sizes sampled requests with a shadow charter off the request path and
+    aggregates its disagreements with the primary charter.
+
+    primary   the charter serving requests; its chart orders sizes when
+              classifying a disagreement
+    shadow    the charter being evaluated
+    maxsize   comparisons that may wait in the queue before new ones are dropped
+    workers   background threads sizing with the shadow charter
+    sample    fraction of requests compared
+    """
+
+    def __init__(self, primary, shadow, maxsize=10000, workers=1, sample=1.0):
+        self.primary = primary
+        self.shadow = shadow
+        self.sample = sample
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.reset()
+        self._threads = [threading.Thread(target=self._run, name=f"shadow-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def reset(self):
+        """
+        Zero every counter.
+        """
+        with self._lock:
+            self.submitted = 0
+            self.skipped = 0
+            self.dropped = 0
+            self.failed = 0
+            self.compared = 0
+            self.agreed = 0
+            # department -> {"compared", "agreed", *DIRECTIONS}
+            self._departments = {}
+            # (department, served size, shadow size) -> count
+            self._pairs = {}
+
+    def submit(self, kwargs, result):
+        """
+        Queue one served request for comparison; never blocks.
+
+        kwargs are the request's get_size_recommendation arguments and result
+        the primary's answer. Returns True if the comparison was queued.
+        """
+        if self.sample < 1.0 and self._random.random() >= self.sample:
+            return False
+        size = getattr(result, "recommended_size", None)
+        if size is None or kwargs.get("chart") is not None:
+            # Error responses and per-request charts have nothing to compare
+            with self._lock:
+                self.skipped += 1
+            return False
+        try:
+            self._queue.put_nowait((kwargs, result.gender, size))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._compare(*item)
+            finally:
+                self._queue.task_done()
+
+    def _compare(self, kwargs, gender, served):
+        try:
+            size = self.shadow.get_size_recommendation(**kwargs).recommended_size
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            return
+        direction = None
+        if size != served:
+            sizes = self.primary.chart.compiled[gender].sizes
+            if served in sizes and size in sizes:
+                direction = DIRECTIONS[0] if sizes.index(size) > sizes.index(served) else DIRECTIONS[1]
+            else:
+                direction = DIRECTIONS[2]
+        with self._lock:
+            counts = self._departments.get(gender)
+            if counts is None:
+                counts = self._departments[gender] = dict.fromkeys(("compared", "agreed") + DIRECTIONS, 0)
+            counts["compared"] += 1
+            self.compared += 1
+            if direction is None:
+                counts["agreed"] += 1
+                self.agreed += 1
+            else:
+                counts[direction] += 1
+                key = (gender, served, size)
+                self._pairs[key] = self._pairs.get(key, 0) + 1
+
+    def join(self):
+        """
+        Wait until every queued comparison has been made.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Finish the queued comparisons and stop the threads.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        """
+        Agreement so far, overall and per department, with the most frequent disagreements.
+        """
+        with self._lock:
+            departments = {gender: dict(counts) for gender, counts in self._departments.items()}
+            pairs = sorted(self._pairs.items(), key=lambda item: -item[1])[:TOP_DISAGREEMENTS]
+            report = {
+                "primary": self.primary.BATCH_ENGINE,
+                "shadow": self.shadow.BATCH_ENGINE,
+                "submitted": self.submitted,
+                "skipped": self.skipped,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "pending": self._queue.qsize(),
+                "compared": self.compared,
+                "agreed": self.agreed,
+                "agreement_rate": self.agreed / self.compared if self.compared else None,
+            }
+        for counts in departments.values():
+            counts["agreement_rate"] = counts["agreed"] / counts["compared"]
+        report["departments"] = departments
+        report["top_disagreements"] = [{"department": gender, "served": served, "shadow": size, "count": count}
+                                       for (gender, served, size), count in pairs]
+        return report
+
+    def series(self, prefix="sizecharter_shadow"):
+        """
+        The counters as extra series for SizingMetrics.render.
+        """
+        with self._lock:
+            engines = (("primary", self.primary.BATCH_ENGINE), ("shadow", self.shadow.BATCH_ENGINE))
+            series = [(f"{prefix}_pending", "gauge", engines, self._queue.qsize())]
+            for name in ("submitted", "skipped", "dropped", "failed"):
+                series.append((f"{prefix}_{name}_total", "counter", engines, getattr(self, name)))
+            departments = sorted(self._departments.items())
+            for gender, counts in departments:
+                series.append((f"{prefix}_compared_total", "counter",
+                               engines + (("department", gender),), counts["compared"]))
+            # Each metric's samples stay together, as the exposition format requires
+            for gender, counts in departments:
+                for direction in DIRECTIONS:
+                    series.append((f"{prefix}_disagreements_total", "counter",
+                                   engines + (("department", gender), ("direction", direction)), counts[direction]))
+        return series
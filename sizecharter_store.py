@@ -0,0 +1,385 @@
+"""
+Persistent per-shopper results: a profile store backed by SQLite.
+
+Returning shoppers resend the same measurements. A ProfileStore keeps, for
+each (profile ID, chart ID, engine), the shopper's last request and the
+encoded /api/size response, stamped with the version of everything the result
+depends on: the chart's fingerprint and the charter's engine, fallback weights
+and cache quantum. With a store, /api/size accepts a "profile_id":
+
+    {"profile_id": "u123", "gender": "womens", "chest": 88, ...}   sizes and stores
+    {"profile_id": "u123"}                                         answers from the store
+
+A stored response is sent as is while its stamp matches the current chart.
+After a chart change, a profile-only request is re-sized from the stored
+request, so the shopper never needs to upload their measurements again. A
+full request whose measurements equal the stored ones is also a hit.
+
+    store = ProfileStore("profiles.db")
+    store.warmup(charter, records)            # bulk-load known shoppers
+    store.compact(charter, registry, max_age=180 * 86400)
+    app = create_app(sizer=charter, store=store)
+
+Run as a script for bulk warmup, compaction and stats:
+
+    python sizecharter_store.py profiles.db warmup shoppers.ndjson --engine mimic
+    python sizecharter_store.py profiles.db compact --max-age-days 180
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+from sizecharter_index import MEASUREMENT_FIELDS
+from sizecharter_json import dumps, loads
+from sizecharter_request import RequestSchema, SIZE_REQUEST, error_body, field_error
+from sizecharter_result import SizeRecommendation
+
+# Longest profile ID accepted
+MAX_PROFILE_ID = 128
+
+# Profiles sized and written per transaction by warmup() and compact()
+WRITE_CHUNK_ROWS = 10000
+
+# Most (chart, charter settings) stamps memoized
+VERSION_MEMO_SIZE = 256
+
+# End of warmup() input; None is a record (a JSON null), not the end
+_END = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    profile_id TEXT NOT NULL,
+    chart_id TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    version TEXT NOT NULL,
+    request BLOB NOT NULL,
+    body BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (profile_id, chart_id, engine)
+) WITHOUT ROWID
+"""
+
+# A profile-only /api/size body: just the optional chart ID besides profile_id
+PROFILE_REQUEST = RequestSchema([("chart", "name")], omit_missing=("chart",))
+
+
+def _error(status, field, message):
+    return status, dumps(error_body([field_error(field, message)])), None, None
+
+
+class ProfileStore:
+    """
+    SQLite table of the last request and response per (profile ID, chart ID, engine).
+
+    path  database file, created if missing; ":memory:" for a private in-memory store
+
+    The default chart is stored under chart ID "". One connection is shared
+    by all threads, under a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._versions = {}
+        self.hits = 0
+        self.refreshed = 0
+        self.stored = 0
+        self.unknown = 0
+
+    def result_version(self, charter, chart):
+        """
+        Stamp of what charter's results on chart depend on besides the request.
+        """
+        quantum = charter.cache.quantum if charter.cache is not None else None
+        key = (chart, charter.BATCH_ENGINE, charter.fallback_weights, quantum)
+        version = self._versions.get(key)
+        if version is None:
+            if len(self._versions) >= VERSION_MEMO_SIZE:
+                self._versions.clear()
+            version = self._versions[key] = f"{chart.fingerprint()}:{dumps(key[1:]).decode()}"
+        return version
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, profile_id, chart_id, engine):
+        """
+        The stored (version, request kwargs, response body) of a profile, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, request, body FROM profiles WHERE profile_id = ? AND chart_id = ? AND engine = ?",
+                (profile_id, chart_id, engine)).fetchone()
+        if row is None:
+            return None
+        return row[0], loads(row[1]), row[2]
+
+    def put(self, profile_id, chart_id, engine, version, kwargs, body):
+        self._write([(profile_id, chart_id, engine, version, dumps(kwargs), body, time.time())])
+
+    def _write(self, rows):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def size(self, charter, data, registry=None):
+        """
+        Answer one decoded /api/size body carrying a "profile_id".
+
+        With a "gender" the body is a full request: it is sized unless the
+        stored request is the same and still current, and the result is
+        stored. Without one, the stored response is returned, re-sized from
+        the stored request first if the chart changed. Returns (status,
+        response body bytes, kwargs, result); kwargs and result are those of
+        the get_size_recommendation call made, or None when none was.
+        """
+        profile_id = data.get("profile_id")
+        if not profile_id or type(profile_id) is not str or len(profile_id) > MAX_PROFILE_ID:
+            return _error(400, "profile_id", f"profile_id must be a string of 1 to {MAX_PROFILE_ID} characters")
+        if "gender" in data:
+            kwargs, errors = SIZE_REQUEST.decode(data)
+        else:
+            kwargs, errors = PROFILE_REQUEST.decode(data)
+        if errors:
+            return 400, dumps(error_body(errors)), None, None
+        chart_id = kwargs.pop("chart", None)
+        if "gender" not in kwargs:
+            kwargs = None
+
+        if chart_id is None:
+            chart = charter.chart
+        else:
+            try:
+                if registry is None:
+                    raise KeyError(f"Unknown chart: {chart_id}")
+                chart = registry.get(chart_id)
+            except KeyError as exc:
+                return _error(404, "chart", exc.args[0])
+            except ValueError as exc:
+                return _error(500, "chart", f"Chart failed to load: {exc}")
+
+        key = (profile_id, chart_id or "", charter.BATCH_ENGINE)
+        version = self.result_version(charter, chart)
+        stored = self.get(*key)
+        if stored is not None and stored[0] == version and (kwargs is None or kwargs == stored[1]):
+            self._count("hits")
+            return 200, stored[2], None, None
+        if kwargs is None:
+            if stored is None:
+                self._count("unknown")
+                return _error(404, "profile_id", f"Unknown profile: {profile_id}")
+            kwargs = stored[1]
+            outcome = "refreshed"
+        else:
+            outcome = "stored"
+
+        result = charter.get_size_recommendation(**kwargs, chart=chart)
+        if chart_id is not None:
+            # As the front ends pass it on, e.g. to a ShadowComparer
+            kwargs = dict(kwargs, chart=chart)
+        if not isinstance(result, SizeRecommendation):
+            # An error, e.g. an unknown department: answered but not stored
+            return 200, dumps(result), kwargs, result
+        body = result.to_json_bytes()
+        self.put(*key, version, {name: value for name, value in kwargs.items() if name != "chart"}, body)
+        # Counted once written: error answers are not stored
+        self._count(outcome)
+        return 200, body, kwargs, result
+
+    def _size_many(self, charter, chart, chart_id, profiles):
+        # Size (profile ID, kwargs) pairs against chart and store them; returns how many were stored
+        engine = charter.BATCH_ENGINE
+        version = self.result_version(charter, chart)
+        if chart is charter.chart:
+            from sizecharter_batch import batch_recommendations
+            results = batch_recommendations(charter, [
+                (kwargs["gender"], tuple(kwargs[name] for name in MEASUREMENT_FIELDS),
+                 kwargs["abdomen_shape"], kwargs["hip_shape"]) for _, kwargs in profiles])
+        else:
+            results = [charter.get_size_recommendation(**kwargs, chart=chart) for _, kwargs in profiles]
+        now = time.time()
+        rows = [(profile_id, chart_id, engine, version, dumps(kwargs), result.to_json_bytes(), now)
+                for (profile_id, kwargs), result in zip(profiles, results)
+                if isinstance(result, SizeRecommendation)]
+        self._write(rows)
+        return len(rows)
+
+    def warmup(self, charter, records, registry=None, chunk_rows=WRITE_CHUNK_ROWS):
+        """
+        Size and store many profiles, a transaction per chunk_rows records.
+
+        records are decoded /api/size bodies, each with a "profile_id". Those
+        on the charter's own chart are sized together by
+        sizecharter_batch.batch_recommendations (which requires NumPy); those
+        naming a chart are resolved through registry. Returns (stored,
+        rejected): records that are not objects or are invalid, and unknown
+        charts and departments, are rejected.
+        """
+        stored = rejected = 0
+        chunk = []
+        records = iter(records)
+        while True:
+            record = next(records, _END)
+            if record is not _END:
+                chunk.append(record)
+                if len(chunk) < chunk_rows:
+                    continue
+            groups = {}
+            for data in chunk:
+                if type(data) is not dict:
+                    rejected += 1
+                    continue
+                profile_id = data.get("profile_id")
+                kwargs, errors = SIZE_REQUEST.decode(data)
+                if errors or not profile_id or type(profile_id) is not str or len(profile_id) > MAX_PROFILE_ID:
+                    rejected += 1
+                    continue
+                groups.setdefault(kwargs.pop("chart", None), []).append((profile_id, kwargs))
+            for chart_id, profiles in groups.items():
+                try:
+                    chart = charter.chart if chart_id is None else registry.get(chart_id)
+                except (AttributeError, KeyError, ValueError):
+                    rejected += len(profiles)
+                    continue
+                count = self._size_many(charter, chart, chart_id or "", profiles)
+                stored += count
+                rejected += len(profiles) - count
+            chunk = []
+            if record is _END:
+                return stored, rejected
+
+    def compact(self, charter=None, registry=None, max_age=None, vacuum=True):
+        """
+        Drop what can no longer be served and refresh what went stale.
+
+        Entries not updated for max_age seconds are deleted. With a charter,
+        its engine's entries are checked against the current charts: entries
+        of a chart ID the registry no longer has are deleted, and stale ones
+        are re-sized in bulk from their stored requests, so the next
+        profile-only request is a hit. Without a registry only default-chart
+        entries are checked. vacuum then returns the freed pages to the file
+        system. Returns counts of "expired", "orphaned" and "refreshed" entries.
+        """
+        report = {"expired": 0, "orphaned": 0, "refreshed": 0}
+        if max_age is not None:
+            with self._lock:
+                report["expired"] = self._conn.execute(
+                    "DELETE FROM profiles WHERE updated < ?", (time.time() - max_age,)).rowcount
+        if charter is not None:
+            engine = charter.BATCH_ENGINE
+            with self._lock:
+                chart_ids = [row[0] for row in self._conn.execute(
+                    "SELECT DISTINCT chart_id FROM profiles WHERE engine = ?", (engine,))]
+            for chart_id in chart_ids:
+                if not chart_id:
+                    chart = charter.chart
+                elif registry is None:
+                    continue
+                else:
+                    try:
+                        chart = registry.get(chart_id)
+                    except KeyError:
+                        with self._lock:
+                            report["orphaned"] += self._conn.execute(
+                                "DELETE FROM profiles WHERE chart_id = ? AND engine = ?", (chart_id, engine)).rowcount
+                        continue
+                    except ValueError:
+                        # A broken chart file: keep its entries until it is fixed
+                        continue
+                version = self.result_version(charter, chart)
+                with self._lock:
+                    stale = [(profile_id, loads(request)) for profile_id, request in self._conn.execute(
+                        "SELECT profile_id, request FROM profiles WHERE chart_id = ? AND engine = ? AND version != ?",
+                        (chart_id, engine, version))]
+                for start in range(0, len(stale), WRITE_CHUNK_ROWS):
+                    report["refreshed"] += self._size_many(charter, chart, chart_id,
+                                                           stale[start:start + WRITE_CHUNK_ROWS])
+        if vacuum:
+            with self._lock:
+                self._conn.execute("VACUUM")
+        return report
+
+    def stats(self):
+        """
+        Stored entries per engine, and request outcomes since the store was opened.
+        """
+        with self._lock:
+            engines = dict(self._conn.execute("SELECT engine, COUNT(*) FROM profiles GROUP BY engine").fetchall())
+        return {
+            "entries": sum(engines.values()),
+            "engines": engines,
+            "hits": self.hits,
+            "refreshed": self.refreshed,
+            "stored": self.stored,
+            "unknown": self.unknown,
+        }
+
+    def series(self, prefix="sizecharter_profile_store"):
+        """
+        Request outcomes as extra series for SizingMetrics.render.
+        """
+        return [(f"{prefix}_{name}_total", "counter", (), getattr(self, name))
+                for name in ("hits", "refreshed", "stored", "unknown")]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm up, compact or inspect a profile store.")
+    parser.add_argument("database", help="SQLite file of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    warmup = commands.add_parser("warmup", help="size and store NDJSON or JSON-array profile records")
+    warmup.add_argument("input", nargs="?", default="-", help="records, each with a profile_id (default: stdin)")
+    compact = commands.add_parser("compact", help="drop old and orphaned entries, refresh stale ones")
+    compact.add_argument("--max-age-days", type=float, help="delete entries not updated for this many days")
+    commands.add_parser("stats", help="print the entry counts")
+    for command in (warmup, compact):
+        command.add_argument("--engine", choices=("tuned", "mimic"), default="tuned")
+        command.add_argument("--chart-dir", help="chart registry directory, for records naming a chart")
+    args = parser.parse_args(argv)
+
+    store = ProfileStore(args.database)
+    try:
+        if args.command == "stats":
+            report = store.stats()
+        else:
+            from sizecharter_cli import make_charter
+            from sizecharter_registry import ChartRegistry
+            charter = make_charter(args.engine)
+            registry = ChartRegistry(args.chart_dir) if args.chart_dir else None
+            if args.command == "warmup":
+                from sizecharter_request import iter_records
+                source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+                try:
+                    # Malformed records reach warmup as ValueErrors and are counted as rejected
+                    stored, rejected = store.warmup(charter, iter_records(source), registry)
+                finally:
+                    if source is not sys.stdin.buffer:
+                        source.close()
+                report = {"stored": stored, "rejected": rejected}
+            else:
+                max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+                report = store.compact(charter, registry, max_age)
+    finally:
+        store.close()
+    print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Table mode: dense precomputed lookups for the fastest in-process sizing call.
+
+Measurements are bounded and usually entered at 0.5 cm resolution, so each
+(department, field) mapping from adjusted value to size can be materialized
+once as a dense array. Slot 2*i is the grid value low + i * resolution itself
+and slot 2*i + 1 the open stretch up to the next grid value. A SizeTable holds
+those arrays for one charter and chart:
+
+    Tuned  the smallest size ordinal whose range covers the value (-1 = none)
+    Mimic  a bitmask of the sizes the value is compatible with
+
+and memoizes the combined chest/waist/hips deltas of every shape combination
+it meets. SizeTable.size() then costs a body shape inference, one delta lookup
+and an array index per present field, and returns exactly the
+recommended_size of get_size_recommendation, without building the result
+object:
+
+    table = SizeTable(SizeCharterTuned())
+    table.size("womens", chest=88, waist=70, hips=95)     # "M"
+    table.footprint()                                     # bytes held by the arrays
+    table.verify(records)                                 # [] when every record agrees
+
+Values off the grid whose stretch contains a range boundary (e.g. a 85.3 cm
+boundary at 0.5 cm resolution), values outside the charts' ranges and NaN are
+resolved through the compiled rule index instead, so every input is answered
+correctly. A table is built for one chart: call refresh() after the charter's
+chart may have changed.
+"""
+import sys
+from array import array
+
+from sizecharter_index import MEASUREMENT_FIELDS
+
+# Fields the morphology adjustments apply to
+ADJUSTED_FIELDS = ("chest", "waist", "hips")
+
+# Fields SizeCharterMimic requires to match
+MIMIC_MATCH_FIELDS = ("chest", "waist", "hips", "shoulders", "neck", "thigh", "calf")
+
+# Most shape combinations memoized per department
+DELTA_MEMO_SIZE = 4096
+
+# Slot value of a stretch that a range boundary splits
+SPLIT = -2
+
+
+def _grid(ranges, resolution):
+    # Grid points (in units of resolution) spanning every boundary with one spare step each side
+    points = [point for _, low, high in ranges for point in (low, high)]
+    return int(min(points) // resolution) - 1, int(-(-max(points) // resolution)) + 1
+
+
+class FieldTable:
+    """
+    Dense lookup of one (department, field): value -> ordinal or size bitmask.
+
+    Slots below the first and above the last grid point repeat the end slots,
+    which lie outside every range.
+    """
+    __slots__ = ("start", "last", "scale", "slots")
+
+    def __init__(self, ranges, resolution, value_at):
+        # ranges: (ordinal, low, high); value_at(value) is the slot value for one value
+        first, final = _grid(ranges, resolution)
+        boundaries = sorted({point for _, low, high in ranges for point in (low, high)})
+        self.scale = 1 / resolution
+        self.start = first
+        self.last = 2 * (final - first)
+        slots = []
+        for i in range(first, final + 1):
+            point = i * resolution
+            slots.append(value_at(point))
+            following = point + resolution
+            if any(point < boundary < following for boundary in boundaries):
+                slots.append(SPLIT)
+            else:
+                slots.append(value_at(point + resolution / 2))
+        slots = slots[:self.last + 1]
+        self.slots = array(_typecode(min(slots), max(slots)), slots)
+
+    def lookup(self, value):
+        """
+        The slot value for value, or SPLIT if a boundary lies in its stretch.
+        """
+        k = value * self.scale - self.start
+        if k <= 0:
+            return self.slots[0]
+        if k >= self.last >> 1:
+            return self.slots[self.last]
+        if k != k:
+            return SPLIT  # NaN: resolved by the compiled index, as off-grid values are
+        i = int(k)
+        return self.slots[2 * i + (k != i)]
+
+
+class SizeTable:
+    """
+    Dense lookup tables of one charter's chart.
+
+    resolution must be 1 or a power-of-two fraction of a centimetre (0.5,
+    0.25, ...), so grid arithmetic is exact in binary floating point.
+    """
+
+    def __init__(self, charter, resolution=0.5):
+        scale = 1 / resolution
+        if scale < 1 or scale != int(scale) or int(scale) & (int(scale) - 1):
+            raise ValueError("resolution must be 1 or a power-of-two fraction, e.g. 0.5")
+        self.charter = charter
+        self.resolution = resolution
+        self.scale = scale
+        self.engine = charter.BATCH_ENGINE
+        self.chart = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuild the tables if the charter's chart changed; returns True if it did.
+        """
+        chart = self.charter.chart
+        if chart is self.chart:
+            return False
+        departments = {}
+        for gender, rules in chart.sizing_rules.items():
+            compiled = chart.compiled[gender]
+            fields = {}
+            for name in MEASUREMENT_FIELDS:
+                ranges = [(ordinal, limits[name][0], limits[name][1])
+                          for ordinal, limits in enumerate(rules.values()) if name in limits]
+                if not ranges:
+                    continue
+                if self.engine == "tuned":
+                    index = compiled.fields[name]
+                    fields[name] = FieldTable(ranges, self.resolution,
+                                              lambda value, index=index: -1 if index.lookup(value) is None
+                                              else index.lookup(value))
+                elif name in MIMIC_MATCH_FIELDS:
+                    fields[name] = FieldTable(ranges, self.resolution,
+                                              lambda value, ranges=ranges, sizes=len(rules): _mimic_mask(ranges, sizes, value))
+            # (position, grid start, last grid step, slots) per looked-up field;
+            # mens are sized on inseam, not hips, by SizeCharterTuned
+            skip = ("hips",) if self.engine == "tuned" and gender == "mens" else ()
+            departments[gender] = {
+                "sizes": compiled.sizes,
+                "fields": fields,
+                "lookups": tuple((MEASUREMENT_FIELDS.index(name), table.start, table.last >> 1, table.slots)
+                                 for name, table in fields.items() if name not in skip),
+                "deltas": {},
+            }
+        self.departments = departments
+        self.chart = chart
+        return True
+
+    def _deltas(self, gender, department, body_shape, abdomen_shape, hip_shape):
+        key = (body_shape, abdomen_shape, hip_shape)
+        deltas = department["deltas"].get(key)
+        if deltas is None:
+            adjustments = self.chart.adjustments_for(gender, body_shape, abdomen_shape, hip_shape)
+            deltas = tuple(adjustments.get(name, 0) for name in ADJUSTED_FIELDS)
+            if len(department["deltas"]) < DELTA_MEMO_SIZE:
+                department["deltas"][key] = deltas
+        return deltas
+
+    def size(self, gender, chest=None, waist=None, hips=None, inseam=None,
+             shoulders=None, neck=None, thigh=None, calf=None, abdomen_shape=None, hip_shape=None):
+        """
+        The recommended_size get_size_recommendation would return for these arguments.
+
+        Raises ValueError for an unknown department.
+        """
+        department = self.departments.get(gender)
+        if department is None:
+            gender = gender.lower()
+            department = self.departments.get(gender)
+            if department is None:
+                raise ValueError("Invalid gender/department. Choose from 'womens', 'mens', or 'maternity'.")
+
+        charter = self.charter
+        if self.engine == "tuned":
+            body_shape = charter._infer_body_shape(gender, chest, waist, hips)
+        else:
+            body_shape = charter._infer_body_shape(gender, chest, waist, hips, shoulders, neck, thigh, calf)
+        d_chest, d_waist, d_hips = self._deltas(gender, department, body_shape, abdomen_shape, hip_shape)
+        values = (chest + d_chest if chest is not None else None,
+                  waist + d_waist if waist is not None else None,
+                  hips + d_hips if hips is not None else None,
+                  inseam, shoulders, neck, thigh, calf)
+
+        if self.engine == "tuned":
+            return self._size_tuned(gender, department, values)
+        return self._size_mimic(gender, department, values)
+
+    def _size_tuned(self, gender, department, values):
+        scale = self.scale
+        best = -1
+        for position, start, top, slots in department["lookups"]:
+            value = values[position]
+            if value is None:
+                continue
+            # FieldTable.lookup, inlined
+            k = value * scale - start
+            if k <= 0:
+                ordinal = slots[0]
+            elif k >= top:
+                ordinal = slots[-1]
+            elif k != k:
+                ordinal = SPLIT  # NaN
+            else:
+                i = int(k)
+                ordinal = slots[2 * i + (k != i)]
+            if ordinal == SPLIT:
+                ordinal = self.chart.compiled[gender].size_for(MEASUREMENT_FIELDS[position], value)
+                ordinal = -1 if ordinal is None else ordinal
+            if ordinal > best:
+                best = ordinal
+        if best >= 0:
+            return department["sizes"][best]
+        weights = self.charter.fallback_weights
+        if weights is not None:
+            nearest = self.chart.nearest_index(gender, weights).nearest(values)
+            if nearest is not None:
+                return nearest.size
+        return "No exact match found"
+
+    def _size_mimic(self, gender, department, values):
+        scale = self.scale
+        sizes = department["sizes"]
+        mask = (1 << len(sizes)) - 1
+        for position, start, top, slots in department["lookups"]:
+            value = values[position]
+            if value is None:
+                continue
+            k = value * scale - start
+            if k <= 0:
+                bits = slots[0]
+            elif k >= top:
+                bits = slots[-1]
+            elif k != k:
+                bits = SPLIT  # NaN
+            else:
+                i = int(k)
+                bits = slots[2 * i + (k != i)]
+            if bits == SPLIT:
+                name = MEASUREMENT_FIELDS[position]
+                bits = _mimic_mask([(ordinal, limits[name][0], limits[name][1])
+                                    for ordinal, limits in enumerate(self.chart.sizing_rules[gender].values())
+                                    if name in limits], len(sizes), value)
+            mask &= bits
+        if mask:
+            return sizes[(mask & -mask).bit_length() - 1]
+        nearest = self.chart.nearest_index(gender, self.charter.fallback_weights).nearest(values)
+        if nearest is not None:
+            return nearest.size
+        return sizes[0] if sizes else "No match found"
+
+    def footprint(self):
+        """
+        Bytes held by the dense arrays, per department and in total.
+        """
+        report = {"total": 0}
+        for gender, department in self.departments.items():
+            size = sum(sys.getsizeof(table.slots) for table in department["fields"].values())
+            report[gender] = size
+            report["total"] += size
+        return report
+
+    def verify(self, records):
+        """
+        Compare size() with the rule-based get_size_recommendation on each record
+        (a dict of get_size_recommendation keyword arguments). Returns the
+        mismatches as (record, rule-based size, table size) tuples.
+        """
+        mismatches = []
+        for record in records:
+            expected = self.charter._recommend(self.chart, **record)
+            expected = expected.get("recommended_size") if isinstance(expected, dict) else expected.recommended_size
+            try:
+                got = self.size(**record)
+            except ValueError:
+                got = None
+            if got != expected:
+                mismatches.append((record, expected, got))
+        return mismatches
+
+
+def _typecode(low, high):
+    # Smallest signed array typecode holding every slot value
+    for code in ("b", "h", "l", "q"):
+        bits = array(code).itemsize * 8 - 1
+        if -(1 << bits) <= low and high < 1 << bits:
+            return code
+    raise ValueError("Too many sizes for table mode")
+
+
+def _mimic_mask(ranges, sizes, value):
+    # Bit s set where size s has no range for the field or its range contains value
+    mask = (1 << sizes) - 1
+    for ordinal, low, high in ranges:
+        if not low <= value <= high:
+            mask &= ~(1 << ordinal)
+    return mask
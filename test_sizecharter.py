@@ -0,0 +1,161 @@
+"""
+Regression tests; run with python -m pytest -q.
+"""
+import asyncio
+import io
+import json
+import threading
+
+import numpy as np
+
+from sizecharter_asgi import SizingApp
+from sizecharter_columnar import NO_CODE, ColumnFile, ndjson_to_columns, size_column_file
+from sizecharter_core import SizeCharterTuned
+from sizecharter_mimic import SizeCharterMimic
+from sizecharter_parallel import ParallelSizer
+from sizecharter_request import iter_records
+from sizecharter_store import ProfileStore
+from sizecharter_table import SizeTable
+
+RECORD = {"gender": "womens", "chest": 88, "waist": 70, "hips": 95}
+
+
+def _ndjson(records):
+    return "".join(json.dumps(record) + "\n" for record in records).encode()
+
+
+def test_parallel_close_after_stopping_early():
+    stream = io.BytesIO(_ndjson([RECORD] * 5000))
+    done = threading.Event()
+
+    def run():
+        with ParallelSizer(SizeCharterMimic(), processes=2, block_bytes=4096) as runner:
+            for count, _ in enumerate(runner.size_stream(stream), 1):
+                if count == 2:
+                    break
+        done.set()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert done.wait(30), "close() did not return after the caller stopped early"
+
+
+def test_parallel_close_with_map_still_open():
+    stream = io.BytesIO(_ndjson([RECORD] * 5000))
+    done = threading.Event()
+    outputs = []
+
+    def run():
+        with ParallelSizer(SizeCharterMimic(), processes=2, block_bytes=4096) as runner:
+            results = runner.size_stream(stream)
+            outputs.append(next(results))
+            outputs.append(next(results))
+            # results is still referenced, so its generator is not closed here
+        done.set()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert done.wait(30), "close() did not return with a map() still open"
+    assert json.loads(outputs[0].splitlines()[0])["recommended_size"]
+
+
+def test_store_warmup_rejects_null_record(tmp_path):
+    lines = [dict(RECORD, profile_id="a"), None, dict(RECORD, profile_id="b")]
+    store = ProfileStore(str(tmp_path / "profiles.db"))
+    try:
+        stored, rejected = store.warmup(SizeCharterMimic(), iter_records(io.BytesIO(_ndjson(lines))))
+        assert (stored, rejected) == (2, 1)
+        assert store.stats()["entries"] == 2
+    finally:
+        store.close()
+
+
+def test_json_array_spanning_chunks():
+    records = [dict(RECORD, profile_id=f"p{i}") for i in range(20000)]
+    body = json.dumps(records, indent=1).encode()
+    assert list(iter_records(io.BytesIO(body))) == records
+
+
+def test_json_array_rejects_trailing_comma():
+    *records, error = iter_records(io.BytesIO(b'[{"chest": 88}, ]'))
+    assert records == [{"chest": 88}]
+    assert isinstance(error, ValueError)
+    assert list(iter_records(io.BytesIO(b" [ ] "))) == []
+
+
+def test_columns_ignore_unknown_shape_names(tmp_path):
+    records = [dict(RECORD, abdomen_shape="junk-shape-" + "x" * 40 + str(i), hip_shape=f"hip-{i}") for i in range(400)]
+    records.append(dict(RECORD, abdomen_shape="soft", hip_shape="pear"))
+    records.append(dict(RECORD, gender="not-a-department"))
+    source = tmp_path / "shoppers.ndjson"
+    source.write_bytes(_ndjson(records))
+    target = str(tmp_path / "shoppers.cols")
+    assert ndjson_to_columns(str(source), target) == len(records)
+
+    charter = SizeCharterMimic()
+    with size_column_file(charter, target) as sizes:
+        size = np.asarray(sizes["size"])
+        names = sizes.metadata["sizes"]["womens"]
+    with ColumnFile(target) as store:
+        assert store.metadata["shapes"] == ["soft", "pear"]
+        assert store["abdomen_shape"][0] == NO_CODE
+        assert store["department"][len(records) - 1] == NO_CODE
+    for i in (0, len(records) - 2):
+        expected = charter.get_size_recommendation(**records[i]).recommended_size
+        assert names[size[i]] == expected
+    assert size[-1] == -1
+
+
+def test_asgi_timed_out_job_keeps_its_slot():
+    async def post(app, body):
+        messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await app({"type": "http", "method": "POST", "path": "/api/size", "headers": []}, receive, send)
+        return sent[0]["status"]
+
+    async def main():
+        app = SizingApp(workers=2, max_pending=1, request_timeout=0.1)
+        release = threading.Event()
+        sizer = app.sizer.get_size_recommendation
+        app.sizer.get_size_recommendation = lambda **kwargs: (release.wait(5), sizer(**kwargs))[1]
+        assert await post(app, RECORD) == 504
+        # The timed-out job still runs on the pool, so it still holds the only slot
+        assert app._pending == 1
+        assert await post(app, RECORD) == 503
+        release.set()
+        await asyncio.wait_for(app._idle.wait(), 5)
+        app.sizer.get_size_recommendation = sizer
+        assert await post(app, RECORD) == 200
+        await app.shutdown()
+
+    asyncio.run(main())
+
+
+def test_table_mode_accepts_nan():
+    nan = float("nan")
+    for charter in (SizeCharterTuned(), SizeCharterTuned(fallback=True), SizeCharterMimic()):
+        table = SizeTable(charter)
+        for kwargs in ({"chest": nan, "waist": 70, "hips": 95}, {"chest": 88, "waist": nan, "hips": nan},
+                       {"inseam": nan, "chest": 100}):
+            for gender in ("womens", "mens"):
+                assert table.size(gender, **kwargs) == charter.get_size_recommendation(gender, **kwargs).recommended_size
+
+
+def test_store_counts_only_stored_profiles(tmp_path):
+    store = ProfileStore(str(tmp_path / "profiles.db"))
+    charter = SizeCharterMimic()
+    try:
+        status, body, _, _ = store.size(charter, dict(RECORD, gender="kids", profile_id="a"))
+        assert status == 200 and b"error" in body
+        assert store.stats()["stored"] == 0 and store.stats()["entries"] == 0
+        store.size(charter, dict(RECORD, profile_id="b"))
+        assert store.stats()["stored"] == 1 and store.stats()["entries"] == 1
+    finally:
+        store.close()